@@ -7,7 +7,8 @@ api_routes = {}
 
 
 class ApiRoute(object):
-    def __init__(self, path, method, doc, fields, db_call, returns):
+    def __init__(self, path, method, doc, fields, db_call, returns,
+                 cached=False, invalidates_cache=False, versioned_by=None):
         assert isinstance(path, str)
         assert method in ['GET', 'POST']
         assert isinstance(path, str)
@@ -21,32 +22,99 @@ class ApiRoute(object):
         self.fields = fields
         self.db_call = db_call
         self.returns = returns
+        # whether the server may serve this from its listing cache, and
+        # whether calling this could change anything that's in there
+        self.cached = cached
+        self.invalidates_cache = invalidates_cache
+        # a function from the params to the name of the db.get_version
+        # counter that changes whenever this route's response could
+        self.versioned_by = versioned_by
 
     @property
     def basename(self):
         return os.path.basename(self.path)
 
+    def parse_params(self, source, limits=None):
+        """
+        Pull this route's arguments out of `source`, a dict-like of raw values
+
+        `limits` overrides the defaults of any `Limit`s, by name. Returns a
+        tuple `(params, errors)` where `errors` is a list of problems with the
+        arguments
+        """
+        params = {}
+        errors = []
+        for field_name, field in self.fields.items():
+            if field_name not in source and field.required:
+                errors.append("missing %s" % (field_name,))
+            elif field_name not in source:
+                params[field_name] = field.default
+            else:
+                try:
+                    value = field.type(source[field_name])
+                except (TypeError, ValueError):
+                    errors.append("invalid %s" % (field_name,))
+                    continue
+                if field.minimum is not None and value < field.minimum:
+                    errors.append("%s must be at least %s"
+                                  % (field_name, field.minimum))
+                elif field.maximum is not None:
+                    # asking for too much isn't an error, they just get
+                    # the most that we allow
+                    value = min(value, _resolve(field.maximum, limits))
+                params[field_name] = value
+        return params, errors
+
     def __repr__(self):
         return "%s<%s>" % (self.__class__.__name__, self.path)
 
 
 class Field(object):
     _REQUIRED = []
-    def __init__(self, description=None, type=str, default=_REQUIRED):
+    def __init__(self, description=None, type=str, default=_REQUIRED,
+                 minimum=None, maximum=None):
         self.description = description
         self.type = type
         self.default = default
+        # bounds on what a client may ask for. values under the minimum are
+        # rejected and values over the maximum are lowered to it
+        self.minimum = minimum
+        self.maximum = maximum
 
     @property
     def required(self):
         return self.default is self._REQUIRED
 
 
-def api_route(path, method, doc, fields, db_call, returns):
-    route = ApiRoute(path, method, doc, fields, db_call, returns)
+class Limit(object):
+    "A Field's bound that the server can be configured with, by `name`"
+    def __init__(self, name, default):
+        self.name = name
+        self.default = default
+
+    def __str__(self):
+        return "%s (configurable)" % (self.default,)
+
+
+def _resolve(bound, limits):
+    if isinstance(bound, Limit):
+        return (limits or {}).get(bound.name, bound.default)
+    return bound
+
+
+def api_route(path, method, doc, fields, db_call, returns, **kw):
+    route = ApiRoute(path, method, doc, fields, db_call, returns, **kw)
     api_routes[path] = route
 
 
+# the most that any one request can ask for, by default. every listing is read
+# into memory before it's sent, so these bound how much work and memory a
+# request can cost. see server.init_app
+MAX_LISTING_LIMIT = 100
+MAX_COMMENT_LIMIT = 500
+MAX_COMMENT_DEPTH = 32
+
+
 api_route('/api/create-author', 'POST',
           'Create a new user account',
           {'author_id': Field('the username of the account to create')},
@@ -66,7 +134,8 @@ api_route('/api/submit-link', 'POST',
            'url': Field('the URL the link should point to', default=None),
            'body': Field('a textual body of the link', default=None)},
           db.submit_link,
-          returns=models.Link)
+          returns=models.Link,
+          invalidates_cache=True)
 
 api_route('/api/get-link', 'GET',
           'Get a link object by ID',
@@ -82,7 +151,8 @@ api_route('/api/submit-comment', 'POST',
            'parent_id': Field('the comment this new comment is replying to if applicable',
                               default=None)},
           db.submit_comment,
-          returns=models.Comment)
+          returns=models.Comment,
+          invalidates_cache=True)
 
 api_route('/api/get-comment', 'GET',
           'Get a comment object by ID',
@@ -91,30 +161,113 @@ api_route('/api/get-comment', 'GET',
           returns=models.Comment)
 
 api_route('/api/get-comments-for-link', 'GET',
-          'Get all of the comments on a link',
-          {'link_id': Field()},
+          'Get the tree of comments on a link',
+          {'link_id': Field(),
+           'parent_id': Field('only get the replies to this comment',
+                              default=None),
+           'sort': Field('how to order each level of the tree: best or new',
+                         default='best'),
+           'depth': Field('how many levels of replies to return',
+                          type=int,
+                          default=8,
+                          minimum=1,
+                          maximum=Limit('max_comment_depth',
+                                        MAX_COMMENT_DEPTH)),
+           'limit': Field('the most comments to return',
+                          type=int,
+                          default=200,
+                          minimum=1,
+                          maximum=Limit('max_comment_limit',
+                                        MAX_COMMENT_LIMIT)),
+           'pager': Field('the pager from a "more" stub, to continue a level that was cut short',
+                          default=None)},
           db.get_comments_for_link,
-          returns=models.CommentListing)
+          returns=models.CommentListing,
+          versioned_by=lambda params: 'comments:%s' % (params['link_id'],))
+
+def _links_version(params):
+    # every listing of links can change when any link does
+    return 'links'
 
 LISTING_FIELDS = {
     'pager': Field('null if requesting the first page. otherwise the value you got for the previous page',
                    default=None),
     'limit': Field('how many to request',
                    type=int,
-                   default=25),
+                   default=25,
+                   minimum=1,
+                   maximum=Limit('max_listing_limit', MAX_LISTING_LIMIT)),
 }
 
 api_route('/api/get-newest-links', 'GET',
           'Get a listing of the youngest links',
           LISTING_FIELDS,
           db.get_newest_links,
-          returns=models.LinkListing)
+          returns=models.LinkListing,
+          cached=True,
+          versioned_by=_links_version)
 
 api_route('/api/get-best-links', 'GET',
           'Get the highest scoring links',
           LISTING_FIELDS,
           db.get_best_links,
-          returns=models.LinkListing)
+          returns=models.LinkListing,
+          cached=True,
+          versioned_by=_links_version)
+
+api_route('/api/get-hot-links', 'GET',
+          'Get the links with the most points for their age',
+          LISTING_FIELDS,
+          db.get_hot_links,
+          returns=models.LinkListing,
+          cached=True,
+          versioned_by=_links_version)
+
+# links drop out of these as they get older, which changes them without any
+# writes, so unlike the other listings they can't be versioned
+api_route('/api/get-top-links', 'GET',
+          'Get the highest scoring links submitted in the past hour, day, week or month',
+          dict(LISTING_FIELDS,
+               period=Field('hour, day, week or month', default='day')),
+          db.get_top_links,
+          returns=models.LinkListing,
+          cached=True)
+
+AUTHOR_LISTING_FIELDS = dict(
+    LISTING_FIELDS,
+    author_id=Field('the username whose history to get'),
+    sort=Field('new or top', default='new'))
+
+api_route('/api/get-author-links', 'GET',
+          'Get the links a user has submitted',
+          AUTHOR_LISTING_FIELDS,
+          db.get_author_links,
+          returns=models.LinkListing,
+          versioned_by=_links_version)
+
+api_route('/api/get-author-comments', 'GET',
+          'Get the comments a user has written',
+          AUTHOR_LISTING_FIELDS,
+          db.get_author_comments,
+          returns=models.CommentPage)
+
+SEARCH_FIELDS = dict(
+    LISTING_FIELDS,
+    q=Field('the words to search for. results have all of them'),
+    author_id=Field('only search what this user wrote', default=None))
+
+api_route('/api/search-links', 'GET',
+          'Search the titles and bodies of links, best matches first',
+          SEARCH_FIELDS,
+          db.search_links,
+          returns=models.LinkListing,
+          versioned_by=_links_version)
+
+api_route('/api/search-comments', 'GET',
+          'Search the bodies of comments, best matches first',
+          SEARCH_FIELDS,
+          db.search_comments,
+          returns=models.CommentPage)
 
 api_route('/api/upvote-link', 'POST',
           'Upvote a link',
@@ -122,7 +275,8 @@ api_route('/api/upvote-link', 'POST',
            'diff': Field('how many points to apply',
                          type=int)},
           db.upvote_link,
-          returns=models.Link)
+          returns=models.Link,
+          invalidates_cache=True)
 
 api_route('/api/upvote-comment', 'POST',
           'Upvote a comment',
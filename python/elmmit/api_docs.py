@@ -29,6 +29,10 @@ def make_docs(route_descriptor):
             if not field.required:
                 if field.default is not None:
                     docs.append("\t\t- default: %s" % field.default)
+            if field.minimum is not None:
+                docs.append("\t\t- minimum: %s" % field.minimum)
+            if field.maximum is not None:
+                docs.append("\t\t- maximum: %s" % field.maximum)
 
         docs.append("Return type: %s" % (route.returns.__name__))
         return_types.add(route.returns)
@@ -0,0 +1,263 @@
+from collections import defaultdict
+from collections import deque
+import ctypes
+import ctypes.util
+import gzip
+import json
+import os
+import os.path
+import sqlite3
+import sys
+import time
+
+
+# copies of a live database. `backup` makes a page-for-page copy with sqlite's
+# online backup API, and `snapshot` writes out every author, link and comment
+# as rows that bulk.import_rows can read back in. both read from a single read
+# transaction, so they see one consistent version of the database, and in WAL
+# mode that never blocks a writer. both sleep between steps so that they leave
+# the disk to the server, and report how fast they're going as they go
+
+_SQLITE_OK = 0
+_SQLITE_BUSY = 5
+_SQLITE_LOCKED = 6
+_SQLITE_DONE = 101
+_SQLITE_OPEN_READONLY = 0x1
+_SQLITE_OPEN_READWRITE = 0x2
+_SQLITE_OPEN_CREATE = 0x4
+
+# how often to report progress, in seconds
+REPORT_INTERVAL = 1.0
+
+
+class BackupError(Exception):
+    "sqlite refused to make the copy"
+
+
+def _libsqlite3():
+    # python 2's sqlite3 module doesn't expose the backup API, so we call it in
+    # the same library that the module is linked against
+    name = ctypes.util.find_library('sqlite3')
+    if name is None:
+        raise BackupError("couldn't find libsqlite3 for the backup API")
+    lib = ctypes.CDLL(name)
+
+    db_p = ctypes.c_void_p
+    lib.sqlite3_open_v2.argtypes = [ctypes.c_char_p, ctypes.POINTER(db_p),
+                                    ctypes.c_int, ctypes.c_char_p]
+    lib.sqlite3_close.argtypes = [db_p]
+    lib.sqlite3_errmsg.argtypes = [db_p]
+    lib.sqlite3_errmsg.restype = ctypes.c_char_p
+    lib.sqlite3_busy_timeout.argtypes = [db_p, ctypes.c_int]
+    lib.sqlite3_exec.argtypes = [db_p, ctypes.c_char_p, ctypes.c_void_p,
+                                 ctypes.c_void_p, ctypes.c_void_p]
+    lib.sqlite3_backup_init.argtypes = [db_p, ctypes.c_char_p,
+                                        db_p, ctypes.c_char_p]
+    lib.sqlite3_backup_init.restype = ctypes.c_void_p
+    lib.sqlite3_backup_step.argtypes = [ctypes.c_void_p, ctypes.c_int]
+    for fn in (lib.sqlite3_backup_remaining, lib.sqlite3_backup_pagecount,
+               lib.sqlite3_backup_finish):
+        fn.argtypes = [ctypes.c_void_p]
+    return lib
+
+
+def _open(lib, fname, flags):
+    handle = ctypes.c_void_p()
+    rc = lib.sqlite3_open_v2(fname, ctypes.byref(handle), flags, None)
+    if rc != _SQLITE_OK:
+        message = lib.sqlite3_errmsg(handle)
+        lib.sqlite3_close(handle)
+        raise BackupError("couldn't open %s: %s" % (fname, message))
+    lib.sqlite3_busy_timeout(handle, 2000)
+    return handle
+
+
+def _exec(lib, handle, sql):
+    if lib.sqlite3_exec(handle, sql, None, None, None) != _SQLITE_OK:
+        raise BackupError(lib.sqlite3_errmsg(handle))
+
+
+def backup(src_path, dest_path, pages_per_step=100, sleep=0.01,
+           progress=sys.stderr):
+    """
+    Copy the database at `src_path` to a new file at `dest_path` while it's in
+    use
+
+    `pages_per_step` pages are copied at a time with a `sleep` between steps.
+    The copy is of the database as it was when we started, however long it
+    takes. Because the read transaction holds the WAL back from being fully
+    checkpointed, a slow backup of a busy database leaves the WAL bigger than
+    usual until it's done. Returns the number of pages copied
+    """
+    if not os.path.exists(src_path):
+        # or sqlite would make an empty one for us to copy
+        raise BackupError("%s doesn't exist" % (src_path,))
+    if os.path.exists(dest_path):
+        raise BackupError("%s already exists" % (dest_path,))
+
+    conn = sqlite3.connect(src_path)
+    page_size, = conn.execute("PRAGMA page_size").fetchone()
+    conn.close()
+
+    lib = _libsqlite3()
+    src = _open(lib, src_path, _SQLITE_OPEN_READONLY)
+    try:
+        dest = _open(lib, dest_path,
+                     _SQLITE_OPEN_READWRITE | _SQLITE_OPEN_CREATE)
+        try:
+            # backup_step takes its own read transaction for every step, and
+            # starts all over again if another connection writes in between
+            # them. if one's already open, it uses that one instead
+            _exec(lib, src, "BEGIN; SELECT count(*) FROM sqlite_master")
+            pages = _copy(lib, src, dest, pages_per_step, sleep, page_size,
+                          progress)
+            _exec(lib, src, "COMMIT")
+        except:
+            # don't leave half a database lying around to be mistaken for one
+            lib.sqlite3_close(dest)
+            os.remove(dest_path)
+            raise
+        else:
+            lib.sqlite3_close(dest)
+    finally:
+        lib.sqlite3_close(src)
+
+    return pages
+
+
+def _copy(lib, src, dest, pages_per_step, sleep, page_size, progress):
+    handle = lib.sqlite3_backup_init(dest, 'main', src, 'main')
+    if not handle:
+        raise BackupError(lib.sqlite3_errmsg(dest))
+
+    start = last_report = time.time()
+    try:
+        while True:
+            rc = lib.sqlite3_backup_step(handle, pages_per_step)
+            if rc == _SQLITE_DONE:
+                break
+            elif rc not in (_SQLITE_OK, _SQLITE_BUSY, _SQLITE_LOCKED):
+                raise BackupError(lib.sqlite3_errmsg(dest))
+
+            if time.time() - last_report >= REPORT_INTERVAL:
+                last_report = time.time()
+                total = lib.sqlite3_backup_pagecount(handle)
+                _report_pages(progress,
+                              total - lib.sqlite3_backup_remaining(handle),
+                              total, page_size, start)
+            time.sleep(sleep)
+        pages = lib.sqlite3_backup_pagecount(handle)
+    finally:
+        rc = lib.sqlite3_backup_finish(handle)
+    if rc != _SQLITE_OK:
+        raise BackupError(lib.sqlite3_errmsg(dest))
+
+    _report_pages(progress, pages, pages, page_size, start)
+    return pages
+
+
+def _report_pages(progress, done, total, page_size, start):
+    elapsed = max(time.time() - start, 1e-6)
+    progress.write("copied %d/%d pages in %.1fs (%.1f MB/sec)\n"
+                   % (done, total, elapsed,
+                      done * page_size / elapsed / (1024 * 1024)))
+
+
+def snapshot(conn, f, chunk_size=1000, sleep=0.01, progress=sys.stderr):
+    """
+    Write every author, link and comment to `f` as gzipped NDJSON
+
+    The rows are in the format that bulk.import_rows reads, and in an order
+    that it can import: authors, then links, then comments with every reply
+    after the comment it replies to. Votes are already counted in the rows'
+    points and karma. Rows are read `chunk_size` at a time with a `sleep`
+    between chunks. Returns the number of rows written
+    """
+    out = gzip.GzipFile(fileobj=f, mode='wb', compresslevel=6)
+    start = last_report = time.time()
+    count = 0
+
+    # like the batch route, one read transaction keeps every chunk to the
+    # same snapshot
+    conn.execute("BEGIN")
+    try:
+        for rows in _snapshot_chunks(conn, chunk_size):
+            out.write(''.join(json.dumps(row, sort_keys=True) + '\n'
+                              for row in rows))
+            count += len(rows)
+            if time.time() - last_report >= REPORT_INTERVAL:
+                last_report = time.time()
+                _report_rows(progress, count, start)
+            time.sleep(sleep)
+    finally:
+        conn.rollback()
+    out.close()
+
+    _report_rows(progress, count, start)
+    return count
+
+
+def _report_rows(progress, count, start):
+    elapsed = max(time.time() - start, 1e-6)
+    progress.write("exported %d rows in %.1fs (%d rows/sec)\n"
+                   % (count, elapsed, count / elapsed))
+
+
+def _snapshot_chunks(conn, chunk_size):
+    # yields lists of rows, each at most about `chunk_size` long
+    for chunk in _by_key(conn, 'author', 'authors', 'author_id',
+                         ['author_id', 'created', 'karma'], chunk_size):
+        yield chunk
+
+    link_columns = ['link_id', 'author_id', 'created', 'title', 'url', 'body',
+                    'points']
+    for chunk in _by_key(conn, 'link', 'links', 'link_id', link_columns,
+                         chunk_size):
+        yield chunk
+
+    # comments go a link at a time, which lets us put parents first
+    comments = []
+    for links in _by_key(conn, 'link', 'links', 'link_id', ['link_id'],
+                         chunk_size):
+        for link in links:
+            comments.extend(_parents_first(conn, link['link_id']))
+            if len(comments) >= chunk_size:
+                yield comments
+                comments = []
+    if comments:
+        yield comments
+
+
+def _by_key(conn, row_type, table, key, columns, chunk_size):
+    # page through the whole of `table` in primary key order
+    query = ("SELECT %s FROM %s WHERE %s > ? ORDER BY %s LIMIT ?"
+             % (', '.join(columns), table, key, key))
+    after = ''
+    while True:
+        rows = [dict(zip(columns, row), type=row_type)
+                for row in conn.execute(query, (after, chunk_size))]
+        if not rows:
+            break
+        yield rows
+        after = rows[-1][key]
+
+
+def _parents_first(conn, link_id):
+    columns = ['comment_id', 'link_id', 'author_id', 'created', 'parent_id',
+               'body', 'points']
+    replies = defaultdict(list)
+    for row in conn.execute("SELECT %s FROM comments WHERE link_id = ?"
+                            % (', '.join(columns),),
+                            (link_id,)):
+        row = dict(zip(columns, row), type='comment')
+        replies[row['parent_id']].append(row)
+
+    # a reply can have the same created time as its parent, so this has to
+    # walk the tree rather than just sort it
+    ordered = []
+    queue = deque(replies.pop(None, []))
+    while queue:
+        row = queue.popleft()
+        ordered.append(row)
+        queue.extend(replies.pop(row['comment_id'], []))
+    return ordered
@@ -0,0 +1,210 @@
+import argparse
+import json
+import os
+import os.path
+import platform
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+from . import bulk
+from . import db
+from . import synth
+
+
+# how many pages deep the "deep page" listing benchmarks fetch
+DEEP_PAGE = 20
+
+
+def _git_commit():
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                           stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _sample(conn, query, k, rng):
+    ids = [row[0] for row in conn.execute(query)]
+    return [rng.choice(ids) for _ in range(k)]
+
+
+def _deep_pager(conn, db_fn):
+    pager = None
+    for _ in range(DEEP_PAGE - 1):
+        pager = db_fn(conn, pager=pager, limit=25).pager
+        if pager is None:
+            break
+    return pager
+
+
+def benchmarks(conn, repeat, rng):
+    """
+    Yield `(name, fn)` for every benchmarked db call, where `fn(i)` runs its
+    `i`th repetition. Anything the calls need is looked up before timing starts
+    """
+    links = _sample(conn, "SELECT link_id FROM links", repeat, rng)
+    comments = _sample(conn, "SELECT comment_id FROM comments", repeat, rng)
+    authors = _sample(conn, "SELECT author_id FROM authors", repeat, rng)
+    busiest_link, = conn.execute(
+        """
+        SELECT link_id FROM comments
+        GROUP BY link_id ORDER BY count(*) DESC LIMIT 1
+        """).fetchone()
+
+    yield 'create_author', lambda i: db.create_author(conn, 'bench%d' % (i,))
+    yield 'get_author', lambda i: db.get_author(conn, authors[i])
+    yield 'submit_link', lambda i: db.submit_link(conn, authors[i], 'title',
+                                                  'http://example.com', None)
+    yield 'get_link', lambda i: db.get_link(conn, links[i])
+    yield 'submit_comment', lambda i: db.submit_comment(conn, links[i],
+                                                        authors[i], 'body')
+    yield 'get_comment', lambda i: db.get_comment(conn, comments[i])
+    yield 'get_comments_for_link', lambda i: db.get_comments_for_link(
+        conn, links[i])
+    yield 'get_comments_for_link_busiest', lambda i: db.get_comments_for_link(
+        conn, busiest_link)
+
+    for db_fn in (db.get_newest_links, db.get_best_links, db.get_hot_links):
+        yield db_fn.__name__, lambda i, db_fn=db_fn: db_fn(conn, None)
+        pager = _deep_pager(conn, db_fn)
+        yield (db_fn.__name__ + '_deep',
+               lambda i, db_fn=db_fn, pager=pager: db_fn(conn, pager))
+
+    yield 'upvote_link', lambda i: db.upvote_link(conn, links[i], 1)
+    yield 'upvote_comment', lambda i: db.upvote_comment(conn, comments[i], 1)
+    yield 'apply_votes', lambda i: db.apply_votes(
+        conn,
+        {link_id: 1 for link_id in links[:100]},
+        {comment_id: 1 for comment_id in comments[:100]})
+
+
+def _summarise(timings):
+    timings = sorted(timings)
+    def percentile(p):
+        return timings[min(int(len(timings) * p), len(timings) - 1)]
+    return {'min_ms': timings[0] * 1000,
+            'p50_ms': percentile(0.5) * 1000,
+            'p95_ms': percentile(0.95) * 1000,
+            'mean_ms': sum(timings) / len(timings) * 1000}
+
+
+def run(sizes, repeat=50, seed=0, output=sys.stdout, ids='random'):
+    """
+    Benchmark every db call against a synthetic dataset of each size in
+    `sizes` (counted in links), writing one JSON object per line to `output`.
+    `ids` is the db.ID_SCHEMES entry that both the dataset and the benchmarked
+    inserts use
+    """
+    meta = {'commit': _git_commit(),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'seed': seed,
+            'repeat': repeat,
+            'ids': ids}
+
+    def emit(**result):
+        result.update(meta)
+        output.write(json.dumps(result, sort_keys=True) + '\n')
+        output.flush()
+
+    for size in sizes:
+        tempdir = tempfile.mkdtemp()
+        try:
+            db_path = os.path.join(tempdir, 'bench.db')
+            conn = db.connect_db(db_path, id_scheme=ids)
+
+            start = time.time()
+            with open(os.devnull, 'w') as devnull:
+                rows = bulk.import_rows(conn,
+                                        synth.generate(size, seed=seed,
+                                                       ids=ids),
+                                        defer_indexes=True,
+                                        progress=devnull)
+            elapsed = time.time() - start
+            emit(op='bulk_import', size=size, rows=rows,
+                 seconds=elapsed, rows_per_sec=rows / elapsed,
+                 db_bytes=os.path.getsize(db_path))
+
+            rng = random.Random(seed)
+            for name, fn in benchmarks(conn, repeat, rng):
+                timings = []
+                for i in range(repeat):
+                    start = time.time()
+                    fn(i)
+                    timings.append(time.time() - start)
+                emit(op=name, size=size, **_summarise(timings))
+
+            conn.close()
+        finally:
+            shutil.rmtree(tempdir)
+
+
+def compare(old, new, out=sys.stdout):
+    """
+    Print the p50 change of every (op, size) between two result files, and
+    the change in import throughput and database size
+    """
+    def load(f):
+        return {(r['op'], r['size']): r for r in map(json.loads, f)}
+    old, new = load(old), load(new)
+
+    def change(before, after):
+        return (after - before) / max(float(before), 1e-9) * 100
+
+    out.write("%-35s %10s %10s %10s %8s\n"
+              % ('op', 'size', 'old p50', 'new p50', 'change'))
+    for key in sorted(set(old) & set(new)):
+        if 'p50_ms' not in old[key] or 'p50_ms' not in new[key]:
+            continue
+        before, after = old[key]['p50_ms'], new[key]['p50_ms']
+        out.write("%-35s %10d %9.3fms %9.3fms %+7.0f%%\n"
+                  % (key[0], key[1], before, after, change(before, after)))
+
+    for key in sorted(set(old) & set(new)):
+        if key[0] != 'bulk_import':
+            continue
+        for field in ['rows_per_sec', 'db_bytes']:
+            before, after = old[key][field], new[key][field]
+            out.write("%-35s %10d %10d %10d %+7.1f%%\n"
+                      % ('bulk_import ' + field, key[1], before, after,
+                         change(before, after)))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        'elmmit.bench',
+        description='benchmark the db layer against synthetic datasets')
+    parser.add_argument('--sizes', default='1000,10000,100000',
+                        help='comma-separated dataset sizes, in links')
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--ids', choices=sorted(db.ID_SCHEMES),
+                        default='random',
+                        help='how the dataset and the inserts make their IDs')
+    parser.add_argument('--output', default=None,
+                        help='write results here instead of stdout')
+    parser.add_argument('--compare', default=None,
+                        help='results from an earlier run to compare against')
+    arguments = parser.parse_args()
+
+    sizes = [int(size) for size in arguments.sizes.split(',')]
+    if arguments.output:
+        with open(arguments.output, 'w') as output:
+            run(sizes, arguments.repeat, arguments.seed, output,
+                ids=arguments.ids)
+    else:
+        run(sizes, arguments.repeat, arguments.seed, ids=arguments.ids)
+
+    if arguments.compare and arguments.output:
+        with open(arguments.compare) as old, open(arguments.output) as new:
+            compare(old, new, out=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
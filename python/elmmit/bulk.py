@@ -0,0 +1,180 @@
+from collections import Counter
+import csv
+import json
+import sys
+import time
+
+from . import db
+
+
+# the order that each batch is written in, so that rows can refer to rows of
+# an earlier type that came before them in the same batch
+ROW_TYPES = ['author', 'link', 'comment', 'vote']
+
+# columns that hold numbers when they're read from a CSV file
+INT_COLUMNS = set(['created', 'points', 'karma', 'diff'])
+
+
+def read_ndjson(f):
+    "Yield one dict per non-empty line of newline-delimited JSON"
+    for line in f:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+
+def read_csv(f):
+    """
+    Yield one dict per row of a CSV file with a header row
+
+    Every row has a `type` column, plus whichever of the other columns apply
+    to that type. Empty cells are treated as missing
+    """
+    for row in csv.DictReader(f):
+        yield {name: int(value) if name in INT_COLUMNS else value
+               for name, value in row.items()
+               if value != '' and value is not None}
+
+
+READERS = {
+    'ndjson': read_ndjson,
+    'csv': read_csv,
+}
+
+
+def import_rows(conn, rows, batch_size=10000, defer_indexes=False,
+                progress=sys.stderr):
+    """
+    Write a stream of author, link, comment and vote dicts to the database
+
+    Rows are written with executemany in batches of `batch_size`, each batch in
+    its own transaction, so only one batch is ever held in memory. With
+    `defer_indexes` the secondary indexes are dropped for the duration and
+    rebuilt in one pass at the end, which is much faster for big imports into
+    big tables. Returns the number of rows imported
+    """
+    dropped = _drop_indexes(conn) if defer_indexes else []
+
+    start = time.time()
+    count = 0
+    batch = {row_type: [] for row_type in ROW_TYPES}
+    pending = 0
+
+    try:
+        for row in rows:
+            row_type = row.get('type')
+            if row_type not in batch:
+                raise ValueError("unknown row type %r" % (row_type,))
+            batch[row_type].append(row)
+            pending += 1
+
+            if pending >= batch_size:
+                _write_batch(conn, batch)
+                count += pending
+                pending = 0
+                _report(progress, count, start)
+
+        _write_batch(conn, batch)
+        count += pending
+
+    finally:
+        if dropped:
+            progress.write("rebuilding %d indexes\n" % (len(dropped),))
+            conn.executescript(';\n'.join(dropped))
+
+    _report(progress, count, start)
+    return count
+
+
+def _report(progress, count, start):
+    elapsed = max(time.time() - start, 1e-6)
+    progress.write("imported %d rows in %.1fs (%d rows/sec)\n"
+                   % (count, elapsed, count / elapsed))
+
+
+def _drop_indexes(conn):
+    # returns the SQL to put back all of the explicitly created indexes. the
+    # ones backing primary keys have no SQL and can't be dropped anyway
+    indexes = list(conn.execute(
+        """
+        SELECT name, sql
+        FROM sqlite_master
+        WHERE type='index' AND sql IS NOT NULL
+        """))
+    for name, _ in indexes:
+        conn.execute('DROP INDEX "%s"' % (name,))
+    return [sql for _, sql in indexes]
+
+
+def _write_batch(conn, batch):
+    with conn:
+        curs = conn.cursor()
+
+        curs.executemany(
+            """
+            INSERT OR IGNORE INTO authors(author_id, created, karma)
+            VALUES(lower(?), coalesce(?, strftime('%s','now')), coalesce(?, 0))
+            """,
+            [(row['author_id'], row.get('created'), row.get('karma'))
+             for row in batch['author']])
+
+        now = int(time.time())
+
+        links = [(row.get('link_id') or db._new_id(conn), row)
+                 for row in batch['link']]
+        curs.executemany(
+            """
+            INSERT INTO links(link_id, author_id, created, title, url, body,
+                              points, hot)
+            VALUES(?, lower(?), ?, ?, ?, ?, ?, hot_score(?, ?))
+            """,
+            [(link_id,
+              row['author_id'],
+              row.get('created', now),
+              row['title'],
+              row.get('url'),
+              row.get('body'),
+              row.get('points', 0),
+              row.get('points', 0),
+              row.get('created', now))
+             for link_id, row in links])
+        db._add_top_links(curs, [(link_id,
+                                  row.get('created', now),
+                                  row.get('points', 0))
+                                 for link_id, row in links])
+
+        curs.executemany(
+            """
+            INSERT INTO comments(comment_id, link_id, author_id, created,
+                                 parent_id, body, points)
+            VALUES(?, ?, lower(?), ?, ?, ?, ?)
+            """,
+            [(row.get('comment_id') or db._new_id(conn),
+              row['link_id'],
+              row['author_id'],
+              row.get('created', now),
+              row.get('parent_id'),
+              row['body'],
+              row.get('points', 0))
+             for row in batch['comment']])
+
+        counts = Counter()
+        newest = {}
+        for row in batch['comment']:
+            created = row.get('created', now)
+            counts[row['link_id']] += 1
+            newest[row['link_id']] = max(newest.get(row['link_id']), created)
+        db._count_comments(curs, [(count, newest[link_id], link_id)
+                                  for link_id, count in counts.items()])
+
+        link_diffs = Counter()
+        comment_diffs = Counter()
+        for row in batch['vote']:
+            if row.get('link_id'):
+                link_diffs[row['link_id']] += row.get('diff', 1)
+            else:
+                comment_diffs[row['comment_id']] += row.get('diff', 1)
+        db.apply_votes(curs, link_diffs, comment_diffs)
+
+    for rows in batch.values():
+        del rows[:]
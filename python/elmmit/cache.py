@@ -0,0 +1,72 @@
+from collections import OrderedDict
+import time
+
+from . import utils
+
+
+class ListingCache(object):
+    """
+    Cache of ready-to-send listing responses
+
+    Entries live for at most `ttl` seconds and at most `max_size` of them are
+    kept, evicting the least recently used first. Writes that could change a
+    listing call `invalidate` to drop everything.
+
+    A response is computed outside of the lock, so callers take a `generation`
+    before running the query and hand it back to `put`. If anything was
+    invalidated in the meantime the (possibly stale) response isn't stored
+    """
+
+    def __init__(self, max_size=1000, ttl=5.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.state = utils.LockBox({
+            'entries': OrderedDict(),
+            'generation': 0,
+            'hits': 0,
+            'misses': 0,
+            'invalidations': 0,
+        })
+
+    def get(self, key):
+        "Returns the cached body for `key`, or None"
+        with self.state as state:
+            entries = state['entries']
+            entry = entries.pop(key, None)
+            if entry is not None and entry[0] > time.time():
+                # re-insert it to mark it as most recently used
+                entries[key] = entry
+                state['hits'] += 1
+                return entry[1]
+            state['misses'] += 1
+            return None
+
+    @property
+    def generation(self):
+        with self.state as state:
+            return state['generation']
+
+    def put(self, key, body, generation):
+        with self.state as state:
+            if generation != state['generation']:
+                return
+            entries = state['entries']
+            entries.pop(key, None)
+            entries[key] = (time.time() + self.ttl, body)
+            while len(entries) > self.max_size:
+                entries.popitem(last=False)
+
+    def invalidate(self):
+        with self.state as state:
+            state['entries'].clear()
+            state['generation'] += 1
+            state['invalidations'] += 1
+
+    def stats(self):
+        with self.state as state:
+            return {'size': len(state['entries']),
+                    'max_size': self.max_size,
+                    'ttl': self.ttl,
+                    'hits': state['hits'],
+                    'misses': state['misses'],
+                    'invalidations': state['invalidations']}
@@ -1,11 +1,18 @@
 import argparse
+import gzip
 import json
+import logging
 import pprint
+import shlex
+import sys
 
 from elmmit import api
+from elmmit import backup
+from elmmit import bulk
 from elmmit import db
-from elmmit import models
-from elmmit import server
+from elmmit import maintenance
+# the server (and flask with it) is only imported for the server command, since
+# importing it takes much longer than most commands take to run
 
 def main():
     parser = argparse.ArgumentParser('elmmit')
@@ -14,14 +21,277 @@ def main():
                         help='path to sqlite database',
                         required=True,
                         default="elmmit.db")
+    parser.add_argument('--id-scheme',
+                        choices=sorted(db.ID_SCHEMES),
+                        default='random',
+                        help='how to make the IDs of new links and comments.'
+                             ' sortable ones are faster to insert')
 
     subparsers = parser.add_subparsers()
 
     server_subparser = subparsers.add_parser("server")
     server_subparser.add_argument('--port', '-p', default=8080, type=int)
     server_subparser.add_argument('--host', default='0.0.0.0')
+    server_subparser.add_argument(
+        '--vote-flush-interval',
+        type=float,
+        default=None,
+        help='buffer upvotes and write them out every this many seconds')
+    server_subparser.add_argument(
+        '--listing-cache-ttl',
+        type=float,
+        default=5.0,
+        help='how many seconds to cache listings for. 0 disables the cache')
+    server_subparser.add_argument(
+        '--listing-cache-size',
+        type=int,
+        default=1000,
+        help='the most listing responses to cache')
+    server_subparser.add_argument(
+        '--max-batch-size',
+        type=int,
+        default=50,
+        help='the most calls a client can make in one /api/batch request')
+    server_subparser.add_argument(
+        '--trace-sql',
+        action='store_true',
+        help='log slow queries and queries that scan whole tables')
+    server_subparser.add_argument(
+        '--sqlite-readers',
+        type=int,
+        default=0,
+        help='serve requests from threads and run their reads on this many '
+             'sqlite worker threads. 0 runs them on the request threads')
+    server_subparser.add_argument(
+        '--max-queued',
+        type=int,
+        default=100,
+        help='the most calls that can wait for the writer (or, with '
+             '--sqlite-readers, the readers) before requests get a 503')
+    server_subparser.add_argument(
+        '--request-timeout',
+        type=float,
+        default=10.0,
+        help='how many seconds a request waits for its turn with the writer '
+             '(or readers) before getting a 503')
+    server_subparser.add_argument(
+        '--max-write-batch',
+        type=int,
+        default=100,
+        help='the most writes to commit together in one transaction')
+    server_subparser.add_argument(
+        '--query-budget',
+        type=float,
+        default=5.0,
+        help='how many seconds the reads of one request may run for before '
+             'they are stopped and it gets a 503. 0 for no limit')
+    server_subparser.add_argument(
+        '--max-listing-limit',
+        type=int,
+        default=api.MAX_LISTING_LIMIT,
+        help='the most links a listing request can ask for')
+    server_subparser.add_argument(
+        '--max-comment-limit',
+        type=int,
+        default=api.MAX_COMMENT_LIMIT,
+        help='the most comments a request can ask for')
+    server_subparser.add_argument(
+        '--max-comment-depth',
+        type=int,
+        default=api.MAX_COMMENT_DEPTH,
+        help='the most levels of replies a request can ask for')
+    server_subparser.add_argument(
+        '--maintenance-interval',
+        type=float,
+        default=None,
+        help='vacuum, checkpoint and analyze the database every this many '
+             'seconds, like the maintain command')
     server_subparser.set_defaults(func='server')
 
+    import_subparser = subparsers.add_parser(
+        "bulk-import",
+        help='stream authors, links, comments and votes into the database')
+    import_subparser.add_argument(
+        'input',
+        nargs='?',
+        default='-',
+        help='the file to import, or - for stdin (default: %(default)s)')
+    import_subparser.add_argument(
+        '--format',
+        choices=sorted(bulk.READERS),
+        default=None,
+        help='the input format (default: from the file extension, or ndjson)')
+    import_subparser.add_argument('--batch-size', default=10000, type=int)
+    import_subparser.add_argument(
+        '--defer-indexes',
+        action='store_true',
+        help='drop the indexes during the import and rebuild them afterwards')
+    import_subparser.set_defaults(func='bulk-import')
+
+    search_subparser = subparsers.add_parser(
+        "rebuild-search",
+        help='index any links and comments missing from the search indexes')
+    search_subparser.add_argument('--batch-size', default=1000, type=int)
+    search_subparser.set_defaults(func='rebuild-search')
+
+    counts_subparser = subparsers.add_parser(
+        "repair-comment-counts",
+        help="recount every link's comments and fix any that are wrong")
+    counts_subparser.add_argument('--batch-size', default=1000, type=int)
+    counts_subparser.set_defaults(func='repair-comment-counts')
+
+    maintain_subparser = subparsers.add_parser(
+        'maintain',
+        help='vacuum, checkpoint and analyze the database a little at a time')
+    maintain_subparser.add_argument(
+        '--vacuum-seconds',
+        default=1.0,
+        type=float,
+        help='how long to spend giving free pages back to the filesystem. '
+             'whatever is left is done by the next run')
+    maintain_subparser.add_argument('--vacuum-step',
+                                    default=maintenance.VACUUM_STEP,
+                                    type=int)
+    maintain_subparser.add_argument(
+        '--wal-threshold-mb',
+        default=maintenance.WAL_THRESHOLD / (1024 * 1024),
+        type=float,
+        help='checkpoint if the WAL is bigger than this')
+    maintain_subparser.add_argument(
+        '--checkpoint',
+        choices=maintenance.CHECKPOINT_MODES,
+        default='passive',
+        help='passive never waits for readers or writers. truncate waits so '
+             'that it can empty the WAL')
+    maintain_subparser.add_argument(
+        '--analyze',
+        choices=['optimize', 'full', 'none'],
+        default='optimize',
+        help='optimize only analyzes the tables that have grown or shrunk a '
+             'lot since they last were')
+    maintain_subparser.add_argument(
+        '--analysis-limit',
+        default=maintenance.ANALYSIS_LIMIT,
+        type=int,
+        help='how many rows of each index to look at when analyzing. 0 for '
+             'all of them')
+    maintain_subparser.set_defaults(func='maintain')
+
+    backup_subparser = subparsers.add_parser(
+        'backup',
+        help='copy the database to a new file while the server is using it')
+    backup_subparser.add_argument('output', help='where to write the copy')
+    backup_subparser.add_argument('--pages-per-step', default=100, type=int)
+    backup_subparser.add_argument(
+        '--sleep',
+        default=0.01,
+        type=float,
+        help='seconds to wait between steps, to leave the disk to the server')
+    backup_subparser.set_defaults(func='backup')
+
+    snapshot_subparser = subparsers.add_parser(
+        'snapshot',
+        help='export the database as gzipped NDJSON that bulk-import can read')
+    snapshot_subparser.add_argument(
+        'output',
+        help='file to write the export to, or - for stdout')
+    snapshot_subparser.add_argument('--chunk-size', default=1000, type=int)
+    snapshot_subparser.add_argument(
+        '--sleep',
+        default=0.01,
+        type=float,
+        help='seconds to wait between chunks, to leave the disk to the server')
+    snapshot_subparser.set_defaults(func='snapshot')
+
+    batch_subparser = subparsers.add_parser(
+        'batch',
+        help='run API commands from stdin, one per line, over one connection, '
+             'and print one JSON result per line')
+    batch_subparser.set_defaults(func='batch')
+
+    _add_route_commands(subparsers)
+
+    arguments = parser.parse_args()
+
+    if hasattr(arguments, 'route'):
+        # it was an auto-generated command. construct the call to the
+        # underlying DB command
+        conn = db.connect_db(arguments.f, id_scheme=arguments.id_scheme)
+        route = arguments.route
+        args = {name: getattr(arguments, name)
+                for name in route.fields}
+        print "%s %s:" % (route.basename, args)
+        result = route.db_call(conn, **args)
+        pprint.pprint(result.to_json())
+
+    elif arguments.func == 'batch':
+        conn = db.connect_db(arguments.f, id_scheme=arguments.id_scheme)
+        run_batch(conn, iter(sys.stdin.readline, ''), sys.stdout)
+
+    elif arguments.func == 'bulk-import':
+        bulk_import(arguments)
+
+    elif arguments.func == 'rebuild-search':
+        conn = db.connect_db(arguments.f)
+        db.rebuild_search(conn, batch_size=arguments.batch_size)
+
+    elif arguments.func == 'repair-comment-counts':
+        conn = db.connect_db(arguments.f)
+        db.repair_comment_counts(conn, batch_size=arguments.batch_size)
+
+    elif arguments.func == 'maintain':
+        conn = db.connect_db(arguments.f)
+        maintenance.maintain(
+            conn,
+            vacuum_seconds=arguments.vacuum_seconds,
+            vacuum_step=arguments.vacuum_step,
+            wal_threshold=int(arguments.wal_threshold_mb * 1024 * 1024),
+            checkpoint_mode=arguments.checkpoint,
+            analyze=None if arguments.analyze == 'none' else arguments.analyze,
+            analysis_limit=arguments.analysis_limit,
+            progress=sys.stdout)
+
+    elif arguments.func == 'backup':
+        backup.backup(arguments.f, arguments.output,
+                      pages_per_step=arguments.pages_per_step,
+                      sleep=arguments.sleep)
+
+    elif arguments.func == 'snapshot':
+        conn = db.connect_db(arguments.f)
+        if arguments.output == '-':
+            f = sys.stdout
+        else:
+            f = open(arguments.output, 'wb')
+        with f:
+            backup.snapshot(conn, f,
+                            chunk_size=arguments.chunk_size,
+                            sleep=arguments.sleep)
+
+    elif arguments.func == 'server':
+        from elmmit import server
+        if arguments.trace_sql:
+            logging.basicConfig()
+        server.server(db_path=arguments.f,
+                      host=arguments.host,
+                      port=arguments.port,
+                      vote_flush_interval=arguments.vote_flush_interval,
+                      listing_cache_ttl=arguments.listing_cache_ttl,
+                      listing_cache_size=arguments.listing_cache_size,
+                      max_batch_size=arguments.max_batch_size,
+                      trace_sql=arguments.trace_sql,
+                      sqlite_readers=arguments.sqlite_readers,
+                      max_queued=arguments.max_queued,
+                      request_timeout=arguments.request_timeout,
+                      max_write_batch=arguments.max_write_batch,
+                      id_scheme=arguments.id_scheme,
+                      query_budget=arguments.query_budget,
+                      maintenance_interval=arguments.maintenance_interval,
+                      max_listing_limit=arguments.max_listing_limit,
+                      max_comment_limit=arguments.max_comment_limit,
+                      max_comment_depth=arguments.max_comment_depth)
+
+
+def _add_route_commands(subparsers, add_help=True):
     # autogenerate command-line versions of all API functions.  we autogenerate
     # the parser out of the API description given by server.py.  this lets us
     # have a nice command-line interface without having to write individual
@@ -29,7 +299,8 @@ def main():
     # arguments can be
     for route_path, route in sorted(api.api_routes.items()):
         subparser = subparsers.add_parser(route.basename,
-                                          help=route.doc)
+                                          help=route.doc,
+                                          add_help=add_help)
         for field_name, field in route.fields.items():
             subparser.add_argument(
                 '--' + field_name,
@@ -39,23 +310,80 @@ def main():
                 default=field.default)
             subparser.set_defaults(route=route)
 
-    arguments = parser.parse_args()
 
-    if hasattr(arguments, 'route'):
-        # it was an auto-generated command. construct the call to the
-        # underlying DB command
-        conn = db.connect_db(arguments.f)
+def run_batch(conn, lines, out):
+    """
+    Run an API command from each line of `lines`, writing one JSON object per
+    line to `out`
+
+    A line is either what would follow `elmmit -f ...` on the command line, like
+    `get-link --link_id abc`, or a JSON object like `{"command": "get-link",
+    "params": {"link_id": "abc"}}`. Blank lines and lines starting with # are
+    skipped. Each result is `{"result": ...}` or `{"errors": [...]}`, as with
+    the server's batch route
+    """
+    # without any --help, which would print to `out` in amongst the results
+    parser = argparse.ArgumentParser('elmmit batch', add_help=False)
+    _add_route_commands(parser.add_subparsers(), add_help=False)
+
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        out.write(json.dumps(_run_batch_line(conn, parser, line)) + '\n')
+        # whoever is feeding us lines may be waiting for the answer
+        out.flush()
+
+
+def _run_batch_line(conn, parser, line):
+    if line.startswith('{'):
+        try:
+            command = json.loads(line)
+            route = api.api_routes['/api/' + command['command']]
+            params, errors = route.parse_params(command.get('params', {}))
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return {'errors': ['malformed command %r' % (line,)]}
+        if errors:
+            return {'errors': errors}
+    else:
+        try:
+            arguments = parser.parse_args(shlex.split(line))
+        except (SystemExit, ValueError):
+            # argparse has already said what was wrong on stderr
+            return {'errors': ['invalid command %r' % (line,)]}
         route = arguments.route
-        args = {name: getattr(arguments, name)
-                for name in route.fields}
-        print "%s %s:" % (route.basename, args)
-        result = route.db_call(conn, **args)
-        pprint.pprint(result.to_json())
+        params = {name: getattr(arguments, name) for name in route.fields}
 
-    elif arguments.func == 'server':
-        server.server(db_path=arguments.f,
-                      host=arguments.host,
-                      port=arguments.port)
+    try:
+        return {'result': route.db_call(conn, **params).to_json()}
+    except Exception as ex:
+        return {'errors': [repr(ex)]}
+
+
+def bulk_import(arguments):
+    # a .gz (like a snapshot) is read through gzip, and otherwise the same
+    name = arguments.input
+    compressed = name.endswith('.gz')
+    if compressed:
+        name = name[:-len('.gz')]
+
+    fmt = arguments.format
+    if fmt is None:
+        fmt = 'csv' if name.endswith('.csv') else 'ndjson'
+
+    if arguments.input == '-':
+        f = sys.stdin
+    elif compressed:
+        f = gzip.open(arguments.input, 'rb')
+    else:
+        f = open(arguments.input, 'rb')
+
+    conn = db.connect_db(arguments.f, id_scheme=arguments.id_scheme)
+    with f:
+        bulk.import_rows(conn,
+                         bulk.READERS[fmt](f),
+                         batch_size=arguments.batch_size,
+                         defer_indexes=arguments.defer_indexes)
 
 
 if __name__ == '__main__':
@@ -1,85 +1,332 @@
+from collections import Counter
+from collections import deque
 from collections import namedtuple
+from contextlib import contextmanager
 from functools import wraps
+import Queue
 import json
+import math
 import sqlite3
 import sys
 import time
 
+from . import metrics
 from . import utils
 from . models import Author, Comment, Link
-from . models import LinkListing, CommentListing
+from . models import LinkListing, CommentListing, CommentPage
+from . models import CommentTree, MoreComments
 
-def connect_db(fname):
-    conn = sqlite3.connect(fname)
+# the schema as it was before we started versioning it. everything since then
+# is applied on top of this by _MIGRATIONS. (it had links_by_author and
+# comments_by_author indexes too, until migration 5 replaced them)
+_SCHEMA = """
+    PRAGMA auto_vacuum=INCREMENTAL;
+    PRAGMA encoding="UTF-8";
+    PRAGMA journal_mode=WAL;
 
+    CREATE TABLE IF NOT EXISTS authors (
+        author_id NOT NULL PRIMARY KEY,
+        created NOT NULL DEFAULT (strftime('%s','now')),
+        karma INTEGER NOT NULL DEFAULT 0
+    ) WITHOUT ROWID;
+
+    CREATE TABLE IF NOT EXISTS links (
+        link_id NOT NULL PRIMARY KEY,
+        author_id NOT NULL REFERENCES authors(author_id),
+        created INTEGER NOT NULL DEFAULT (strftime('%s','now')),
+        title TEXT NOT NULL,
+        url TEXT NULL,
+        body TEXT NULL,
+        points INTEGER NOT NULL DEFAULT (0)
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS links_by_points ON links(points DESC);
+    CREATE INDEX IF NOT EXISTS links_by_created ON links(created DESC);
+
+    CREATE TABLE IF NOT EXISTS comments (
+        comment_id NOT NULL PRIMARY KEY,
+        link_id NOT NULL REFERENCES links(link_id),
+        author_id NOT NULL REFERENCES authors(author_id),
+        created INTEGER NOT NULL DEFAULT (strftime('%s','now')),
+        parent_id NULL REFERENCES comments(comment_id),
+        body TEXT NOT NULL,
+        points INTEGER NOT NULL DEFAULT (0)
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS comments_by_link ON comments(link_id);
+"""
+
+# the windows of the "top" listings, in seconds. see get_top_links
+TOP_PERIODS = {
+    'hour': 3600,
+    'day': 86400,
+    'week': 7*86400,
+    'month': 30*86400,
+}
+
+# schema changes, in order. the database records how many of these it has had
+# applied in PRAGMA user_version. each one is either a SQL script or a function
+# that takes a cursor, for migrations that need to backfill data
+_MIGRATIONS = [
+    # 1: precomputed "hot" rank for get_hot_links
+    """
+    ALTER TABLE links ADD COLUMN hot REAL NOT NULL DEFAULT 0;
+    UPDATE links SET hot = hot_score(points, created);
+    CREATE INDEX IF NOT EXISTS links_by_hot ON links(hot DESC);
+    """,
+    # 2: one index per comment sort so that each level of a comment tree can be
+    # read straight out of an index
+    """
+    CREATE INDEX IF NOT EXISTS comments_by_parent_points
+        ON comments(link_id, parent_id, points DESC);
+    CREATE INDEX IF NOT EXISTS comments_by_parent_created
+        ON comments(link_id, parent_id, created DESC);
+    """,
+    # 3: version counters for conditional GETs, see get_version
+    """
+    CREATE TABLE IF NOT EXISTS versions (
+        name NOT NULL PRIMARY KEY,
+        version INTEGER NOT NULL DEFAULT 0,
+        modified INTEGER NOT NULL DEFAULT 0
+    ) WITHOUT ROWID;
+    """ + ''.join(
+        # (sqlite before 3.24 has no upsert, so it's an insert and an update)
+        """
+        CREATE TRIGGER IF NOT EXISTS %(table)s_version_%(event)s
+        AFTER %(event)s ON %(table)s BEGIN
+            INSERT OR IGNORE INTO versions(name) VALUES(%(name)s);
+            UPDATE versions
+            SET version = version + 1, modified = strftime('%%s','now')
+            WHERE name = %(name)s;
+        END;
+        """ % {'table': table, 'event': event, 'name': name}
+        for table, name in [('links', "'links'"),
+                            ('comments', "'comments:' || NEW.link_id")]
+        for event in ['insert', 'update']),
+    # 4: full-text search, if this sqlite has it
+    lambda conn: _search_schema(conn),
+    # 5: indexes for paging through an author's history in either order. they
+    # also cover everything that the single-column ones did
+    """
+    CREATE INDEX IF NOT EXISTS links_by_author_created
+        ON links(author_id, created DESC);
+    CREATE INDEX IF NOT EXISTS links_by_author_points
+        ON links(author_id, points DESC);
+    CREATE INDEX IF NOT EXISTS comments_by_author_created
+        ON comments(author_id, created DESC);
+    CREATE INDEX IF NOT EXISTS comments_by_author_points
+        ON comments(author_id, points DESC);
+    DROP INDEX IF EXISTS links_by_author;
+    DROP INDEX IF EXISTS comments_by_author;
+    """,
+    # 6: comment counts kept on the links themselves, so that listings don't
+    # have to look at the comments. see also repair_comment_counts
+    """
+    ALTER TABLE links ADD COLUMN num_comments INTEGER NOT NULL DEFAULT 0;
+    ALTER TABLE links ADD COLUMN last_comment_at INTEGER NULL;
+    UPDATE links SET
+        num_comments = (SELECT count(*) FROM comments
+                        WHERE comments.link_id = links.link_id),
+        last_comment_at = (SELECT max(created) FROM comments
+                           WHERE comments.link_id = links.link_id)
+    WHERE link_id IN (SELECT link_id FROM comments);
+    """,
+    # 7: the links young enough for each "top" listing, see get_top_links
+    """
+    CREATE TABLE IF NOT EXISTS top_links (
+        period NOT NULL,
+        link_id NOT NULL REFERENCES links(link_id),
+        created INTEGER NOT NULL,
+        points INTEGER NOT NULL,
+        PRIMARY KEY (link_id, period)
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS top_links_by_points
+        ON top_links(period, points DESC);
+    CREATE INDEX IF NOT EXISTS top_links_by_created
+        ON top_links(period, created);
+    """ + ''.join(
+        """
+        INSERT INTO top_links(period, link_id, created, points)
+        SELECT '%s', link_id, created, points FROM links
+        WHERE created >= strftime('%%s','now') - %d;
+        """ % (period, seconds)
+        for period, seconds in sorted(TOP_PERIODS.items())),
+]
+
+
+# how new links and comments get their IDs. random ones scatter inserts all
+# over the tables' b-trees, while sortable ones are always appended to the end.
+# either way they're opaque strings, so the two can be mixed in one database
+ID_SCHEMES = {
+    'random': utils.uuid4_36,
+    'sortable': utils.sortable_id,
+}
+
+
+def connect_db(fname, init_schema=True, check_same_thread=True, tracer=None,
+               id_scheme='random'):
+    conn = sqlite3.connect(fname,
+                           check_same_thread=check_same_thread,
+                           factory=metrics.InstrumentedConnection)
+    # see tracing.QueryTracer
+    conn.tracer = tracer
+    conn.new_id = ID_SCHEMES[id_scheme]
+
+    # these are per-connection settings, unlike the ones in _SCHEMA which are
+    # stored in the database file itself
     conn.executescript("""
-        PRAGMA auto_vacuum=INCREMENTAL;
         PRAGMA busy_timeout=2000;
-        PRAGMA encoding="UTF-8";
         PRAGMA foreign_keys=true;
-        PRAGMA journal_mode=WAL;
-
-        CREATE TABLE IF NOT EXISTS authors (
-            author_id NOT NULL PRIMARY KEY,
-            created NOT NULL DEFAULT (strftime('%s','now')),
-            karma INTEGER NOT NULL DEFAULT 0
-        ) WITHOUT ROWID;
-
-        CREATE TABLE IF NOT EXISTS links (
-            link_id NOT NULL PRIMARY KEY,
-            author_id NOT NULL REFERENCES authors(author_id),
-            created INTEGER NOT NULL DEFAULT (strftime('%s','now')),
-            title TEXT NOT NULL,
-            url TEXT NULL,
-            body TEXT NULL,
-            points INTEGER NOT NULL DEFAULT (0)
-        ) WITHOUT ROWID;
-        CREATE INDEX IF NOT EXISTS links_by_author ON links(author_id);
-        CREATE INDEX IF NOT EXISTS links_by_points ON links(points DESC);
-        CREATE INDEX IF NOT EXISTS links_by_created ON links(created DESC);
-
-        CREATE TABLE IF NOT EXISTS comments (
-            comment_id NOT NULL PRIMARY KEY,
-            link_id NOT NULL REFERENCES links(link_id),
-            author_id NOT NULL REFERENCES authors(author_id),
-            created INTEGER NOT NULL DEFAULT (strftime('%s','now')),
-            parent_id NULL REFERENCES comments(comment_id),
-            body TEXT NOT NULL,
-            points INTEGER NOT NULL DEFAULT (0)
-        ) WITHOUT ROWID;
-        CREATE INDEX IF NOT EXISTS comments_by_author ON comments(author_id);
-        CREATE INDEX IF NOT EXISTS comments_by_link ON comments(link_id);
     """)
+    conn.create_function('hot_score', 2, hot_score)
+
+    if init_schema:
+        create_schema(conn)
+
     conn.row_factory = sqlite3.Row
 
     return conn
 
 
+def create_schema(conn):
+    "Create any missing tables and bring the schema up to date"
+
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version == len(_MIGRATIONS):
+        # the usual case. everything in _SCHEMA is already there (its PRAGMAs
+        # are stored in the file) so there's no need to run it all again
+        return
+
+    conn.executescript(_SCHEMA)
+
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for version, migration in enumerate(_MIGRATIONS[version:], version+1):
+        if callable(migration):
+            # one that depends on what this sqlite can do, which works out the
+            # SQL to run
+            migration = migration(conn)
+        # executescript doesn't take part in the sqlite3 module's transaction
+        # handling so we have to make our own. (the module's own would commit
+        # before every CREATE, so a migration couldn't fail half way through)
+        try:
+            conn.executescript("BEGIN; %s; PRAGMA user_version=%d; COMMIT;"
+                               % (migration, version))
+        except sqlite3.Error:
+            # which also means that conn.rollback() doesn't know it's open
+            _rollback_script(conn)
+            raise
+
+
+def _rollback_script(conn):
+    try:
+        conn.execute("ROLLBACK")
+    except sqlite3.OperationalError:
+        # it failed before it got as far as starting its transaction
+        pass
+
+
+# the zero point and decay rate of the hot ranking. every HOT_DECAY seconds of
+# age is worth an order of magnitude of points
+HOT_EPOCH = 1134028003
+HOT_DECAY = 45000.0
+
+
+def hot_score(points, created):
+    """
+    The rank of a link in the "hot" listing
+
+    Newer links get a higher base score rather than older links having theirs
+    decayed, so the score only changes when the link's points do and can be
+    stored and indexed
+    """
+    order = math.log10(max(abs(points), 1))
+    sign = 1 if points > 0 else -1 if points < 0 else 0
+    return round(sign * order + (created - HOT_EPOCH) / HOT_DECAY, 7)
+
+
+class ConnectionPool(object):
+    """A pool of warm connections to a single database
+
+    Opening a connection means re-running all of the per-connection PRAGMAs,
+    so we keep some around between requests. The schema is expected to have
+    already been created with `create_schema`. A connection can be checked out
+    and returned by different threads but must only be used by one at a time
+    """
+
+    def __init__(self, fname, max_idle=16, tracer=None, id_scheme='random'):
+        self.fname = fname
+        self.tracer = tracer
+        self.id_scheme = id_scheme
+        # LIFO so that the most recently used connection (with the warmest
+        # page cache) is the next one handed out
+        self.idle = Queue.LifoQueue(max_idle)
+
+    def checkout(self):
+        try:
+            return self.idle.get_nowait()
+        except Queue.Empty:
+            return connect_db(self.fname,
+                              init_schema=False,
+                              check_same_thread=False,
+                              tracer=self.tracer,
+                              id_scheme=self.id_scheme)
+
+    def checkin(self, conn):
+        # don't let a failed request leave a transaction open for the next one
+        conn.rollback()
+        try:
+            self.idle.put_nowait(conn)
+        except Queue.Full:
+            conn.close()
+
+    @contextmanager
+    def connection(self):
+        conn = self.checkout()
+        try:
+            yield conn
+        finally:
+            self.checkin(conn)
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except Queue.Empty:
+                break
+
+
 class Pager(object):
     """Representation of an opaque cursor
 
     Queries that return listings also return one of these strings so that
     further calls can retrieve the next page of results
 
-    Note: the implementation uses sqlite's OFFSET operator which is very slow
-    on large datasets
+    The cursor holds the sort key and ID of the last row of the previous page
+    so the next page can seek directly to it through the listing's index
+    instead of counting past every earlier row with OFFSET
     """
 
-    def __init__(self, offset):
-        self.offset = offset
+    def __init__(self, after=None):
+        # None, or a (sort_value, id) pair for the last row we returned
+        self.after = after
 
     @classmethod
     def parse(cls, blob):
         if not blob:
-            return cls(offset=0)
+            return cls()
         try:
-            offset = json.loads(utils.debase64(blob))['offset']
-            return cls(offset=offset)
+            sort_value, id_ = json.loads(utils.debase64(blob))['after']
+            return cls(after=(sort_value, id_))
         except Exception:
-            return cls(offset=0)
+            return cls()
 
     def unparse(self):
-        return utils.enbase64(json.dumps({'offset': self.offset}))
+        return utils.enbase64(json.dumps({'after': list(self.after)}))
+
+
+def _new_id(conn):
+    # the functions wrapped by `transaction` are handed a cursor
+    if isinstance(conn, sqlite3.Cursor):
+        conn = conn.connection
+    return conn.new_id()
 
 
 def transaction(fn):
@@ -87,7 +334,7 @@ def transaction(fn):
     def _fn(conn, *a, **kw):
         if isinstance(conn, sqlite3.Cursor):
             # if we're already in a transaction, just pass it along
-            return fn(conn, *w, **kw)
+            return fn(conn, *a, **kw)
         else:
             with conn:
                 # otherwise start one and pass that in instead
@@ -96,6 +343,44 @@ def transaction(fn):
     return _fn
 
 
+class OverBudget(Exception):
+    "A call's queries ran for longer than it was allowed, and were stopped"
+
+
+# how many sqlite VM instructions run_with_budget lets go by between looking
+# at the clock
+BUDGET_CHECK_INTERVAL = 1000
+
+
+def run_with_budget(conn, seconds, fn, *a, **kw):
+    """
+    Call `fn(conn, *a, **kw)`, but interrupt whatever query it's running once
+    `seconds` have passed and raise OverBudget instead
+
+    Interrupting a write rolls back its whole transaction, so this is meant for
+    reads
+    """
+    deadline = time.time() + seconds
+    expired = []
+
+    def check():
+        # sqlite aborts the statement when this returns true
+        if time.time() > deadline:
+            expired.append(True)
+            return 1
+        return 0
+
+    conn.set_progress_handler(check, BUDGET_CHECK_INTERVAL)
+    try:
+        return fn(conn, *a, **kw)
+    except sqlite3.OperationalError:
+        if expired:
+            raise OverBudget("the query took longer than %.1fs" % (seconds,))
+        raise
+    finally:
+        conn.set_progress_handler(None, BUDGET_CHECK_INTERVAL)
+
+
 @transaction
 def create_author(conn, author_id):
     "Create an author ID if it doesn't already exist"
@@ -116,82 +401,234 @@ def get_author(conn, author_id):
 
     rows = conn.execute(
         """
-        SELECT *
+        SELECT %s
         FROM authors WHERE author_id = lower(?)
-        """,
+        """ % (Author.columns,),
         (author_id,))
 
-    return Author(**rows.fetchone())
+    return Author.from_row(rows.fetchone())
 
 
 @transaction
 def submit_link(conn, author_id, title, url, body, created=None):
-    link_id = utils.uuid4_36()
+    link_id = _new_id(conn)
     created = int(created or time.time())
     conn.execute(
         """
-        INSERT INTO links(link_id, author_id, title, url, body, created)
-        VALUES(?, lower(?), ?, ?, ?, ?)
+        INSERT INTO links(link_id, author_id, title, url, body, created, hot)
+        VALUES(?, lower(?), ?, ?, ?, ?, hot_score(0, ?))
         """,
-        (link_id, author_id, title, url, body, created))
+        (link_id, author_id, title, url, body, created, created))
+    _add_top_links(conn, [(link_id, created, 0)])
     return get_link(conn, link_id)
 
 
+def _add_top_links(curs, links, now=None):
+    # takes (link_id, created, points)s, and adds the ones that are young
+    # enough to each of the top listings. it's a good time to drop the ones
+    # that have got too old, since there are usually as many of them as there
+    # are new ones
+    now = int(now or time.time())
+    for period, seconds in sorted(TOP_PERIODS.items()):
+        cutoff = now - seconds
+        curs.execute(
+            "DELETE FROM top_links WHERE period = ? AND created < ?",
+            (period, cutoff))
+        curs.executemany(
+            """
+            INSERT OR IGNORE INTO top_links(period, link_id, created, points)
+            VALUES(?, ?, ?, ?)
+            """,
+            [(period, link_id, created, points)
+             for link_id, created, points in links
+             if created >= cutoff])
+
+
 def get_link(conn, link_id):
     rows = conn.execute(
         """
-        SELECT *
+        SELECT %s
         FROM links
         WHERE link_id=?
-        """,
+        """ % (Link.columns,),
         (link_id,))
-    return Link(**rows.fetchone())
+    return Link.from_row(rows.fetchone())
 
 
 @transaction
 def submit_comment(conn, link_id, author_id, body, parent_id=None):
-    comment_id = utils.uuid4_36()
+    comment_id = _new_id(conn)
 
     if parent_id is not None:
         parent = get_comment(conn, parent_id)
         if parent.link_id != link_id:
             raise ValueError("Comments with parents must belong to the same link")
 
+    created = int(time.time())
     conn.execute(
         """
-        INSERT INTO comments(comment_id, link_id, author_id, body, parent_id)
-        VALUES(?, ?, lower(?), ?, ?)
+        INSERT INTO comments(comment_id, link_id, author_id, body, parent_id,
+                             created)
+        VALUES(?, ?, lower(?), ?, ?, ?)
         """,
-        (comment_id, link_id, author_id, body, parent_id or None))
+        (comment_id, link_id, author_id, body, parent_id or None, created))
+    _count_comments(conn, [(1, created, link_id)])
     return get_comment(conn, comment_id)
 
 
+def _count_comments(curs, counts):
+    # takes (new comments, newest created, link_id)s
+    curs.executemany(
+        """
+        UPDATE links SET
+            num_comments = num_comments + ?,
+            last_comment_at = max(coalesce(last_comment_at, 0), ?)
+        WHERE link_id = ?
+        """,
+        counts)
+
+
+def repair_comment_counts(conn, batch_size=1000, progress=sys.stderr):
+    """
+    Recount every link's comments, and fix any whose num_comments or
+    last_comment_at are wrong
+
+    Goes through the links in batches of `batch_size`, each in its own
+    transaction. Only links that were wrong are written. Returns how many
+    there were
+    """
+    start = time.time()
+    after = ''
+    checked = repaired = 0
+    while True:
+        with conn:
+            rows = list(conn.execute(
+                """
+                SELECT link_id, num_comments, last_comment_at,
+                       (SELECT count(*) FROM comments
+                        WHERE comments.link_id = links.link_id),
+                       (SELECT max(created) FROM comments
+                        WHERE comments.link_id = links.link_id)
+                FROM links WHERE link_id > ?
+                ORDER BY link_id LIMIT ?
+                """,
+                (after, batch_size)))
+            if not rows:
+                break
+            wrong = [(count, newest, link_id)
+                     for link_id, num_comments, last_comment_at, count, newest
+                     in rows
+                     if (num_comments, last_comment_at) != (count, newest)]
+            conn.executemany(
+                """
+                UPDATE links SET num_comments = ?, last_comment_at = ?
+                WHERE link_id = ?
+                """,
+                wrong)
+        after = rows[-1][0]
+        checked += len(rows)
+        repaired += len(wrong)
+        progress.write("checked %d links, repaired %d, in %.1fs\n"
+                       % (checked, repaired, time.time() - start))
+    return repaired
+
+
 def get_comment(conn, comment_id):
     rows = conn.execute(
         """
-        SELECT *
+        SELECT %s
         FROM comments
         WHERE comment_id=?
-        """,
+        """ % (Comment.columns,),
         (comment_id,))
-    return Comment(**rows.fetchone())
+    return Comment.from_row(rows.fetchone())
+
+
+# the orderings available within each level of a comment tree, and the column
+# each one sorts by
+COMMENT_SORTS = {
+    'best': 'points',
+    'new': 'created',
+}
 
 
-def get_comments_for_link(conn, link_id):
+def get_comments_for_link(conn, link_id, parent_id=None, sort='best',
+                          depth=8, limit=200, pager=None):
     """
-    Get all of the comments for a link.
+    Get the tree of comments on a link
 
-    No pagination, sorting, or tree-building is done
+    Every level of the tree is sorted by `sort` (one of COMMENT_SORTS). At most
+    `limit` comments are returned in total, down to at most `depth` levels.
+    Replies that didn't fit are left out and represented by a MoreComments
+    stub, whose `parent_id` and `pager` can be passed back in here to fetch
+    them. With `parent_id` the tree starts from that comment's replies rather
+    than from the top-level comments
     """
+    try:
+        sort_column = COMMENT_SORTS[sort]
+    except KeyError:
+        raise ValueError("unknown sort %r" % (sort,))
+    if depth < 1 or limit < 1:
+        raise ValueError("depth and limit must be positive")
+
+    remaining = [limit]
+
+    def fetch_replies(parent_id, pager=None):
+        comments, next_pager = _paginate(conn, Comment, 'comments',
+                                         'comment_id', sort_column,
+                                         pager, remaining[0],
+                                         where="link_id = ? AND parent_id IS ?",
+                                         params=(link_id, parent_id))
+        remaining[0] -= len(comments)
+        more = None
+        if next_pager is not None:
+            more = MoreComments(link_id=link_id, parent_id=parent_id,
+                                pager=next_pager)
+        return comments, more
 
+    # walk the tree breadth-first so that the budget is spent on the top of
+    # the thread before its deeper replies. `replies` maps each comment_id
+    # that we expanded to its (comments, more)
+    roots, roots_more = fetch_replies(parent_id, pager)
+    replies = {}
+    unexpanded = []
+    queue = deque((comment, 1) for comment in roots)
+    while queue:
+        comment, comment_depth = queue.popleft()
+        if comment_depth >= depth or remaining[0] == 0:
+            unexpanded.append(comment.comment_id)
+            continue
+        children, more = fetch_replies(comment.comment_id)
+        replies[comment.comment_id] = children, more
+        queue.extend((child, comment_depth+1) for child in children)
+
+    # anything we didn't get to only needs a stub if it actually has replies
+    for comment_id in unexpanded:
+        if _has_replies(conn, link_id, comment_id):
+            replies[comment_id] = [], MoreComments(link_id=link_id,
+                                                   parent_id=comment_id,
+                                                   pager=None)
+
+    def build(comment):
+        children, more = replies.get(comment.comment_id, ([], None))
+        return CommentTree(comment=comment,
+                           replies=[build(child) for child in children],
+                           more=more)
+
+    return CommentListing(comments=[build(comment) for comment in roots],
+                          more=roots_more)
+
+
+def _has_replies(conn, link_id, comment_id):
     rows = conn.execute(
         """
-        SELECT *
+        SELECT 1
         FROM comments
-        WHERE link_id=?
+        WHERE link_id=? AND parent_id=?
+        LIMIT 1
         """,
-        (link_id,))
-    return CommentListing(comments=[Comment(**row) for row in rows])
+        (link_id, comment_id))
+    return rows.fetchone() is not None
 
 
 def get_newest_links(conn, pager, limit=25):
@@ -201,17 +638,9 @@ def get_newest_links(conn, pager, limit=25):
     Returns a tuple `(links, cursor)` where `cursor` is either None or a string
     that can be used to fetch the next page of results
     """
-    rows, next_pager = _paginate(
-        conn,
-        """
-        SELECT *
-        FROM links
-        ORDER BY created DESC
-        """,
-        (),
-        pager,
-        limit)
-    return LinkListing(links=[Link(**row) for row in rows], pager=next_pager)
+    links, next_pager = _paginate(conn, Link, 'links', 'link_id', 'created',
+                                  pager, limit)
+    return LinkListing(links=links, pager=next_pager)
 
 
 def get_best_links(conn, pager, limit=25):
@@ -221,38 +650,359 @@ def get_best_links(conn, pager, limit=25):
     Returns a tuple `(links, cursor)` where `cursor` is either None or a string
     that can be used to fetch the next page of results
     """
-    rows, next_pager = _paginate(
-        conn,
-        """
-        SELECT *
-        FROM links
-        ORDER BY points DESC
-        """,
-        (),
-        pager,
-        limit)
-    return LinkListing(links=[Link(**row) for row in rows],
-                       pager=next_pager)
+    links, next_pager = _paginate(conn, Link, 'links', 'link_id', 'points',
+                                  pager, limit)
+    return LinkListing(links=links, pager=next_pager)
+
+
+def get_hot_links(conn, pager, limit=25):
+    """
+    Get the `limit` hottest links, ranked by points decayed over age
+
+    Returns a tuple `(links, cursor)` where `cursor` is either None or a string
+    that can be used to fetch the next page of results
+    """
+    links, next_pager = _paginate(conn, Link, 'links', 'link_id', 'hot',
+                                  pager, limit)
+    return LinkListing(links=links, pager=next_pager)
+
+
+# the orderings of an author's links and comments, and the column each one
+# sorts by
+AUTHOR_SORTS = {
+    'new': 'created',
+    'top': 'points',
+}
+
+
+def get_author_links(conn, author_id, sort='new', pager=None, limit=25):
+    "Get a page of the links submitted by `author_id`"
+    links, next_pager = _paginate_author(conn, Link, 'links', 'link_id',
+                                         author_id, sort, pager, limit)
+    return LinkListing(links=links, pager=next_pager)
+
+
+def get_author_comments(conn, author_id, sort='new', pager=None, limit=25):
+    "Get a page of the comments written by `author_id`"
+    comments, next_pager = _paginate_author(conn, Comment, 'comments',
+                                            'comment_id', author_id, sort,
+                                            pager, limit)
+    return CommentPage(comments=comments, pager=next_pager)
+
+
+def get_top_links(conn, period, pager=None, limit=25):
+    """
+    Get the highest scoring links submitted in the last `period` (one of
+    TOP_PERIODS)
+    """
+    try:
+        cutoff = int(time.time()) - TOP_PERIODS[period]
+    except KeyError:
+        raise ValueError("unknown period %r" % (period,))
+
+    # walking top_links_by_points. anything in there that's since got too old
+    # is skipped until _add_top_links drops it. (the unary + keeps sqlite from
+    # using top_links_by_created instead, which only narrows things down by
+    # those few and then has to sort the rest)
+    links, next_pager = _paginate(
+        conn, Link, 'top_links JOIN links USING (link_id)', 'link_id',
+        'top_links.points', pager, limit,
+        where="top_links.period = ? AND +top_links.created >= ?",
+        params=(period, cutoff),
+        columns=', '.join('links.' + field for field in Link.fields))
+    return LinkListing(links=links, pager=next_pager)
+
 
+def _paginate_author(conn, model, table, id_column, author_id, sort, pager,
+                     limit):
+    try:
+        sort_column = AUTHOR_SORTS[sort]
+    except KeyError:
+        raise ValueError("unknown sort %r" % (sort,))
+    return _paginate(conn, model, table, id_column, sort_column, pager, limit,
+                     where="author_id = lower(?)", params=(author_id,))
 
-def _paginate(conn, query, params, pager, limit):
-    # helper function for our pageable queries since they all look the same
+
+def _paginate(conn, model, table, id_column, sort_column, pager, limit,
+              where=None, params=(), columns=None):
+    # helper function for our pageable queries since they all look the same.
+    # rows come back ordered by `sort_column` DESC with `id_column` as the
+    # tiebreaker. our WITHOUT ROWID tables append the primary key to every
+    # index, so an index on (sort_column DESC) is really an index on
+    # (sort_column DESC, id_column ASC) and satisfies this ordering without a
+    # sort step. an optional `where` clause narrows the rows further, and
+    # should be covered by the leading columns of that same index.
+    #
+    # `table` can also be a join or a subquery, with any parameters of its own
+    # at the start of `params`. then `columns` picks the model's columns out
+    # of it, and `sort_column` and `id_column` can be any expressions
 
     # take our opaque cursor and parse it
     pager = Pager.parse(pager)
 
-    # take the query and add our LIMIT & OFFSET portions. fetch one more than
-    # the limit so we know if there are any entries on the next page or not
-    rows = conn.execute(query + " LIMIT ? OFFSET ?",
-                        params + (limit+1, pager.offset))
+    conditions = [where] if where else []
+    params = tuple(params)
+    if pager.after is not None:
+        # seek past the last row we returned. this is written so that sqlite
+        # can use the index range on `sort_column` rather than a MULTI-INDEX
+        # OR, which would need a temp b-tree for the ORDER BY
+        sort_value, id_ = pager.after
+        conditions.append("{sort} <= ? AND ({sort} < ? OR {id} > ?)")
+        params += (sort_value, sort_value, id_)
+
+    # fetch one more than the limit so we know if there are any entries on the
+    # next page or not. the sort and id values come last, for the next pager
+    query = "SELECT {columns}, {sort}, {id} FROM {table}"
+    if conditions:
+        query += " WHERE " + " AND ".join("(%s)" % c for c in conditions)
+    query += " ORDER BY {sort} DESC, {id} ASC LIMIT ?"
+    query = query.format(columns=columns or model.columns, table=table,
+                         sort=sort_column, id=id_column)
+    rows = conn.execute(query, params + (limit+1,))
     rows = list(rows)
 
     next_pager = None
-    if len(rows) > limit:
-        next_pager = Pager(offset=pager.offset+limit).unparse()
+    if len(rows) > limit > 0:
         rows = rows[:-1]
+        last = rows[-1]
+        next_pager = Pager(after=(last[-2], last[-1])).unparse()
+
+    width = len(model.fields)
+    return [model.from_row(tuple(row)[:width]) for row in rows], next_pager
+
+
+# full-text indexes of links and comments. sqlite can only index the contents
+# of tables with a rowid, so the indexes hold their own copy of the text along
+# with each row's ID. rows are indexed by triggers as they're inserted (there's
+# no way to edit them), except while rebuild_search is working through a table:
+# then anything past its progress is left for it to get to
+_SEARCH_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS search_rebuilds (
+        name NOT NULL PRIMARY KEY,
+        after NOT NULL
+    ) WITHOUT ROWID;
+
+    CREATE VIRTUAL TABLE IF NOT EXISTS links_search USING fts5(
+        title, body, link_id UNINDEXED, tokenize='porter unicode61');
+    CREATE TRIGGER IF NOT EXISTS links_search_insert AFTER INSERT ON links
+    WHEN NOT EXISTS (SELECT 1 FROM search_rebuilds
+                     WHERE name = 'links' AND NEW.link_id > after)
+    BEGIN
+        INSERT INTO links_search(title, body, link_id)
+        VALUES(NEW.title, NEW.body, NEW.link_id);
+    END;
+
+    CREATE VIRTUAL TABLE IF NOT EXISTS comments_search USING fts5(
+        body, comment_id UNINDEXED, tokenize='porter unicode61');
+    CREATE TRIGGER IF NOT EXISTS comments_search_insert AFTER INSERT ON comments
+    WHEN NOT EXISTS (SELECT 1 FROM search_rebuilds
+                     WHERE name = 'comments' AND NEW.comment_id > after)
+    BEGIN
+        INSERT INTO comments_search(body, comment_id)
+        VALUES(NEW.body, NEW.comment_id);
+    END;
+"""
+
+# the tables that can be searched: (table, id column, index, indexed columns)
+_SEARCHES = {
+    'links': ('links', 'link_id', 'links_search', ['title', 'body']),
+    'comments': ('comments', 'comment_id', 'comments_search', ['body']),
+}
+
+# the get_version counters that searches are served by, see api.py. the
+# indexes are virtual tables and can't have the triggers that bump them, so
+# rebuild_search does it
+_SEARCH_VERSIONS = {'links': 'links'}
+
+# how much more a word in a link's title counts than one in its body
+SEARCH_TITLE_WEIGHT = 5.0
+
+
+def has_fts5(conn):
+    try:
+        conn.execute("CREATE VIRTUAL TABLE temp.fts5_check USING fts5(x)")
+    except sqlite3.OperationalError:
+        return False
+    conn.execute("DROP TABLE temp.fts5_check")
+    return True
+
+
+def create_search(conn):
+    """
+    Set up the full-text indexes, if sqlite was built with FTS5
+
+    Anything that was already in the database has to be indexed afterwards
+    with rebuild_search. Returns whether search is available
+    """
+    if not has_fts5(conn):
+        return False
+    schema = _search_schema(conn)
+    if schema:
+        try:
+            conn.executescript("BEGIN; %s; COMMIT;" % (schema,))
+        except sqlite3.Error:
+            _rollback_script(conn)
+            raise
+    return True
+
+
+def _search_schema(conn):
+    # the SQL that sets up search, or none if it can't be or already has been.
+    # tables with rows in already are marked as needing rebuild_search
+    if not has_fts5(conn) or has_search(conn):
+        return ''
+    return _SEARCH_SCHEMA + ''.join(
+        """
+        INSERT OR IGNORE INTO search_rebuilds(name, after)
+        SELECT '%s', '' WHERE EXISTS (SELECT 1 FROM %s);
+        """ % (name, table)
+        for name, (table, _, _, _) in sorted(_SEARCHES.items()))
 
-    return rows, next_pager
+
+def has_search(conn):
+    return bool(conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE name = 'links_search'").fetchone())
+
+
+def _bump_search_version(conn, name):
+    # the same as the versions triggers do
+    version = _SEARCH_VERSIONS.get(name)
+    if version is not None:
+        conn.execute("INSERT OR IGNORE INTO versions(name) VALUES(?)",
+                     (version,))
+        conn.execute(
+            """
+            UPDATE versions
+            SET version = version + 1, modified = strftime('%s','now')
+            WHERE name = ?
+            """, (version,))
+
+
+def rebuild_search(conn, batch_size=1000, progress=sys.stderr):
+    """
+    Index every link and comment that's missing from the full-text indexes
+
+    Works through each table in order of ID, one transaction per `batch_size`
+    rows, so it can run alongside the server. If it's interrupted, running it
+    again picks up where it left off. With nothing to pick up it starts again
+    from scratch, in case the indexes have got out of step
+    """
+    if not create_search(conn):
+        raise ValueError("this sqlite wasn't built with FTS5")
+
+    for name, (table, id_column, index, columns) in sorted(_SEARCHES.items()):
+        with conn:
+            row = conn.execute(
+                "SELECT after FROM search_rebuilds WHERE name = ?",
+                (name,)).fetchone()
+            if row is None:
+                conn.execute("DELETE FROM %s" % (index,))
+                conn.execute(
+                    "INSERT INTO search_rebuilds(name, after) VALUES(?, '')",
+                    (name,))
+                _bump_search_version(conn, name)
+                after = ''
+            else:
+                after = row[0]
+
+        start = time.time()
+        count = 0
+        while True:
+            with conn:
+                ids = [row[0] for row in conn.execute(
+                    """
+                    SELECT {id} FROM {table} WHERE {id} > ?
+                    ORDER BY {id} LIMIT ?
+                    """.format(id=id_column, table=table),
+                    (after, batch_size))]
+                if not ids:
+                    conn.execute(
+                        "DELETE FROM search_rebuilds WHERE name = ?", (name,))
+                    break
+                conn.execute(
+                    """
+                    INSERT INTO {index}({columns}, {id})
+                    SELECT {columns}, {id} FROM {table}
+                    WHERE {id} > ? AND {id} <= ?
+                    """.format(index=index, table=table, id=id_column,
+                               columns=', '.join(columns)),
+                    (after, ids[-1]))
+                after = ids[-1]
+                conn.execute(
+                    "UPDATE search_rebuilds SET after = ? WHERE name = ?",
+                    (after, name))
+                _bump_search_version(conn, name)
+            count += len(ids)
+            elapsed = max(time.time() - start, 1e-6)
+            progress.write("indexed %d %s in %.1fs (%d/sec)\n"
+                           % (count, name, elapsed, count / elapsed))
+
+        with conn:
+            conn.execute("INSERT INTO %s(%s) VALUES('optimize')"
+                         % (index, index))
+
+
+def _match_query(q):
+    # every word has to appear. quoting each one keeps FTS5 from reading any
+    # of its query syntax into what the user typed
+    return ' '.join('"%s"' % (word.replace('"', '""'),) for word in q.split())
+
+
+def search_links(conn, q, author_id=None, pager=None, limit=25):
+    """
+    Find the links with all of the words in `q` in their title or body, most
+    relevant first
+    """
+    links, next_pager = _search(
+        conn, Link, 'links', q, author_id, pager, limit,
+        'bm25(links_search, %r, 1.0)' % (SEARCH_TITLE_WEIGHT,))
+    return LinkListing(links=links, pager=next_pager)
+
+
+def search_comments(conn, q, author_id=None, pager=None, limit=25):
+    "Find the comments with all of the words in `q`, most relevant first"
+    comments, next_pager = _search(
+        conn, Comment, 'comments', q, author_id, pager, limit,
+        'bm25(comments_search)')
+    return CommentPage(comments=comments, pager=next_pager)
+
+
+def _search(conn, model, name, q, author_id, pager, limit, rank):
+    # paginated by relevance. FTS5 has to find and rank every match to order
+    # them, so paging only saves sending them
+    table, id_column, index, _ = _SEARCHES[name]
+    match = _match_query(q)
+    if not match:
+        return [], None
+
+    # bm25 is more negative for better matches
+    matches = """
+        (SELECT {id}, -{rank} AS score FROM {index} WHERE {index} MATCH ?)
+        JOIN {table} USING ({id})
+    """.format(id=id_column, rank=rank, index=index, table=table)
+    where = None
+    params = (match,)
+    if author_id is not None:
+        where = "author_id = lower(?)"
+        params += (author_id,)
+    return _paginate(conn, model, matches, id_column, 'score', pager, limit,
+                     where=where, params=params)
+
+
+def get_version(conn, name):
+    """
+    How many times `name` has changed and when it last did, as `(version,
+    modified)`
+
+    The versions are kept by triggers on every write, whoever makes it, so
+    they're cheap to check before doing the real work. `links` changes with
+    any link (and as rebuild_search indexes them) and `comments:<link_id>`
+    with any comment on that link
+    """
+    row = conn.execute(
+        "SELECT version, modified FROM versions WHERE name = ?",
+        (name,)).fetchone()
+    return (row[0], row[1]) if row else (0, 0)
 
 
 @transaction
@@ -264,10 +1014,13 @@ def upvote_link(curs, link_id, diff=1):
     """
     curs.execute(
         """
-        UPDATE links SET points = points + ?
+        UPDATE links SET points = points + ?,
+                         hot = hot_score(points + ?, created)
         WHERE link_id=?
         """,
-        (diff, link_id))
+        (diff, diff, link_id))
+    curs.execute("UPDATE top_links SET points = points + ? WHERE link_id = ?",
+                 (diff, link_id))
     link = get_link(curs, link_id)
     _increment_karma(curs, link.author_id, diff)
     return get_link(curs, link_id)
@@ -291,6 +1044,52 @@ def upvote_comment(curs, comment_id, diff=1):
     return get_comment(curs, comment_id)
 
 
+@transaction
+def apply_votes(curs, link_diffs, comment_diffs):
+    """
+    Apply many upvotes at once
+
+    Takes dicts of {link_id: diff} and {comment_id: diff} and credits each
+    author's karma once with the total for all of their items
+    """
+    curs.executemany(
+        """
+        UPDATE links SET points = points + ?,
+                         hot = hot_score(points + ?, created)
+        WHERE link_id=?
+        """,
+        [(diff, diff, link_id) for link_id, diff in link_diffs.items()])
+    curs.executemany(
+        "UPDATE top_links SET points = points + ? WHERE link_id = ?",
+        [(diff, link_id) for link_id, diff in link_diffs.items()])
+    curs.executemany(
+        """
+        UPDATE comments SET points = points + ?
+        WHERE comment_id=?
+        """,
+        [(diff, comment_id) for comment_id, diff in comment_diffs.items()])
+
+    karma = Counter()
+    for table, id_column, diffs in [('links', 'link_id', link_diffs),
+                                    ('comments', 'comment_id', comment_diffs)]:
+        ids = list(diffs)
+        # stay well under sqlite's limit on the number of bound parameters
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start+500]
+            rows = curs.execute(
+                "SELECT {id}, author_id FROM {table} WHERE {id} IN ({params})"
+                .format(id=id_column, table=table,
+                        params=', '.join('?' * len(chunk))),
+                chunk)
+            for item_id, author_id in rows:
+                karma[author_id] += diffs[item_id]
+
+    curs.executemany("UPDATE authors SET karma = karma + ? WHERE author_id=?",
+                     [(diff, author_id)
+                      for author_id, diff in karma.items()
+                      if diff])
+
+
 def _increment_karma(curs, author_id, diff):
     # we should always be appearing in someone else's transaction
     assert isinstance(curs, sqlite3.Cursor)
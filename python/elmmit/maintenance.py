@@ -0,0 +1,252 @@
+from threading import Event
+from threading import Thread
+import logging
+import os.path
+import time
+
+from . import db
+from . import utils
+
+
+log = logging.getLogger(__name__)
+
+# sqlite doesn't tidy up after itself in the ways we've configured it. with
+# auto_vacuum=INCREMENTAL, deleted pages stay in the file until something runs
+# incremental_vacuum. the WAL is only checkpointed automatically when a
+# commit happens to notice that it's big, and never shrinks. and the query
+# planner only knows how our data is distributed once ANALYZE has looked. all
+# of these can be done a little at a time while the server is running
+
+# how many pages each incremental_vacuum frees. each is its own short write
+# transaction, so the writer never waits long for one
+VACUUM_STEP = 100
+
+# checkpoint once the WAL is bigger than this many bytes
+WAL_THRESHOLD = 64 * 1024 * 1024
+
+# re-analyze a table once it has this many times more or fewer rows than when
+# it was last analyzed
+ANALYZE_DRIFT = 2.0
+
+# how many rows of each index ANALYZE looks at. its statistics are rougher for
+# it, but it only holds the write lock for a moment however big the table is,
+# so the writer's transactions don't time out waiting for it. (sqlite before
+# 3.32 has no analysis_limit and reads everything)
+ANALYSIS_LIMIT = 400
+
+# PASSIVE never waits for anyone, while TRUNCATE waits for readers and writers
+# to finish so that it can empty the WAL file completely
+CHECKPOINT_MODES = ('passive', 'full', 'restart', 'truncate')
+
+
+def wal_bytes(conn):
+    "How big `conn`'s database's WAL file is"
+    fname = conn.execute("PRAGMA database_list").fetchone()[2]
+    if not fname:
+        # an in-memory database
+        return 0
+    try:
+        return os.path.getsize(fname + '-wal')
+    except OSError:
+        return 0
+
+
+def free_pages(conn):
+    return conn.execute("PRAGMA freelist_count").fetchone()[0]
+
+
+def analyzed_rows(conn):
+    "How many rows each table had when it was last analyzed"
+    if not conn.execute("SELECT 1 FROM sqlite_master"
+                        " WHERE name = 'sqlite_stat1'").fetchone():
+        return {}
+    rows = {}
+    for table, stat in conn.execute("SELECT tbl, stat FROM sqlite_stat1"):
+        # every index on a table has its number of rows first
+        rows[table] = max(rows.get(table, 0), int(stat.split()[0]))
+    return rows
+
+
+def drifted_tables(conn, drift=ANALYZE_DRIFT):
+    """
+    The tables whose numbers of rows have changed by more than a factor of
+    `drift` since they were last analyzed, counting ones that never have been
+    as having had none
+    """
+    # sqlite's own PRAGMA optimize does something like this, but only for the
+    # tables that its connection has queried (before 3.46), which ours haven't
+    analyzed = analyzed_rows(conn)
+    drifted = []
+    for table, in conn.execute("""
+            SELECT name FROM sqlite_master
+            WHERE type = 'table' AND name NOT LIKE 'sqlite_%'
+            AND sql NOT LIKE 'CREATE VIRTUAL TABLE%'
+            ORDER BY name
+            """).fetchall():
+        then = max(analyzed.get(table, 0), 1)
+        now = max(conn.execute("SELECT count(*) FROM %s"
+                               % (table,)).fetchone()[0], 1)
+        if max(now, then) >= drift * min(now, then):
+            drifted.append(table)
+    return drifted
+
+
+def analyze_tables(conn, tables=None, limit=ANALYSIS_LIMIT):
+    """
+    ANALYZE `tables`, or the whole database if None, looking at no more than
+    about `limit` rows of each index. 0 for no limit
+    """
+    conn.execute("PRAGMA analysis_limit=%d" % (limit,)).fetchall()
+    if tables is None:
+        conn.execute("ANALYZE")
+    else:
+        for table in tables:
+            conn.execute("ANALYZE %s" % (table,))
+
+
+def incremental_vacuum(conn, seconds=1.0, step=VACUUM_STEP):
+    """
+    Give free pages back to the filesystem `step` at a time, until there are
+    none left or `seconds` have passed. Returns how many were freed
+    """
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        # the database was made before we set auto_vacuum=INCREMENTAL, and
+        # only a full VACUUM can change that
+        return 0
+
+    deadline = time.time() + seconds
+    freed = 0
+    free = free_pages(conn)
+    while free and time.time() < deadline:
+        # it only frees as many pages as rows are read out of it
+        conn.execute("PRAGMA incremental_vacuum(%d)" % (step,)).fetchall()
+        now_free = free_pages(conn)
+        freed += free - now_free
+        free = now_free
+    return freed
+
+
+def checkpoint(conn, mode='passive'):
+    """
+    Copy the WAL back into the database. Returns (busy, frames in the WAL,
+    frames checkpointed) as sqlite reports them
+    """
+    if mode not in CHECKPOINT_MODES:
+        raise ValueError("unknown checkpoint mode %r" % (mode,))
+    return tuple(conn.execute("PRAGMA wal_checkpoint(%s)"
+                              % (mode.upper(),)).fetchone())
+
+
+def maintain(conn, vacuum_seconds=1.0, vacuum_step=VACUUM_STEP,
+             wal_threshold=WAL_THRESHOLD, checkpoint_mode='passive',
+             analyze='optimize', analysis_limit=ANALYSIS_LIMIT,
+             progress=None):
+    """
+    Run one round of everything, and return a dict of what it did
+
+    Vacuuming stops after `vacuum_seconds`, and the next round carries on
+    where it left off. `analyze` is 'optimize' to only ANALYZE the tables that
+    have grown or shrunk a lot since they last were, 'full' to ANALYZE
+    everything or None to skip it, with `analysis_limit` as for
+    analyze_tables. Then the WAL is checkpointed if it's over `wal_threshold`
+    bytes. If given, a summary is written to `progress`
+    """
+    start = time.time()
+    report = {'wal_bytes_before': wal_bytes(conn),
+              'free_pages_before': free_pages(conn)}
+
+    report['vacuumed_pages'] = incremental_vacuum(conn, vacuum_seconds,
+                                                  vacuum_step)
+
+    # which tables were analyzed, or None for the whole database
+    report['analyzed'] = []
+    if analyze == 'optimize':
+        report['analyzed'] = drifted_tables(conn)
+        if report['analyzed']:
+            analyze_tables(conn, report['analyzed'], analysis_limit)
+    elif analyze == 'full':
+        report['analyzed'] = None
+        analyze_tables(conn, None, analysis_limit)
+    elif analyze is not None:
+        raise ValueError("unknown analyze %r" % (analyze,))
+
+    # last, since the vacuum and ANALYZE both write to the WAL too
+    report['checkpoint'] = None
+    if wal_bytes(conn) >= wal_threshold:
+        report['checkpoint'] = checkpoint(conn, checkpoint_mode)
+
+    report['wal_bytes'] = wal_bytes(conn)
+    report['free_pages'] = free_pages(conn)
+    report['seconds'] = time.time() - start
+
+    if progress is not None:
+        _report(progress, report)
+    return report
+
+
+def _report(progress, report):
+    mb = 1024.0 * 1024
+    progress.write("wal: %.1fMB -> %.1fMB" % (report['wal_bytes_before'] / mb,
+                                              report['wal_bytes'] / mb))
+    if report['checkpoint'] is not None:
+        busy, frames, checkpointed = report['checkpoint']
+        progress.write(" (checkpointed %d/%d frames%s)"
+                       % (checkpointed, frames, ', busy' if busy else ''))
+    progress.write("\nfree pages: %d -> %d (vacuumed %d)\n"
+                   % (report['free_pages_before'], report['free_pages'],
+                      report['vacuumed_pages']))
+    if report['analyzed'] is None:
+        progress.write("analyzed: everything\n")
+    else:
+        progress.write("analyzed: %s\n"
+                       % (', '.join(report['analyzed']) or 'nothing',))
+    progress.write("took %.2fs\n" % (report['seconds'],))
+
+
+class Maintainer(object):
+    """
+    Runs `maintain` every `interval` seconds on a background thread, with
+    `options` for its arguments. Each round opens its own connection. `stats`
+    has the latest report and the totals so far
+    """
+
+    def __init__(self, fname, interval=300.0, **options):
+        self.fname = fname
+        self.interval = interval
+        self.options = options
+        self.totals = utils.LockBox({'runs': 0, 'seconds': 0.0,
+                                     'last': None})
+
+        self.stopping = Event()
+        self.thread = Thread(target=self._run, name='maintainer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        conn = db.connect_db(self.fname, init_schema=False)
+        try:
+            report = maintain(conn, **self.options)
+        finally:
+            conn.close()
+
+        with self.totals as totals:
+            totals['runs'] += 1
+            totals['seconds'] += report['seconds']
+            totals['last'] = report
+        return report
+
+    def stats(self):
+        with self.totals as totals:
+            return dict(totals)
+
+    def close(self):
+        self.stopping.set()
+        self.thread.join()
+
+    def _run(self):
+        while not self.stopping.wait(self.interval):
+            try:
+                self.run()
+            except Exception:
+                log.exception("Failed to maintain the database")
+
@@ -0,0 +1,263 @@
+from collections import defaultdict
+from itertools import chain
+import sqlite3
+import threading
+import time
+
+from . import utils
+
+
+# upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class Histogram(object):
+    "Counts of observations falling into fixed buckets, like Prometheus's"
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        # the last count is for everything bigger than the last bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                break
+        else:
+            index = len(self.buckets)
+        self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """
+        Estimate the `q` quantile by interpolating within the bucket it falls
+        in. Anything beyond the last bucket is reported as the last bound
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        lower = 0.0
+        for bound, count in zip(self.buckets, self.counts):
+            if count and seen + count >= rank:
+                return lower + (bound - lower) * (rank - seen) / count
+            seen += count
+            lower = bound
+        return self.buckets[-1]
+
+
+class Registry(object):
+    """
+    Everything that we measure about the server
+
+    Requests record into it once they're done, so the only cost while they
+    run is counting their SQL statements into `request_stats`
+    """
+
+    def __init__(self):
+        self.state = utils.LockBox(self._empty())
+
+    @staticmethod
+    def _empty():
+        return {'requests': defaultdict(int),
+                'latency': defaultdict(Histogram),
+                'sql_statements': defaultdict(int),
+                'sql_seconds': defaultdict(float),
+                'serialise_seconds': defaultdict(float),
+                'response_bytes': defaultdict(int),
+                'sqlite_busy': 0}
+
+    def reset(self):
+        with self.state as state:
+            state.clear()
+            state.update(self._empty())
+
+    def record_request(self, route, status, seconds, sql_statements,
+                       sql_seconds):
+        with self.state as state:
+            state['requests'][(route, status)] += 1
+            state['latency'][route].observe(seconds)
+            state['sql_statements'][route] += sql_statements
+            state['sql_seconds'][route] += sql_seconds
+
+    def record_response(self, route, nbytes, serialise_seconds):
+        with self.state as state:
+            state['response_bytes'][route] += nbytes
+            state['serialise_seconds'][route] += serialise_seconds
+
+    def record_busy(self):
+        with self.state as state:
+            state['sqlite_busy'] += 1
+
+    def exposition(self, extra=()):
+        """
+        Render everything in the Prometheus text exposition format. `extra` is
+        a list of `(name, type, help, [(labels, value)])` to include as well
+        """
+        families = []
+        with self.state as state:
+            families.append((
+                'elmmit_requests_total', 'counter',
+                'Requests handled, by route and HTTP status',
+                [({'route': route, 'status': status}, count)
+                 for (route, status), count
+                 in sorted(state['requests'].items())]))
+
+            latency = []
+            quantiles = []
+            for route, histogram in sorted(state['latency'].items()):
+                latency.extend(histogram_samples(histogram, {'route': route}))
+                for q in QUANTILES:
+                    quantiles.append(({'route': route, 'quantile': q},
+                                      histogram.quantile(q)))
+            families.append((
+                'elmmit_request_duration_seconds', 'histogram',
+                'Time from receiving a request to starting the response',
+                latency))
+            families.append((
+                'elmmit_request_duration_quantile_seconds', 'gauge',
+                'Request latency quantiles estimated from the histogram',
+                quantiles))
+
+            for key, name, help in [
+                    ('sql_statements', 'elmmit_sql_statements_total',
+                     'SQL statements executed'),
+                    ('sql_seconds', 'elmmit_sql_seconds_total',
+                     'Time spent executing SQL statements'),
+                    ('serialise_seconds', 'elmmit_serialise_seconds_total',
+                     'Time spent encoding responses as JSON'),
+                    ('response_bytes', 'elmmit_response_bytes_total',
+                     'Bytes of response bodies sent')]:
+                families.append((
+                    name, 'counter', help + ', by route',
+                    [({'route': route}, value)
+                     for route, value in sorted(state[key].items())]))
+
+            families.append((
+                'elmmit_sqlite_busy_total', 'counter',
+                'Statements that gave up waiting for a sqlite lock',
+                [({}, state['sqlite_busy'])]))
+
+        lines = []
+        for name, type_, help, samples in families + list(extra):
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, type_))
+            for sample in samples:
+                labels, value = sample[:2]
+                suffix = sample[2] if len(sample) > 2 else ''
+                lines.append('%s%s%s %s' % (name, suffix,
+                                            _format_labels(labels),
+                                            _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+def histogram_samples(histogram, labels):
+    "The samples of a Histogram, for an exposition"
+    samples = []
+    cumulative = 0
+    for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+        cumulative += count
+        samples.append((dict(labels, le=bound), cumulative, '_bucket'))
+    samples.append((labels, histogram.sum, '_sum'))
+    samples.append((labels, histogram.count, '_count'))
+    return samples
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', r'\\')
+                                     .replace('"', r'\"')
+                                     .replace('\n', r'\n'))
+        for name, value in sorted(labels.items()))
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+registry = Registry()
+
+
+class RequestStats(threading.local):
+    "The work done so far by the current thread's request"
+    statements = 0
+    sql_seconds = 0.0
+    serialise_seconds = 0.0
+
+    def reset(self):
+        self.statements = 0
+        self.sql_seconds = 0.0
+        self.serialise_seconds = 0.0
+
+
+request_stats = RequestStats()
+
+
+def _is_busy(ex):
+    message = str(ex)
+    return 'locked' in message or 'busy' in message
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """
+    A cursor that counts and times its statements into `request_stats`, and
+    hands them to its connection's tracer if it has one
+    """
+
+    def execute(self, sql, params=()):
+        return self._timed(sqlite3.Cursor.execute, sql, params, params)
+
+    def executemany(self, sql, seq_of_params):
+        example_params = ()
+        if self.connection.tracer is not None:
+            # take a look at the first ones so that the tracer can EXPLAIN with
+            # them, without copying what may be a whole bulk import batch
+            seq_of_params = iter(seq_of_params)
+            first = next(seq_of_params, None)
+            if first is not None:
+                example_params = first
+                seq_of_params = chain([first], seq_of_params)
+        return self._timed(sqlite3.Cursor.executemany, sql, seq_of_params,
+                           example_params)
+
+    def _timed(self, method, sql, params, example_params):
+        start = time.time()
+        try:
+            return method(self, sql, params)
+        except sqlite3.OperationalError as ex:
+            if _is_busy(ex):
+                registry.record_busy()
+            raise
+        finally:
+            seconds = time.time() - start
+            request_stats.statements += 1
+            request_stats.sql_seconds += seconds
+            tracer = self.connection.tracer
+            if tracer is not None:
+                tracer.record(self.connection, sql, example_params, seconds)
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    "A connection whose statements all go through an InstrumentedCursor"
+
+    # a tracing.QueryTracer, if this connection's statements are being traced
+    tracer = None
+
+    def cursor(self, factory=InstrumentedCursor):
+        return sqlite3.Connection.cursor(self, factory)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self.cursor().executemany(sql, seq_of_params)
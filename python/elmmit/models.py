@@ -1,32 +1,78 @@
 from collections import namedtuple
-
-class Model(object):
-    def __init__(self, **kw):
-        assert all(k in self.fields for k in kw)
-        self.data = kw
-
-    def __getattr__(self, name):
-        return self.data[name]
+from operator import itemgetter
+import json
+
+
+class ModelMeta(type):
+    # gives every model a read-only property per field and no per-instance
+    # __dict__, the same way namedtuple does
+    def __new__(mcs, name, bases, attrs):
+        attrs.setdefault('__slots__', ())
+        for index, field in enumerate(attrs.get('fields', ())):
+            attrs[field] = property(itemgetter(index))
+        return type.__new__(mcs, name, bases, attrs)
+
+
+class Model(tuple):
+    __metaclass__ = ModelMeta
+    fields = ()
+
+    def __new__(cls, **kw):
+        self = tuple.__new__(cls, [kw.pop(field, None) for field in cls.fields])
+        if kw:
+            raise TypeError("%s has no fields %s"
+                            % (cls.__name__, ', '.join(kw)))
+        return self
+
+    @classmethod
+    def from_row(cls, row):
+        """
+        Build a model from a database row whose columns are in the same order
+        as `fields`, without going through keyword arguments
+        """
+        return tuple.__new__(cls, row)
 
     def to_json(self):
-        return self.data
+        return dict(zip(self.fields, self))
+
+    def iter_json(self):
+        """
+        Yield this model's JSON encoding in pieces, so that big listings can be
+        sent without building the whole thing in memory first
+        """
+        yield json.dumps(self.to_json())
 
     def __repr__(self):
         return "%s(%s)" % (self.__class__.__name__,
-                           ', '.join(["%s=%r" % (field, self.data[field])
-                                     for field in self.fields]))
+                           ', '.join(["%s=%r" % (field, value)
+                                     for field, value in zip(self.fields,
+                                                             self)]))
 
 
 class Author(Model):
     fields = 'author_id created karma'.split()
+    columns = ', '.join(fields)
 
 
 class Link(Model):
-    fields = 'link_id author_id created title url body points'.split()
+    fields = ('link_id author_id created title url body points hot '
+              'num_comments last_comment_at').split()
+    columns = ', '.join(fields)
 
 
 class Comment(Model):
     fields = 'comment_id link_id author_id created parent_id body points'.split()
+    columns = ', '.join(fields)
+
+
+def _iter_json_list(models):
+    yield '['
+    for index, model in enumerate(models):
+        if index:
+            yield ', '
+        for fragment in model.iter_json():
+            yield fragment
+    yield ']'
 
 
 class LinkListing(Model):
@@ -36,10 +82,63 @@ class LinkListing(Model):
         return {'links': map(Link.to_json, self.links),
                 'pager': self.pager}
 
+    def iter_json(self):
+        yield '{"links": '
+        for fragment in _iter_json_list(self.links):
+            yield fragment
+        yield ', "pager": %s}' % (json.dumps(self.pager),)
+
+
+class CommentPage(Model):
+    "A flat page of comments, like LinkListing"
+    fields = 'comments pager'.split()
+
+    def to_json(self):
+        return {'comments': map(Comment.to_json, self.comments),
+                'pager': self.pager}
+
+    def iter_json(self):
+        yield '{"comments": '
+        for fragment in _iter_json_list(self.comments):
+            yield fragment
+        yield ', "pager": %s}' % (json.dumps(self.pager),)
+
+
+class MoreComments(Model):
+    fields = 'link_id parent_id pager'.split()
+
+
+class CommentTree(Model):
+    fields = 'comment replies more'.split()
+
+    def to_json(self):
+        ret = self.comment.to_json()
+        ret['replies'] = map(CommentTree.to_json, self.replies)
+        ret['more'] = self.more and self.more.to_json()
+        return ret
+
+    def iter_json(self):
+        ret = self.comment.to_json()
+        ret['more'] = self.more and self.more.to_json()
+        # leave the object open so that the replies can be streamed into it
+        yield json.dumps(ret)[:-1] + ', "replies": '
+        for fragment in _iter_json_list(self.replies):
+            yield fragment
+        yield '}'
+
 
 class CommentListing(Model):
-    fields = ['comments']
+    fields = 'comments more'.split()
 
     def to_json(self):
-        return {'comments': map(Comment.to_json, self.comments)}
+        return {'comments': map(CommentTree.to_json, self.comments),
+                'more': self.more and self.more.to_json()}
+
+    def iter_json(self):
+        more = self.more and self.more.to_json()
+        yield '{"more": %s, "comments": ' % (json.dumps(more),)
+        for fragment in _iter_json_list(self.comments):
+            yield fragment
+        yield '}'
+
 
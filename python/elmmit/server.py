@@ -1,5 +1,9 @@
 from functools import partial
 import argparse
+import calendar
+import hashlib
+import sqlite3
+import time
 
 from flask import Flask
 from flask import Response
@@ -7,16 +11,27 @@ from flask import current_app
 from flask import g
 from flask import json
 from flask import request
+from flask import stream_with_context
 
 from . import api
 from . import api_docs
+from . import cache
 from . import db
+from . import maintenance
+from . import metrics
 from . import models
+from . import tracing
 from . import utils
+from . import votes
+from . import workers
 
 
 app = Flask(__name__)
 
+# part of every ETag, so that a restarted server (which may render responses
+# differently) never matches the ETags of an earlier one
+BOOT_ID = utils.uuid4_36()
+
 
 @app.route('/docs')
 def docs():
@@ -24,28 +39,93 @@ def docs():
                     mimetype='text/plain')
 
 
+def get_conn():
+    "Check out a pooled connection for the lifetime of the current request"
+    if 'conn' not in g:
+        g.conn = current_app.config['db_pool'].checkout()
+    return g.conn
+
+
+@app.teardown_request
+def return_conn(exc):
+    conn = g.pop('conn', None)
+    if conn is not None:
+        current_app.config['db_pool'].checkin(conn)
+
+
 def routed_fn(route):
-    conn = db.connect_db(current_app.config['db_path'])
+    start = time.time()
+    stats = metrics.request_stats
+    stats.reset()
+
+    try:
+        response = _routed_fn(route)
+    except (workers.Unavailable, db.OverBudget) as ex:
+        response = _unavailable(ex)
+
+    metrics.registry.record_request(route.path,
+                                    response.status_code,
+                                    time.time() - start,
+                                    stats.statements,
+                                    stats.sql_seconds)
+    if not response.is_streamed:
+        # streamed responses record this themselves once they're sent
+        metrics.registry.record_response(route.path,
+                                         response.content_length or 0,
+                                         stats.serialise_seconds)
+    return response
+
 
-    params = {}
-    errors = []
+def _unavailable(ex):
+    return Response(json.dumps({'errors': [str(ex)]}),
+                    mimetype='application/json',
+                    status=503,
+                    headers={'Retry-After': '1'})
+
+
+def _routed_fn(route):
     param_source = request.form if request.method == 'POST' else request.args
-    for field_name, field_desc in route.fields.items():
-        if field_name not in param_source and field_desc.required:
-            errors.append("missing %s" % (field_name,))
-        elif field_name not in param_source:
-            params[field_name] = field_desc.default
-        else:
-            params[field_name] = field_desc.type(param_source[field_name])
+    params, errors = route.parse_params(param_source,
+                                        current_app.config['limits'])
 
     if errors:
         return Response(json.dumps({'errors': errors}),
                         mimetype='application/json',
                         status=400)
 
+    etag = last_modified = None
+    if route.versioned_by is not None:
+        # the version tells us whether the client's copy is still good before
+        # we've done any of the real work
+        version, modified = run_db(False, db.get_version,
+                                   route.versioned_by(params))
+        etag = _etag(route.path, params, version)
+        # more could still change within the current second, so it can't be
+        # a Last-Modified yet
+        if modified < int(time.time()):
+            last_modified = modified
+        if _not_modified(etag, last_modified):
+            return _validated(Response(status=304), etag, last_modified)
+
+    listing_cache = current_app.config['listing_cache']
+    if route.cached and listing_cache is not None:
+        # with the version in the key we'll never serve anything stale
+        cache_key = (route.path, tuple(sorted(params.items())), etag)
+        body = listing_cache.get(cache_key)
+        if body is not None:
+            return _validated(Response(body, mimetype='application/json'),
+                              etag, last_modified)
+        generation = listing_cache.generation
+
     try:
-        ret = route.db_call(conn, **params)
-        ret_json = ret.to_json()
+        ret = call_route(route, params)
+    except (workers.Unavailable, db.OverBudget):
+        raise
+    except ValueError as ex:
+        # the db layer's way of saying that the arguments make no sense
+        return Response(json.dumps({'errors': [str(ex)]}),
+                        mimetype='application/json',
+                        status=400)
     except Exception as ex:
         errors.append(repr(ex))
 
@@ -54,7 +134,256 @@ def routed_fn(route):
                         mimetype='application/json',
                         status=500)
 
-    return Response(json.dumps(ret_json),
+    if listing_cache is not None:
+        if route.cached:
+            body = _serialise(ret)
+            listing_cache.put(cache_key, body, generation)
+            return _validated(Response(body, mimetype='application/json'),
+                              etag, last_modified)
+        elif (route.invalidates_cache
+              and route.db_call not in current_app.config['db_overrides']):
+            # a VoteBuffer's upvotes only change the listings when it flushes
+            # them, so it invalidates from there instead
+            listing_cache.invalidate()
+
+    if isinstance(ret, (models.LinkListing, models.CommentListing,
+                        models.CommentPage)):
+        # listings can be big, so send them as they're serialised rather than
+        # building the whole response first
+        chunks = _metered(route.path, _chunked(ret.iter_json()))
+        return _validated(Response(stream_with_context(chunks),
+                                   mimetype='application/json'),
+                          etag, last_modified)
+
+    body = _serialise(ret)
+    if etag is None and route.method == 'GET':
+        # without a version we have to look at the response itself, which
+        # still saves sending it
+        etag = hashlib.md5(body).hexdigest()
+        if _not_modified(etag, None):
+            return _validated(Response(status=304), etag, None)
+
+    return _validated(Response(body, mimetype='application/json'),
+                      etag, last_modified)
+
+
+def _etag(path, params, version):
+    key = json.dumps([BOOT_ID, path, sorted(params.items()), version])
+    return hashlib.md5(key).hexdigest()
+
+
+def _not_modified(etag, last_modified):
+    "Whether the request's validators say that it already has this response"
+    if request.if_none_match:
+        # If-Modified-Since is ignored when there's an If-None-Match
+        return request.if_none_match.contains_weak(etag)
+    since = request.if_modified_since
+    return (last_modified is not None and since is not None
+            and last_modified <= calendar.timegm(since.utctimetuple()))
+
+
+def _validated(response, etag, last_modified):
+    if etag is not None:
+        response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    return response
+
+
+def _serialise(ret):
+    start = time.time()
+    body = ''.join(ret.iter_json())
+    metrics.request_stats.serialise_seconds += time.time() - start
+    return body
+
+
+def _metered(path, chunks):
+    # everything spent producing the chunks (as opposed to sending them) is
+    # serialisation time
+    nbytes = 0
+    seconds = 0.0
+    start = time.time()
+    for chunk in chunks:
+        seconds += time.time() - start
+        nbytes += len(chunk)
+        yield chunk
+        start = time.time()
+    seconds += time.time() - start
+    metrics.registry.record_response(path, nbytes, seconds)
+
+
+def _chunked(fragments, size=16*1024):
+    # the fragments can be tiny, so gather them up into reasonably sized writes
+    buf = []
+    length = 0
+    for fragment in fragments:
+        buf.append(fragment)
+        length += len(fragment)
+        if length >= size:
+            yield ''.join(buf)
+            buf = []
+            length = 0
+    if buf:
+        yield ''.join(buf)
+
+
+def run_db(write, fn, *a, **kw):
+    """
+    Call `fn(conn, *a, **kw)` on one of the sqlite worker threads if we have
+    them, or with this request's own connection if not. Reads that take longer
+    than the query budget are stopped with db.OverBudget
+    """
+    budget = current_app.config['query_budget']
+    if budget and not write:
+        fn, a = db.run_with_budget, (budget, fn) + a
+    pool = current_app.config['db_writer' if write else 'db_readers']
+    if pool is None:
+        return fn(get_conn(), *a, **kw)
+    return pool.call(current_app.config['request_timeout'], fn, *a, **kw)
+
+
+def call_route(route, params):
+    return run_db(route.method == 'POST', _db_call(route), **params)
+
+
+def _db_call(route):
+    # some calls may be replaced by e.g. a VoteBuffer
+    return current_app.config['db_overrides'].get(route.db_call,
+                                                  route.db_call)
+
+
+@app.route('/api/batch', methods=['POST'])
+def batch():
+    """
+    Run several GET routes in one request
+
+    Takes a JSON list of `{"path": ..., "params": {...}}` and returns
+    `{"results": [...]}` with one `{"result": ...}` or `{"errors": [...]}` per
+    call, in order. All of the calls see the same snapshot of the database
+    """
+    calls = request.get_json(force=True, silent=True)
+    if not isinstance(calls, list):
+        return Response(json.dumps({'errors': ['expected a list of calls']}),
+                        mimetype='application/json',
+                        status=400)
+
+    max_batch_size = current_app.config['max_batch_size']
+    if len(calls) > max_batch_size:
+        return Response(
+            json.dumps({'errors': ['at most %d calls can be batched'
+                                   % (max_batch_size,)]}),
+            mimetype='application/json',
+            status=400)
+
+    try:
+        results = run_db(False, _run_batch, map(_batch_call, calls))
+    except (workers.Unavailable, db.OverBudget) as ex:
+        return _unavailable(ex)
+
+    return Response(json.dumps({'results': results}),
+                    mimetype='application/json')
+
+
+def _batch_call(call):
+    # returns the (db_call, params) to make, or the errors to return instead
+    if (not isinstance(call, dict)
+            or not isinstance(call.get('params', {}), dict)):
+        return {'errors': ['malformed call %r' % (call,)]}
+
+    route = api.api_routes.get(call.get('path'))
+    if route is None:
+        return {'errors': ['no such route %r' % (call.get('path'),)]}
+    if route.method != 'GET':
+        return {'errors': ['only GET routes can be batched']}
+
+    params, errors = route.parse_params(call.get('params', {}),
+                                        current_app.config['limits'])
+    if errors:
+        return {'errors': errors}
+
+    return _db_call(route), params
+
+
+def _run_batch(conn, calls):
+    # holding a read transaction open across every call is what gives them all
+    # the same snapshot
+    conn.execute("BEGIN")
+    try:
+        return map(partial(_run_batch_call, conn), calls)
+    finally:
+        conn.rollback()
+
+
+def _run_batch_call(conn, call):
+    if isinstance(call, dict):
+        return call
+    db_call, params = call
+    try:
+        return {'result': db_call(conn, **params).to_json()}
+    except sqlite3.OperationalError as ex:
+        if str(ex) == 'interrupted':
+            # the batch has used up its query budget, which fails all of it
+            raise
+        return {'errors': [repr(ex)]}
+    except Exception as ex:
+        return {'errors': [repr(ex)]}
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    extra = []
+    listing_cache = current_app.config['listing_cache']
+    if listing_cache is not None:
+        cache_stats = listing_cache.stats()
+        for key, type_, help in [
+                ('hits', 'counter', 'Listing cache hits'),
+                ('misses', 'counter', 'Listing cache misses'),
+                ('invalidations', 'counter', 'Listing cache invalidations'),
+                ('size', 'gauge', 'Responses in the listing cache')]:
+            name = 'elmmit_listing_cache_%s' % (key,)
+            if type_ == 'counter':
+                name += '_total'
+            extra.append((name, type_, help, [({}, cache_stats[key])]))
+
+    queued = [({'pool': name}, current_app.config[key].queued())
+              for name, key in [('readers', 'db_readers'),
+                                ('writer', 'db_writer')]
+              if current_app.config[key] is not None]
+    extra.append(('elmmit_sqlite_queued_calls', 'gauge',
+                  'Calls waiting for a sqlite worker thread', queued))
+
+    batch_sizes = current_app.config['db_writer'].batch_stats()
+    extra.append(('elmmit_sqlite_commit_size', 'histogram',
+                  'Writes committed together by each commit of the writer',
+                  metrics.histogram_samples(batch_sizes, {})))
+
+    maintainer = current_app.config['maintainer']
+    if maintainer is not None:
+        maintenance_stats = maintainer.stats()
+        extra.append(('elmmit_maintenance_runs_total', 'counter',
+                      'Rounds of database maintenance',
+                      [({}, maintenance_stats['runs'])]))
+        extra.append(('elmmit_maintenance_seconds_total', 'counter',
+                      'Time spent on database maintenance',
+                      [({}, maintenance_stats['seconds'])]))
+        last = maintenance_stats['last']
+        if last is not None:
+            extra.append(('elmmit_sqlite_wal_bytes', 'gauge',
+                          'Size of the WAL after the last maintenance',
+                          [({}, last['wal_bytes'])]))
+            extra.append(('elmmit_sqlite_free_pages', 'gauge',
+                          'Unused pages in the database after the last'
+                          ' maintenance',
+                          [({}, last['free_pages'])]))
+
+    return Response(metrics.registry.exposition(extra),
+                    mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/cache-stats')
+def cache_stats():
+    listing_cache = current_app.config['listing_cache']
+    return Response(json.dumps(listing_cache and listing_cache.stats()),
                     mimetype='application/json')
 
 
@@ -94,14 +423,111 @@ def add_cors(response):
     return response
 
 
-def server(db_path, port, debug=True, host='0.0.0.0'):
-    # make sure we can connect to the DB before we start anything, since every
-    # request will try to connect individually and we'd rather fail before that
+def init_app(db_path, vote_flush_interval=None,
+             listing_cache_ttl=5.0, listing_cache_size=1000,
+             max_batch_size=50, trace_sql=False,
+             sqlite_readers=0, max_queued=100, request_timeout=10.0,
+             max_write_batch=100, id_scheme='random', query_budget=5.0,
+             maintenance_interval=None,
+             max_listing_limit=api.MAX_LISTING_LIMIT,
+             max_comment_limit=api.MAX_COMMENT_LIMIT,
+             max_comment_depth=api.MAX_COMMENT_DEPTH):
+    # create and migrate the schema once up front so that requests only have to
+    # check out an already-configured connection. this also makes sure we can
+    # connect to the DB before we start anything
     conn = db.connect_db(db_path)
     assert list(conn.execute('select 1'))
-    del conn
+    conn.close()
+
+    close_app()
 
-    with app.app_context():
-        app.config['db_path'] = db_path
+    tracer = tracing.QueryTracer() if trace_sql else None
+    pool = db.ConnectionPool(db_path, tracer=tracer, id_scheme=id_scheme)
+    app.config['db_path'] = db_path
+    app.config['db_pool'] = pool
+    app.config['db_overrides'] = {}
+    app.config['max_batch_size'] = max_batch_size
+    # the most that a request can ask for, see api.Limit
+    app.config['limits'] = {'max_listing_limit': max_listing_limit,
+                            'max_comment_limit': max_comment_limit,
+                            'max_comment_depth': max_comment_depth}
 
-    app.run(port=port, debug=debug, host=host)
+    # every write goes through the one writer thread, which commits whatever
+    # has queued up together
+    writer = workers.Writer(db_path,
+                            max_queued=max_queued,
+                            max_batch=max_write_batch,
+                            tracer=tracer,
+                            id_scheme=id_scheme)
+    # with sqlite_readers, requests hand their reads to a few threads with
+    # their own connections too instead of each using one of their own. WAL
+    # lets any number of readers run alongside the writer
+    readers = None
+    if sqlite_readers:
+        readers = workers.Workers(db_path, sqlite_readers,
+                                  max_queued=max_queued,
+                                  name='sqlite-reader',
+                                  tracer=tracer,
+                                  id_scheme=id_scheme)
+    app.config['db_readers'] = readers
+    app.config['db_writer'] = writer
+    app.config['request_timeout'] = request_timeout
+    # how long the reads of one request may spend in sqlite
+    app.config['query_budget'] = query_budget
+
+    listing_cache = None
+    if listing_cache_ttl:
+        listing_cache = cache.ListingCache(max_size=listing_cache_size,
+                                           ttl=listing_cache_ttl)
+    app.config['listing_cache'] = listing_cache
+
+    maintainer = None
+    if maintenance_interval:
+        # vacuum, checkpoint and analyze in the background now and then
+        maintainer = maintenance.Maintainer(db_path,
+                                            interval=maintenance_interval)
+    app.config['maintainer'] = maintainer
+
+    if vote_flush_interval:
+        # coalesce upvotes in memory and write them out in batches
+        vote_buffer = votes.VoteBuffer(
+            pool,
+            interval=vote_flush_interval,
+            on_flush=listing_cache and listing_cache.invalidate,
+            writer=writer,
+            timeout=request_timeout)
+        app.config['vote_buffer'] = vote_buffer
+        app.config['db_overrides'].update({
+            db.upvote_link: vote_buffer.upvote_link,
+            db.upvote_comment: vote_buffer.upvote_comment,
+        })
+
+
+def close_app():
+    # drain anything that's buffered before giving up the connections it
+    # would be written with
+    vote_buffer = app.config.pop('vote_buffer', None)
+    if vote_buffer is not None:
+        vote_buffer.close()
+
+    maintainer = app.config.pop('maintainer', None)
+    if maintainer is not None:
+        maintainer.close()
+
+    for key in ['db_readers', 'db_writer', 'db_pool']:
+        pool = app.config.pop(key, None)
+        if pool is not None:
+            pool.close()
+
+
+def server(db_path, port, debug=True, host='0.0.0.0', **kw):
+    init_app(db_path, **kw)
+    options = {}
+    if kw.get('sqlite_readers'):
+        # the HTTP threads only wait on the sqlite workers, so a slow client
+        # ties up nothing but its own thread
+        options['threaded'] = True
+    try:
+        app.run(port=port, debug=debug, host=host, **options)
+    finally:
+        close_app()
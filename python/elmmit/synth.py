@@ -0,0 +1,189 @@
+import argparse
+import hashlib
+import json
+import random
+import sys
+
+from . import utils
+
+
+# reproducible synthetic data for benchmarking, as rows in the format read by
+# bulk.import_rows. who posts, which links get commented on and which items get
+# voted on are all Zipf-distributed so that a few authors and links are much
+# more popular than the rest, and replies favour recent comments so that
+# threads grow deep. only the comments of the link currently being generated
+# are held in memory, so this can stream out millions of rows
+
+# the defaults for a dataset with `links` links
+AUTHORS_PER_LINK = 0.1
+COMMENTS_PER_LINK = 5
+VOTES_PER_LINK = 20
+
+# links are spread over this many seconds before `end`
+DEFAULT_SPAN = 365*86400
+DEFAULT_END = 1500000000
+
+# used to scatter popularity ranks across link indexes. it's prime, so it's
+# coprime with any smaller number of links
+_SCATTER = 2654435761
+
+
+class Zipf(object):
+    """
+    Draws ranks in [0, n) where rank r is picked with probability proportional
+    to 1/(r+1)**s
+
+    Uses the inverse CDF of the continuous power law rather than a table of
+    weights, so it takes constant memory however big `n` is
+    """
+
+    def __init__(self, rng, n, s=1.1):
+        assert s != 1
+        self.rng = rng
+        self.n = n
+        self.s = s
+        self.top = (n + 1) ** (1 - s) - 1
+
+    def sample(self):
+        u = self.rng.random()
+        rank = int((self.top * u + 1) ** (1 / (1 - self.s))) - 1
+        return min(rank, self.n - 1)
+
+    def weight(self, rank):
+        "The expected share of samples that land on `rank`"
+        s = self.s
+        return ((rank + 2) ** (1 - s) - (rank + 1) ** (1 - s)) / self.top
+
+
+def _item_id(seed, kind, index, sortable_from=None):
+    # random-looking (like uuid4_36) but derivable from the index, so that we
+    # can refer back to a row without remembering it
+    digest = hashlib.md5("%s:%s:%d" % (seed, kind, index)).digest()
+    if sortable_from is None:
+        return utils.to36(int(digest.encode('hex'), 16))
+    # like utils.sortable_id, as though each was made a millisecond after the
+    # last one of its kind, so that they sort in the order they're generated
+    return utils.sortable_id(now=sortable_from + (index + 0.5) / 1000.0,
+                             rand=digest[:utils.SORTABLE_RANDOM_BYTES])
+
+
+def _scatter(index, n):
+    return (index * _SCATTER) % n
+
+
+def _modinv(a, n):
+    t, new_t, r, new_r = 0, 1, n, a
+    while new_r:
+        q = r // new_r
+        t, new_t = new_t, t - q*new_t
+        r, new_r = new_r, r - q*new_r
+    return t % n
+
+
+def generate(links, authors=None, comments=None, votes=None, seed=0,
+             end=DEFAULT_END, span=DEFAULT_SPAN, ids='random'):
+    """
+    Yield author, link, comment and then vote rows
+
+    Everything but `links` defaults to a multiple of it. `ids` is 'random' or
+    'sortable', like db.ID_SCHEMES. The same arguments always produce the same
+    rows
+    """
+    if authors is None:
+        authors = max(int(links * AUTHORS_PER_LINK), 1)
+    if comments is None:
+        comments = links * COMMENTS_PER_LINK
+    if votes is None:
+        votes = links * VOTES_PER_LINK
+
+    rng = random.Random(seed)
+    posters = Zipf(rng, authors)
+    popularity = Zipf(rng, links)
+    start = end - span
+
+    def author_id(index):
+        return 'user%d' % (index,)
+
+    sortable_from = start if ids == 'sortable' else None
+    def item_id(kind, index):
+        return _item_id(seed, kind, index, sortable_from)
+
+    for i in range(authors):
+        yield {'type': 'author', 'author_id': author_id(i), 'created': start}
+
+    for i in range(links):
+        yield {'type': 'link',
+               'link_id': item_id('link', i),
+               'author_id': author_id(posters.sample()),
+               'created': start + span * i // links,
+               'title': 'link #%d' % (i,),
+               'url': 'http://example.com/%d' % (i,),
+               'body': None}
+
+    # popular links get proportionally more of the comments. each link's
+    # popularity rank is scattered so the popular ones aren't all the oldest
+    unscatter = _modinv(_SCATTER % links, links) if links > 1 else 0
+    comment_count = 0
+    for i in range(links):
+        expected = comments * popularity.weight(i * unscatter % links)
+        count = int(expected) + (rng.random() < expected % 1)
+        created = start + span * i // links
+        ids = []
+        for _ in range(count):
+            comment_id = item_id('comment', comment_count)
+            if ids and rng.random() > 0.3:
+                # mostly reply to something recent, which makes long chains
+                back = min(int(rng.expovariate(0.5)), len(ids) - 1)
+                parent_id = ids[-1 - back]
+            else:
+                parent_id = None
+            created += rng.randint(1, 600)
+            yield {'type': 'comment',
+                   'comment_id': comment_id,
+                   'link_id': item_id('link', i),
+                   'author_id': author_id(posters.sample()),
+                   'parent_id': parent_id,
+                   'created': created,
+                   'body': 'comment #%d' % (comment_count,)}
+            ids.append(comment_id)
+            comment_count += 1
+
+    comment_popularity = Zipf(rng, max(comment_count, 1))
+    for _ in range(votes):
+        diff = -1 if rng.random() < 0.1 else 1
+        if comment_count and rng.random() < 0.2:
+            index = _scatter(comment_popularity.sample(), comment_count)
+            yield {'type': 'vote',
+                   'comment_id': item_id('comment', index),
+                   'diff': diff}
+        else:
+            index = _scatter(popularity.sample(), links)
+            yield {'type': 'vote',
+                   'link_id': item_id('link', index),
+                   'diff': diff}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        'elmmit.synth',
+        description='write a synthetic dataset as NDJSON for bulk-import')
+    parser.add_argument('--links', type=int, default=10000)
+    parser.add_argument('--authors', type=int, default=None)
+    parser.add_argument('--comments', type=int, default=None)
+    parser.add_argument('--votes', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--ids', choices=['random', 'sortable'],
+                        default='random')
+    arguments = parser.parse_args()
+
+    for row in generate(arguments.links,
+                        authors=arguments.authors,
+                        comments=arguments.comments,
+                        votes=arguments.votes,
+                        seed=arguments.seed,
+                        ids=arguments.ids):
+        sys.stdout.write(json.dumps(row) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+from collections import deque
+from collections import namedtuple
+import logging
+import re
+import sqlite3
+
+
+log = logging.getLogger(__name__)
+
+
+TracedQuery = namedtuple('TracedQuery', 'sql params seconds plan')
+
+
+def full_scans(plan):
+    """
+    The steps of an EXPLAIN QUERY PLAN that read a whole table rather than
+    searching or walking an index
+    """
+    return [detail for detail in plan
+            if detail.startswith('SCAN')
+            and 'USING' not in detail
+            and 'CONSTANT ROW' not in detail
+            # a virtual table that was handed constraints to look up, like
+            # an FTS5 MATCH, rather than asked for everything
+            and not re.search(r'VIRTUAL TABLE INDEX \d+:\S', detail)]
+
+
+def temp_sorts(plan):
+    "The steps of an EXPLAIN QUERY PLAN that have to sort rows themselves"
+    return [detail for detail in plan if 'TEMP B-TREE' in detail]
+
+
+class QueryTracer(object):
+    """
+    Records every statement run on the connections it's attached to (see
+    `db.connect_db`), how long it took, and its query plan
+
+    Statements slower than `slow` seconds and statements that scan a whole
+    table are logged as warnings. Only the most recent `keep` statements are
+    remembered
+    """
+
+    def __init__(self, slow=0.1, keep=10000):
+        self.slow = slow
+        self.queries = deque(maxlen=keep)
+        # plans only depend on the SQL, so we only EXPLAIN each one once
+        self.plans = {}
+
+    def record(self, conn, sql, params, seconds):
+        plan = self.plans.get(sql)
+        if plan is None:
+            plan = self.plans[sql] = self._explain(conn, sql, params)
+
+        self.queries.append(TracedQuery(sql, params, seconds, plan))
+
+        if seconds >= self.slow:
+            log.warning("slow query (%.3fs): %s\n%s",
+                        seconds, _oneline(sql), '\n'.join(plan))
+        scans = full_scans(plan)
+        if scans:
+            log.warning("full table scan (%s): %s",
+                        ', '.join(scans), _oneline(sql))
+
+    def _explain(self, conn, sql, params):
+        # go around the instrumented cursor so that we don't trace ourselves
+        curs = sqlite3.Connection.cursor(conn)
+        try:
+            rows = sqlite3.Cursor.execute(curs, "EXPLAIN QUERY PLAN " + sql,
+                                          params)
+            return tuple(row[-1] for row in rows)
+        except sqlite3.Error:
+            # not everything can be explained, e.g. BEGIN
+            return ()
+        finally:
+            curs.close()
+
+    def clear(self):
+        self.queries.clear()
+
+
+def _oneline(sql):
+    return ' '.join(sql.split())
@@ -0,0 +1,153 @@
+from collections import Counter
+from contextlib import contextmanager
+from threading import Event
+from threading import Lock
+from threading import Thread
+import logging
+
+from . import db
+from . import utils
+from . import workers
+from . models import Comment, Link
+
+
+log = logging.getLogger(__name__)
+
+
+class VoteBuffer(object):
+    """
+    Write-behind buffer for upvotes
+
+    Every upvote of a popular item would otherwise be its own write
+    transaction against the same row. Instead we sum up the `diff`s per item
+    here and apply them all in one transaction every `interval` seconds, or as
+    soon as `max_pending` different items are waiting. The results of
+    `upvote_link` and `upvote_comment` include the votes that are still
+    buffered, and everything in the buffer is written out by `close`. If given,
+    `on_flush` is called after each batch of votes is written. The votes are
+    written with a connection from `pool`, or by `writer` (a workers.Writer) if
+    there is one, waiting at most `timeout` seconds for it. With a writer the
+    upvotes must be made on its thread too, as the server does
+    """
+
+    def __init__(self, pool, interval=1.0, max_pending=1000, on_flush=None,
+                 writer=None, timeout=10.0):
+        self.pool = pool
+        self.writer = writer
+        self.timeout = timeout
+        self.on_flush = on_flush
+        self.interval = interval
+        self.max_pending = max_pending
+
+        self.pending = utils.LockBox({'links': Counter(),
+                                      'comments': Counter()})
+        # only one flush writes at a time, so they're applied in order
+        self.flush_lock = Lock()
+
+        self.stopping = Event()
+        # set to have the background thread flush now rather than later
+        self.wake = Event()
+        self.thread = Thread(target=self._run, name='vote-buffer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def upvote_link(self, conn, link_id, diff=1):
+        "Buffered version of db.upvote_link"
+        with self._unflushed():
+            link = db.get_link(conn, link_id)
+            pending = self._add('links', link_id, diff)
+        points = link.points + pending
+        return Link(**dict(link.to_json(),
+                           points=points,
+                           hot=db.hot_score(points, link.created)))
+
+    def upvote_comment(self, conn, comment_id, diff=1):
+        "Buffered version of db.upvote_comment"
+        with self._unflushed():
+            comment = db.get_comment(conn, comment_id)
+            pending = self._add('comments', comment_id, diff)
+        return Comment(**dict(comment.to_json(),
+                              points=comment.points + pending))
+
+    @contextmanager
+    def _unflushed(self):
+        # a flush landing between reading an item and adding to its pending
+        # votes would have them counted twice, or not at all. with a writer,
+        # upvotes and flushes all run on its one thread so they can't. without
+        # one, the flush lock keeps them apart (with one it could deadlock, as
+        # a flush holds it while waiting for the writer's thread)
+        if self.writer is not None:
+            yield
+        else:
+            with self.flush_lock:
+                yield
+
+    def _add(self, kind, item_id, diff):
+        with self.pending as pending:
+            pending[kind][item_id] += diff
+            total = pending[kind][item_id]
+            full = (len(pending['links']) + len(pending['comments'])
+                    >= self.max_pending)
+        if full:
+            # not here, since with a writer we're running on its thread and
+            # couldn't wait for it to do the flush
+            self.wake.set()
+        return total
+
+    def flush(self):
+        "Write out everything that's been buffered so far"
+        with self.flush_lock:
+            taken = {}
+            try:
+                if self.writer is not None:
+                    # taking the votes on the writer's thread means that no
+                    # buffered upvote can run between that and writing them
+                    applied = self.writer.call(self.timeout,
+                                               self._apply_pending, taken)
+                else:
+                    with self.pool.connection() as conn:
+                        applied = self._apply_pending(conn, taken)
+            except workers.TimedOut:
+                # the votes are either still pending, if the writer never got
+                # to the call, or it took them and will write them itself
+                raise
+            except Exception:
+                # put them back so that the next flush can try again
+                with self.pending as pending:
+                    pending['links'].update(taken.get('links', ()))
+                    pending['comments'].update(taken.get('comments', ()))
+                raise
+
+            if applied and self.on_flush is not None:
+                self.on_flush()
+
+    def _apply_pending(self, conn, taken):
+        # move everything pending into `taken` and write it with `conn`.
+        # returns whether there was anything to write
+        with self.pending as pending:
+            taken['links'], taken['comments'] = (pending['links'],
+                                                 pending['comments'])
+            pending['links'], pending['comments'] = Counter(), Counter()
+
+        if not taken['links'] and not taken['comments']:
+            return False
+        db.apply_votes(conn, taken['links'], taken['comments'])
+        return True
+
+    def close(self):
+        "Stop the background flusher and drain the buffer"
+        self.stopping.set()
+        self.wake.set()
+        self.thread.join()
+        self.flush()
+
+    def _run(self):
+        while True:
+            self.wake.wait(self.interval)
+            self.wake.clear()
+            if self.stopping.is_set():
+                break
+            try:
+                self.flush()
+            except Exception:
+                log.exception("Failed to flush votes")
@@ -0,0 +1,209 @@
+from threading import Event
+from threading import Thread
+import Queue
+import copy
+import sqlite3
+import sys
+
+from . import db
+from . import metrics
+from . import utils
+
+
+# upper bounds of the buckets of Writer's histogram of group commit sizes
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+
+class Unavailable(Exception):
+    "A call couldn't be run in time, so the client should try again later"
+
+
+class Overloaded(Unavailable):
+    "There were already too many calls waiting for a worker"
+
+
+class TimedOut(Unavailable):
+    "A call didn't finish before its caller gave up on it"
+
+
+class _Call(object):
+    def __init__(self, fn, a, kw):
+        self.fn = fn
+        self.a = a
+        self.kw = kw
+        self.done = Event()
+        self.abandoned = False
+        self.result = None
+        self.exc_info = None
+        self.statements = 0
+        self.sql_seconds = 0.0
+
+
+class Workers(object):
+    """
+    A fixed set of threads that run db calls, each with its own connection
+
+    This bounds how many connections can be busy at once however many requests
+    are being served. Only `max_queued` calls can wait for a thread, and
+    beyond that `call` raises `Overloaded` straight away rather than letting
+    them pile up. A caller that gives up waiting gets `TimedOut`, and if its
+    call hasn't started by then it's skipped
+    """
+
+    def __init__(self, fname, size, max_queued=100, name='sqlite',
+                 tracer=None, id_scheme='random'):
+        self.queue = Queue.Queue(max_queued)
+        self.threads = []
+        for i in range(size):
+            conn = db.connect_db(fname,
+                                 init_schema=False,
+                                 check_same_thread=False,
+                                 tracer=tracer,
+                                 id_scheme=id_scheme)
+            thread = Thread(target=self._run, args=(conn,),
+                            name='%s-%d' % (name, i))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def call(self, timeout, fn, *a, **kw):
+        "Run `fn(conn, *a, **kw)` on one of the threads and return its result"
+        call = _Call(fn, a, kw)
+        try:
+            self.queue.put_nowait(call)
+        except Queue.Full:
+            raise Overloaded("too many requests are waiting for the database")
+
+        if not call.done.wait(timeout):
+            call.abandoned = True
+            raise TimedOut("the database didn't answer within %.1fs"
+                           % (timeout,))
+
+        # the statements ran on another thread, but they're still part of the
+        # caller's request
+        metrics.request_stats.statements += call.statements
+        metrics.request_stats.sql_seconds += call.sql_seconds
+
+        if call.exc_info is not None:
+            raise call.exc_info[0], call.exc_info[1], call.exc_info[2]
+        return call.result
+
+    def queued(self):
+        return self.queue.qsize()
+
+    def _run(self, conn):
+        stats = metrics.request_stats
+        while True:
+            call = self.queue.get()
+            if call is None:
+                break
+            if call.abandoned:
+                continue
+
+            stats.reset()
+            try:
+                call.result = call.fn(conn, *call.a, **call.kw)
+            except Exception:
+                call.exc_info = sys.exc_info()
+            finally:
+                # don't let a failed call leave a transaction open for the
+                # next one
+                conn.rollback()
+                call.statements = stats.statements
+                call.sql_seconds = stats.sql_seconds
+                call.done.set()
+
+        conn.close()
+
+    def close(self):
+        "Finish everything that's already queued and stop the threads"
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+
+class Writer(Workers):
+    """
+    The one thread that makes every write, on its own connection
+
+    sqlite only lets one connection write at a time, so writers on different
+    connections just queue up behind its lock (or give up with "database is
+    locked"). Here they queue up in memory instead, and everything that's
+    waiting when the thread comes round for more is run in a single
+    transaction with one commit (up to `max_batch` calls). Each call gets a
+    savepoint, so one failing only undoes that call, and nobody sees their
+    result until it's committed. Calls are made with a cursor, so the
+    `db.transaction` functions join the group's transaction
+    """
+
+    def __init__(self, fname, max_queued=100, max_batch=100, tracer=None,
+                 id_scheme='random'):
+        self.max_batch = max_batch
+        # how many calls went into each commit
+        self.batch_sizes = utils.LockBox(metrics.Histogram(BATCH_BUCKETS))
+        Workers.__init__(self, fname, 1, max_queued=max_queued,
+                         name='sqlite-writer', tracer=tracer,
+                         id_scheme=id_scheme)
+
+    def _run(self, conn):
+        # we do our own BEGIN and COMMIT. left to itself the sqlite3 module
+        # would commit before every SAVEPOINT
+        conn.isolation_level = None
+        stopping = False
+        while not stopping:
+            batch = [self.queue.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            if None in batch:
+                # close() only queues these after everything else
+                stopping = True
+            batch = [call for call in batch
+                     if call is not None and not call.abandoned]
+            if batch:
+                self._commit(conn, batch)
+
+        conn.close()
+
+    def _commit(self, conn, batch):
+        request_stats = metrics.request_stats
+        curs = conn.cursor()
+        try:
+            curs.execute("BEGIN IMMEDIATE")
+            for call in batch:
+                curs.execute("SAVEPOINT call")
+                request_stats.reset()
+                try:
+                    call.result = call.fn(curs, *call.a, **call.kw)
+                except Exception:
+                    call.exc_info = sys.exc_info()
+                    curs.execute("ROLLBACK TO call")
+                finally:
+                    call.statements = request_stats.statements
+                    call.sql_seconds = request_stats.sql_seconds
+                curs.execute("RELEASE call")
+            curs.execute("COMMIT")
+        except Exception:
+            # then nothing in the batch was written, whatever each call did
+            exc_info = sys.exc_info()
+            try:
+                curs.execute("ROLLBACK")
+            except sqlite3.OperationalError:
+                # it failed to BEGIN, so there's nothing to roll back
+                pass
+            for call in batch:
+                call.result = None
+                call.exc_info = exc_info
+        finally:
+            with self.batch_sizes as batch_sizes:
+                batch_sizes.observe(len(batch))
+            for call in batch:
+                call.done.set()
+
+    def batch_stats(self):
+        "A copy of the Histogram of how many calls went into each commit"
+        with self.batch_sizes as batch_sizes:
+            return copy.deepcopy(batch_sizes)
@@ -0,0 +1,68 @@
+from StringIO import StringIO
+import gzip
+import os.path
+import shutil
+import tempfile
+import unittest
+
+from elmmit import backup
+from elmmit import bulk
+from elmmit import db
+from elmmit import synth
+
+class TestBackup(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.tempdir, 'db.db')
+        self.conn = db.connect_db(self.db_path)
+        bulk.import_rows(self.conn,
+                         synth.generate(30, comments=200, votes=300),
+                         progress=StringIO())
+
+    def tearDown(self):
+        self.conn.close()
+        shutil.rmtree(self.tempdir)
+
+    def contents(self, conn):
+        return [list(conn.execute("SELECT * FROM %s ORDER BY 1" % (table,)))
+                for table in ('authors', 'links', 'comments')]
+
+    def test_backup(self):
+        dest = os.path.join(self.tempdir, 'copy.db')
+        progress = StringIO()
+        pages = backup.backup(self.db_path, dest, pages_per_step=5, sleep=0,
+                              progress=progress)
+        self.assertTrue(pages > 5)
+        self.assertIn('copied %d/%d pages' % (pages, pages),
+                      progress.getvalue())
+
+        # everything came across, including what's only in the WAL so far
+        copy = db.connect_db(dest)
+        self.assertEqual(copy.execute("PRAGMA integrity_check").fetchone()[0],
+                         'ok')
+        self.assertEqual(self.contents(copy), self.contents(self.conn))
+        copy.close()
+
+        with self.assertRaises(backup.BackupError):
+            backup.backup(self.db_path, dest, progress=progress)
+
+        # a typo'd source doesn't get created and copied
+        missing = os.path.join(self.tempdir, 'missing.db')
+        with self.assertRaises(backup.BackupError):
+            backup.backup(missing, os.path.join(self.tempdir, 'other.db'),
+                          progress=progress)
+        self.assertFalse(os.path.exists(missing))
+
+    def test_snapshot(self):
+        out = StringIO()
+        count = backup.snapshot(self.conn, out, chunk_size=7, sleep=0,
+                                progress=StringIO())
+
+        rows = list(bulk.read_ndjson(gzip.GzipFile(fileobj=StringIO(
+            out.getvalue()))))
+        self.assertEqual(len(rows), count)
+
+        # and it imports back into the same database
+        copy = db.connect_db(':memory:')
+        bulk.import_rows(copy, iter(rows), batch_size=50, progress=StringIO())
+        self.assertEqual(self.contents(copy), self.contents(self.conn))
@@ -0,0 +1,53 @@
+from StringIO import StringIO
+import json
+import unittest
+
+from elmmit import bench
+from elmmit import bulk
+from elmmit import db
+from elmmit import synth
+
+class TestBench(unittest.TestCase):
+    def test_synth_reproducible(self):
+        self.assertEqual(list(synth.generate(50, seed=1)),
+                         list(synth.generate(50, seed=1)))
+        self.assertNotEqual(list(synth.generate(50, seed=1)),
+                            list(synth.generate(50, seed=2)))
+
+    def test_synth_sortable_ids(self):
+        rows = list(synth.generate(20, ids='sortable'))
+        for kind, key in [('link', 'link_id'), ('comment', 'comment_id')]:
+            ids = [row[key] for row in rows if row['type'] == kind]
+            self.assertEqual(ids, sorted(ids))
+            self.assertEqual(len(set(ids)), len(ids))
+
+    def test_synth_imports(self):
+        conn = db.connect_db(':memory:')
+        bulk.import_rows(conn, synth.generate(50, comments=200, votes=300),
+                         progress=StringIO())
+
+        self.assertEqual(conn.execute("SELECT count(*) FROM links").fetchone()[0],
+                         50)
+        # every vote landed on something and was credited to someone
+        points, = conn.execute(
+            "SELECT (SELECT sum(points) FROM links)"
+            " + (SELECT sum(points) FROM comments)").fetchone()
+        karma, = conn.execute("SELECT sum(karma) FROM authors").fetchone()
+        self.assertEqual(points, karma)
+
+    def test_run(self):
+        output = StringIO()
+        bench.run([30], repeat=3, output=output)
+        results = [json.loads(line) for line in output.getvalue().splitlines()]
+
+        ops = set(r['op'] for r in results)
+        self.assertIn('bulk_import', ops)
+        self.assertIn('get_best_links_deep', ops)
+        self.assertTrue(all(r['size'] == 30 for r in results))
+
+        compared = StringIO()
+        bench.compare(StringIO(output.getvalue()),
+                      StringIO(output.getvalue()),
+                      out=compared)
+        self.assertIn('get_link', compared.getvalue())
+        self.assertIn('bulk_import db_bytes', compared.getvalue())
@@ -0,0 +1,54 @@
+from StringIO import StringIO
+import json
+import unittest
+
+from elmmit import bulk
+from elmmit import db
+
+class TestBulk(unittest.TestCase):
+    def setUp(self):
+        self.conn = db.connect_db(':memory:')
+
+    def test_import_ndjson(self):
+        rows = [
+            {'type': 'author', 'author_id': 'David'},
+            {'type': 'link', 'link_id': 'l1', 'author_id': 'david',
+             'title': 'a title', 'created': 1400000000},
+            {'type': 'comment', 'comment_id': 'c1', 'link_id': 'l1',
+             'author_id': 'david', 'body': 'a body', 'created': 1400000200},
+            {'type': 'comment', 'comment_id': 'c2', 'link_id': 'l1',
+             'author_id': 'david', 'body': 'a reply', 'parent_id': 'c1',
+             'created': 1400000100},
+            {'type': 'vote', 'link_id': 'l1', 'diff': 3},
+            {'type': 'vote', 'comment_id': 'c2'},
+        ]
+        f = StringIO(''.join(json.dumps(row) + '\n' for row in rows))
+
+        progress = StringIO()
+        count = bulk.import_rows(self.conn, bulk.read_ndjson(f),
+                                 batch_size=2, defer_indexes=True,
+                                 progress=progress)
+
+        self.assertEqual(count, len(rows))
+        link = db.get_link(self.conn, 'l1')
+        self.assertEqual(link.points, 3)
+        self.assertEqual(link.hot, db.hot_score(3, 1400000000))
+        self.assertEqual((link.num_comments, link.last_comment_at),
+                         (2, 1400000200))
+        self.assertEqual(db.get_comment(self.conn, 'c2').parent_id, 'c1')
+        self.assertEqual(db.get_author(self.conn, 'david').karma, 4)
+        self.assertIn('rows/sec', progress.getvalue())
+
+        # the indexes were put back afterwards
+        indexes = set(name for name, in self.conn.execute(
+            "SELECT name FROM sqlite_master WHERE type='index'"))
+        self.assertIn('links_by_hot', indexes)
+
+    def test_import_csv(self):
+        f = StringIO("type,author_id,link_id,title,points\n"
+                     "author,david,,,\n"
+                     "link,david,l1,a title,5\n")
+
+        bulk.import_rows(self.conn, bulk.read_csv(f), progress=StringIO())
+
+        self.assertEqual(db.get_link(self.conn, 'l1').points, 5)
@@ -0,0 +1,33 @@
+import unittest
+
+from elmmit import cache
+
+class TestListingCache(unittest.TestCase):
+    def test_lru_eviction(self):
+        listing_cache = cache.ListingCache(max_size=2)
+        generation = listing_cache.generation
+        listing_cache.put('a', 'A', generation)
+        listing_cache.put('b', 'B', generation)
+        self.assertEqual(listing_cache.get('a'), 'A')
+        listing_cache.put('c', 'C', generation)
+
+        # 'b' was the least recently used
+        self.assertIsNone(listing_cache.get('b'))
+        self.assertEqual(listing_cache.get('a'), 'A')
+        self.assertEqual(listing_cache.get('c'), 'C')
+        self.assertEqual(listing_cache.stats()['hits'], 3)
+        self.assertEqual(listing_cache.stats()['misses'], 1)
+
+    def test_ttl(self):
+        listing_cache = cache.ListingCache(ttl=-1)
+        listing_cache.put('a', 'A', listing_cache.generation)
+        self.assertIsNone(listing_cache.get('a'))
+
+    def test_stale_put_after_invalidate(self):
+        listing_cache = cache.ListingCache()
+        generation = listing_cache.generation
+        listing_cache.invalidate()
+
+        # computed before the invalidation, so it mustn't be stored
+        listing_cache.put('a', 'A', generation)
+        self.assertIsNone(listing_cache.get('a'))
@@ -0,0 +1,54 @@
+from StringIO import StringIO
+import json
+import subprocess
+import sys
+import unittest
+
+from elmmit import cmd
+from elmmit import db
+
+class TestCmd(unittest.TestCase):
+    def test_run_batch(self):
+        conn = db.connect_db(':memory:')
+        lines = ['create-author --author_id David',
+                 '',
+                 '# comments are skipped',
+                 "submit-link --author_id david --title 'a title'",
+                 '{"command": "get-author", "params": {"author_id": "david"}}',
+                 '{"command": "get-author", "params": {}}',
+                 'get-author',
+                 'no-such-command',
+                 '{"command": "nope"}',
+                 'get-link --link_id nope']
+        out = StringIO()
+        cmd.run_batch(conn, lines, out)
+        results = [json.loads(line) for line in out.getvalue().splitlines()]
+
+        self.assertEqual(len(results), 8)
+        self.assertEqual(results[0]['result']['author_id'], 'david')
+        self.assertEqual(results[1]['result']['title'], 'a title')
+        self.assertEqual(results[2]['result']['author_id'], 'david')
+        self.assertEqual(results[3]['errors'], ['missing author_id'])
+        for result in results[4:]:
+            self.assertIn('errors', result)
+
+    def test_batch_help(self):
+        # stdout is only ever results, even when asked for help
+        conn = db.connect_db(':memory:')
+        stdout = sys.stdout
+        sys.stdout = out = StringIO()
+        try:
+            cmd.run_batch(conn, ['get-author --help', '-h'], out)
+        finally:
+            sys.stdout = stdout
+        results = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual(len(results), 2)
+        for result in results:
+            self.assertIn('errors', result)
+
+    def test_no_flask(self):
+        # only the server command needs the web stack
+        imported = subprocess.check_output(
+            [sys.executable, '-c',
+             "import sys, elmmit.cmd; print 'flask' in sys.modules"])
+        self.assertEqual(imported.strip(), 'False')
@@ -1,7 +1,11 @@
+from StringIO import StringIO
+from functools import partial
+import sqlite3
 import time
 import unittest
 
 from elmmit import db
+from elmmit import utils
 
 class TestDb(unittest.TestCase):
     def setUp(self):
@@ -44,10 +48,98 @@ class TestDb(unittest.TestCase):
                          parent_comment.comment_id)
 
         comment_listing = db.get_comments_for_link(self.conn, link.link_id)
-        ids = set(c.comment_id for c in comment_listing.comments)
-        self.assertEqual(ids,
-                         set([parent_comment.comment_id,
-                              child_comment.comment_id]))
+        [parent_tree] = comment_listing.comments
+        self.assertEqual(parent_tree.comment.comment_id,
+                         parent_comment.comment_id)
+        self.assertEqual([t.comment.comment_id for t in parent_tree.replies],
+                         [child_comment.comment_id])
+
+    def test_comment_tree_limits(self):
+        author = db.create_author(self.conn, 'David')
+        link = db.submit_link(self.conn, author.author_id, 'a title', 'a url', 'the body')
+
+        def comment(parent=None, points=0):
+            c = db.submit_comment(self.conn, link.link_id, author.author_id,
+                                  "a body",
+                                  parent_id=parent and parent.comment_id)
+            return db.upvote_comment(self.conn, c.comment_id, diff=points)
+
+        roots = [comment(points=i) for i in range(3)]
+        chain = [roots[2]]
+        for i in range(4):
+            chain.append(comment(parent=chain[-1]))
+
+        # sorted best-first, and the chain is cut off after two levels
+        listing = db.get_comments_for_link(self.conn, link.link_id, depth=2)
+        self.assertEqual([t.comment.comment_id for t in listing.comments],
+                         [c.comment_id for c in reversed(roots)])
+        self.assertIsNone(listing.more)
+        [reply] = listing.comments[0].replies
+        self.assertEqual(reply.comment.comment_id, chain[1].comment_id)
+        self.assertEqual(reply.replies, [])
+        self.assertEqual(reply.more.parent_id, chain[1].comment_id)
+
+        # the stub fetches the rest of the chain
+        rest = db.get_comments_for_link(self.conn, link.link_id,
+                                        parent_id=reply.more.parent_id,
+                                        pager=reply.more.pager)
+        self.assertEqual(rest.comments[0].comment.comment_id,
+                         chain[2].comment_id)
+
+        # a budget of two top-level comments leaves a stub for the third
+        listing = db.get_comments_for_link(self.conn, link.link_id, limit=2)
+        self.assertEqual(len(listing.comments), 2)
+        self.assertIsNone(listing.more.parent_id)
+        rest = db.get_comments_for_link(self.conn, link.link_id,
+                                        pager=listing.more.pager)
+        self.assertEqual([t.comment.comment_id for t in rest.comments],
+                         [roots[0].comment_id])
+
+    def test_sortable_ids(self):
+        self.assertEqual(utils.to36(0), '0')
+        self.assertEqual(utils.to36(36**3 - 1), 'zzz')
+        self.assertEqual(utils.to36(35, width=3), '00z')
+
+        ids = [utils.sortable_id(now=now) for now in (1.0, 1.5, 1000.0, 2e9)]
+        self.assertEqual(ids, sorted(ids))
+        for id_ in ids:
+            self.assertEqual(len(id_), 24)
+            self.assertTrue(set(id_) <= set(utils.ALPHABET36))
+
+        # a database can switch schemes and keep its old IDs working
+        author = db.create_author(self.conn, 'David')
+        old = db.submit_link(self.conn, author.author_id, 'old', None, None)
+        self.conn.new_id = db.ID_SCHEMES['sortable']
+        new = db.submit_link(self.conn, author.author_id, 'new', None, None)
+        comment = db.submit_comment(self.conn, old.link_id, author.author_id,
+                                    'a body')
+        self.assertEqual(len(new.link_id), 24)
+        self.assertEqual(db.get_link(self.conn, old.link_id).title, 'old')
+        self.assertEqual(db.get_comment(self.conn, comment.comment_id).link_id,
+                         old.link_id)
+        self.assertEqual(
+            [l.title for l in db.get_newest_links(self.conn, None).links],
+            ['new', 'old'])
+
+    def test_run_with_budget(self):
+        runaway = """
+            WITH RECURSIVE forever(n) AS (
+                SELECT 1 UNION ALL SELECT n+1 FROM forever)
+            SELECT count(*) FROM forever
+        """
+        start = time.time()
+        with self.assertRaises(db.OverBudget):
+            db.run_with_budget(self.conn, 0.05,
+                               lambda conn: conn.execute(runaway).fetchall())
+        self.assertLess(time.time() - start, 1)
+
+        # only an expired budget is turned into OverBudget
+        with self.assertRaises(db.sqlite3.OperationalError):
+            db.run_with_budget(self.conn, 10,
+                               lambda conn: conn.execute("SELECT nope"))
+        self.assertEqual(
+            db.run_with_budget(self.conn, 10, db.get_newest_links, None).links,
+            [])
 
     def test_upvote_comment(self):
         author = db.create_author(self.conn, 'David')
@@ -103,12 +195,252 @@ class TestDb(unittest.TestCase):
             [l.link_id for l in self._follow_pagination(db.get_best_links)])
 
 
-    def _follow_pagination(self, db_fn):
-        pager = None
+    def test_link_listings_keyset(self):
+        author = db.create_author(self.conn, 'david')
+
+        # lots of ties on both sort keys so that we exercise the link_id
+        # tiebreaker across page boundaries
+        now = int(time.time())
+        all_links = [db.submit_link(self.conn,
+                                    author.author_id,
+                                    'title #%d' % (i,),
+                                    None,
+                                    None,
+                                    created=now + i//4)
+                     for i in range(23)]
+        for i, link in enumerate(all_links):
+            db.upvote_link(self.conn, link.link_id, diff=i % 3)
+
+        for db_fn in (db.get_newest_links, db.get_best_links):
+            ids = [l.link_id for l in self._follow_pagination(db_fn, limit=5)]
+            self.assertEqual(len(ids), len(all_links))
+            self.assertEqual(set(ids), set(l.link_id for l in all_links))
+
+        # links submitted between page fetches must not shift the later pages
+        first_page = db.get_newest_links(self.conn, pager=None, limit=5)
+        for i in range(3):
+            db.submit_link(self.conn, author.author_id, 'late #%d' % (i,),
+                           None, None, created=now + 100)
+        ids = [l.link_id for l in first_page.links]
+        ids.extend(l.link_id for l in self._follow_pagination(
+            db.get_newest_links, limit=5, pager=first_page.pager))
+        self.assertEqual(ids,
+                         [l.link_id for l in sorted(all_links,
+                                                    key=lambda l: (-l.created,
+                                                                   l.link_id))])
+
+    def test_hot_links(self):
+        author = db.create_author(self.conn, 'david')
+        now = int(time.time())
+
+        old_popular = db.submit_link(self.conn, author.author_id, 'old',
+                                     None, None, created=now - 2*86400)
+        db.upvote_link(self.conn, old_popular.link_id, diff=100)
+        new_quiet = db.submit_link(self.conn, author.author_id, 'new',
+                                   None, None, created=now)
+        db.upvote_link(self.conn, new_quiet.link_id, diff=2)
+        new_popular = db.submit_link(self.conn, author.author_id, 'newer',
+                                     None, None, created=now - 3600)
+        db.upvote_link(self.conn, new_popular.link_id, diff=50)
+
+        self.assertEqual(
+            [l.link_id for l in self._follow_pagination(db.get_hot_links,
+                                                        limit=1)],
+            [new_popular.link_id, new_quiet.link_id, old_popular.link_id])
+
+    def test_migrate_old_schema(self):
+        # a database created before we versioned the schema gets upgraded and
+        # backfilled when it's opened
+        conn = db.connect_db(':memory:', init_schema=False)
+        conn.executescript(db._SCHEMA)
+        conn.executescript("""
+            INSERT INTO authors(author_id) VALUES('david');
+            INSERT INTO links(link_id, author_id, title, points, created)
+            VALUES('a', 'david', 'title', 10, 1400000000);
+            INSERT INTO comments(comment_id, link_id, author_id, body, created)
+            VALUES('c', 'a', 'david', 'body', 1400000100);
+        """)
+
+        db.create_schema(conn)
+
+        self.assertEqual(conn.execute("PRAGMA user_version").fetchone()[0],
+                         len(db._MIGRATIONS))
+        self.assertEqual(conn.execute("SELECT hot FROM links").fetchone()[0],
+                         db.hot_score(10, 1400000000))
+        link = db.get_link(conn, 'a')
+        self.assertEqual((link.num_comments, link.last_comment_at),
+                         (1, 1400000100))
+
+    def test_failed_migration(self):
+        conn = db.connect_db(':memory:', init_schema=False)
+        conn.executescript(db._SCHEMA)
+        for migration in db._MIGRATIONS[:3]:
+            conn.executescript(migration)
+        # migration 4 gets as far as making the indexes before it finds that
+        # it can't mark the links as needing them rebuilt
+        conn.executescript("""
+            PRAGMA user_version=3;
+            CREATE TABLE search_rebuilds (name PRIMARY KEY);
+        """)
+
+        self.assertRaises(sqlite3.OperationalError, db.create_schema, conn)
+
+        # and none of it stuck
+        self.assertEqual(conn.execute("PRAGMA user_version").fetchone()[0], 3)
+        self.assertFalse(db.has_search(conn))
+        conn.execute("DROP TABLE search_rebuilds")
+        db.create_schema(conn)
+        self.assertTrue(db.has_search(conn))
+
+    def test_comment_counts(self):
+        author = db.create_author(self.conn, 'David')
+        link = db.submit_link(self.conn, author.author_id, 'a title', None,
+                              None)
+        self.assertEqual((link.num_comments, link.last_comment_at), (0, None))
+
+        comments = [db.submit_comment(self.conn, link.link_id,
+                                      author.author_id, 'a body')
+                    for _ in range(3)]
+        link = db.get_link(self.conn, link.link_id)
+        self.assertEqual(link.num_comments, 3)
+        self.assertEqual(link.last_comment_at,
+                         max(c.created for c in comments))
+
+        with self.conn:
+            self.conn.execute("UPDATE links SET num_comments = 1")
+        progress = StringIO()
+        self.assertEqual(db.repair_comment_counts(self.conn, batch_size=1,
+                                                  progress=progress), 1)
+        self.assertEqual(db.get_link(self.conn, link.link_id).num_comments, 3)
+        self.assertEqual(db.repair_comment_counts(self.conn,
+                                                  progress=progress), 0)
+
+    def test_top_links(self):
+        author = db.create_author(self.conn, 'David').author_id
+        now = int(time.time())
+        hour_old = db.submit_link(self.conn, author, 'title', None, None,
+                                  created=now - 2*3600)
+        new = [db.submit_link(self.conn, author, 'title', None, None)
+               for _ in range(3)]
+        db.submit_link(self.conn, author, 'ancient', None, None,
+                       created=now - 365*86400)
+        db.upvote_link(self.conn, hour_old.link_id, 10)
+        db.upvote_link(self.conn, new[1].link_id, 2)
+        db.apply_votes(self.conn, {new[2].link_id: 1}, {})
+
+        def top(period):
+            return [l.link_id for l in self._follow_pagination(
+                partial(db.get_top_links, period=period), limit=1)]
+
+        self.assertEqual(top('hour'),
+                         [new[1].link_id, new[2].link_id, new[0].link_id])
+        self.assertEqual(top('day'),
+                         [hour_old.link_id, new[1].link_id, new[2].link_id,
+                          new[0].link_id])
+        self.assertEqual(len(top('month')), 4)
+        self.assertRaises(ValueError, db.get_top_links, self.conn, 'year')
+
+    def test_author_listings(self):
+        david = db.create_author(self.conn, 'David').author_id
+        other = db.create_author(self.conn, 'other').author_id
+        links = [db.submit_link(self.conn, david, 'title', None, None,
+                                created=1400000000 + i)
+                 for i in range(5)]
+        db.submit_link(self.conn, other, 'not his', None, None)
+        db.upvote_link(self.conn, links[2].link_id, 3)
+        comments = [db.submit_comment(self.conn, links[0].link_id, david,
+                                      'body %d' % (i,))
+                    for i in range(3)]
+        db.submit_comment(self.conn, links[0].link_id, other, 'not his')
+        db.upvote_comment(self.conn, comments[1].comment_id, 1)
+
+        def author_links(**kw):
+            return self._follow_pagination(
+                partial(db.get_author_links, author_id='DAVID', **kw),
+                limit=2)
+
+        self.assertEqual([l.link_id for l in author_links()],
+                         [l.link_id for l in reversed(links)])
+        self.assertEqual([l.link_id for l in author_links(sort='top')][0],
+                         links[2].link_id)
+
+        page = db.get_author_comments(self.conn, david, sort='top')
+        self.assertEqual(len(page.comments), 3)
+        self.assertEqual(page.comments[0].comment_id, comments[1].comment_id)
+
+        self.assertRaises(ValueError, db.get_author_links, self.conn, david,
+                          sort='bogus')
+
+    def test_search(self):
+        david = db.create_author(self.conn, 'David').author_id
+        other = db.create_author(self.conn, 'other').author_id
+        about_cats = db.submit_link(self.conn, david, 'all about cats', None,
+                                    'cats and dogs')
+        mentions_cats = db.submit_link(self.conn, other, 'pets', None,
+                                       'dogs, and a cat')
+        db.submit_link(self.conn, david, 'dogs', None, None)
+        comment = db.submit_comment(self.conn, about_cats.link_id, other,
+                                    'I love "cats" (and OR)')
+
+        # matches in the title rank higher, and words are stemmed
+        listing = db.search_links(self.conn, 'cats')
+        self.assertEqual([l.link_id for l in listing.links],
+                         [about_cats.link_id, mentions_cats.link_id])
+        listing = db.search_links(self.conn, 'Cat Dog', author_id='OTHER')
+        self.assertEqual([l.link_id for l in listing.links],
+                         [mentions_cats.link_id])
+
+        first = db.search_links(self.conn, 'dogs', limit=2)
+        second = db.search_links(self.conn, 'dogs', pager=first.pager)
+        self.assertEqual(len(set(l.link_id
+                                 for l in first.links + second.links)), 3)
+        self.assertIsNone(second.pager)
+
+        # what the user types isn't taken as FTS5 syntax
+        page = db.search_comments(self.conn, 'cats" OR (')
+        self.assertEqual(page.comments, [comment])
+        self.assertEqual(db.search_comments(self.conn, '  ').comments, [])
+
+    def test_rebuild_search(self):
+        # a database from before search has everything indexed by the
+        # rebuild, while what's written in the meantime still gets indexed
+        conn = db.connect_db(':memory:', init_schema=False)
+        conn.executescript(db._SCHEMA)
+        conn.executescript("""
+            INSERT INTO authors(author_id) VALUES('david');
+            INSERT INTO links(link_id, author_id, title)
+            VALUES('b', 'david', 'old cats');
+            INSERT INTO links(link_id, author_id, title)
+            VALUES('d', 'david', 'older cats');
+        """)
+        db.create_schema(conn)
+
+        db.submit_link(conn, 'david', 'new cats', None, None)
+        self.assertEqual(len(db.search_links(conn, 'cats').links), 0)
+
+        version = db.get_version(conn, 'links')[0]
+        progress = StringIO()
+        db.rebuild_search(conn, batch_size=1, progress=progress)
+        self.assertEqual(len(db.search_links(conn, 'cats').links), 3)
+        self.assertIn("indexed 3 links", progress.getvalue())
+        # which changed what searches return, so the ETags have to change
+        self.assertTrue(db.get_version(conn, 'links')[0] > version)
+
+        # and once it's done new rows are indexed as they're written
+        db.submit_link(conn, 'david', 'newer cats', None, None)
+        self.assertEqual(len(db.search_links(conn, 'cats').links), 4)
+
+        # running it again rebuilds the indexes from scratch
+        version = db.get_version(conn, 'links')[0]
+        db.rebuild_search(conn, progress=progress)
+        self.assertEqual(len(db.search_links(conn, 'cats').links), 4)
+        self.assertTrue(db.get_version(conn, 'links')[0] > version)
 
+    def _follow_pagination(self, db_fn, limit=25, pager=None):
         while True:
-            link_listing = db_fn(self.conn, pager=pager, limit=25)
+            link_listing = db_fn(self.conn, pager=pager, limit=limit)
             for link in link_listing.links:
                 yield link
             if link_listing.pager is None:
                 break
+            pager = link_listing.pager
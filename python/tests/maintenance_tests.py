@@ -0,0 +1,89 @@
+from StringIO import StringIO
+import os.path
+import shutil
+import tempfile
+import unittest
+
+from elmmit import db
+from elmmit import maintenance
+from elmmit import utils
+
+class TestMaintenance(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.tempdir, 'db.db')
+        self.conn = db.connect_db(self.db_path)
+
+        # leave some free pages and a big WAL behind
+        with self.conn:
+            self.conn.execute("CREATE TABLE junk(stuff)")
+            self.conn.executemany("INSERT INTO junk VALUES(?)",
+                                  [('x' * 1000,) for _ in range(500)])
+        self.conn.execute("DROP TABLE junk")
+
+    def tearDown(self):
+        self.conn.close()
+        shutil.rmtree(self.tempdir)
+
+    def test_maintain(self):
+        free = maintenance.free_pages(self.conn)
+        self.assertTrue(free > 100)
+
+        # nothing gets vacuumed without any time to do it in
+        report = maintenance.maintain(self.conn, vacuum_seconds=0,
+                                      wal_threshold=10**9, analyze=None)
+        self.assertEqual(report['vacuumed_pages'], 0)
+        self.assertIsNone(report['checkpoint'])
+        self.assertTrue(report['wal_bytes'] > 0)
+
+        progress = StringIO()
+        report = maintenance.maintain(self.conn, vacuum_step=10,
+                                      wal_threshold=0,
+                                      checkpoint_mode='truncate',
+                                      analyze='full',
+                                      progress=progress)
+        self.assertEqual(report['vacuumed_pages'], free)
+        self.assertEqual(report['free_pages'], 0)
+        self.assertEqual(report['checkpoint'][0], 0)
+        self.assertEqual(report['wal_bytes'], 0)
+        self.assertTrue(list(self.conn.execute("SELECT * FROM sqlite_stat1")))
+        self.assertIn('vacuumed %d' % (free,), progress.getvalue())
+
+    def add_authors(self, count):
+        with self.conn:
+            for _ in range(count):
+                db.create_author(self.conn, utils.uuid4_36())
+
+    def test_maintainer(self):
+        self.add_authors(20)
+        self.assertEqual(maintenance.analyzed_rows(self.conn), {})
+        maintainer = maintenance.Maintainer(self.db_path, interval=3600,
+                                            wal_threshold=0)
+        try:
+            maintainer.run()
+        finally:
+            maintainer.close()
+        stats = maintainer.stats()
+        self.assertEqual(stats['runs'], 1)
+        self.assertEqual(stats['last']['free_pages'], 0)
+
+        # its connection was new, and so had queried nothing for a plain
+        # "PRAGMA optimize" to go on
+        self.assertIn('authors', stats['last']['analyzed'])
+        self.assertEqual(maintenance.analyzed_rows(self.conn)['authors'], 20)
+
+    def test_optimize(self):
+        self.add_authors(20)
+        maintenance.maintain(self.conn, analyze='full')
+        self.assertEqual(maintenance.maintain(self.conn)['analyzed'], [])
+
+        # the statistics are refreshed once the table has grown
+        self.add_authors(2000)
+        conn = db.connect_db(self.db_path)
+        try:
+            report = maintenance.maintain(conn)
+        finally:
+            conn.close()
+        self.assertIn('authors', report['analyzed'])
+        self.assertTrue(
+            maintenance.analyzed_rows(self.conn)['authors'] > 1000)
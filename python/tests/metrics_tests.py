@@ -0,0 +1,45 @@
+import unittest
+
+from elmmit import db
+from elmmit import metrics
+from elmmit import tracing
+
+class TestMetrics(unittest.TestCase):
+    def test_histogram_quantiles(self):
+        histogram = metrics.Histogram(buckets=(1.0, 2.0, 3.0))
+        for value in [0.5] * 50 + [1.5] * 40 + [2.5] * 9 + [10]:
+            histogram.observe(value)
+
+        self.assertEqual(histogram.counts, [50, 40, 9, 1])
+        self.assertEqual(histogram.quantile(0.5), 1.0)
+        self.assertAlmostEqual(histogram.quantile(0.7), 1.5)
+        self.assertEqual(histogram.quantile(0.999), 3.0)
+
+    def test_sql_stats(self):
+        conn = db.connect_db(':memory:')
+        metrics.request_stats.reset()
+        db.create_author(conn, 'david')
+        db.get_author(conn, 'david')
+        self.assertEqual(metrics.request_stats.statements, 3)
+
+    def test_executemany(self):
+        # the params can be any iterable, traced or not
+        for tracer in [None, tracing.QueryTracer()]:
+            conn = db.connect_db(':memory:', tracer=tracer)
+            conn.executemany("INSERT INTO authors(author_id) VALUES(?)",
+                             ((author_id,) for author_id in 'abc'))
+            self.assertEqual(
+                conn.execute("SELECT count(*) FROM authors").fetchone()[0], 3)
+        self.assertTrue(tracer.queries)
+
+    def test_exposition(self):
+        registry = metrics.Registry()
+        registry.record_request('/a"b', 200, 0.003, 2, 0.001)
+        text = registry.exposition()
+
+        self.assertIn('# TYPE elmmit_request_duration_seconds histogram\n',
+                      text)
+        self.assertIn('elmmit_request_duration_seconds_bucket'
+                      '{le="0.005",route="/a\\"b"} 1\n', text)
+        self.assertIn('elmmit_requests_total{route="/a\\"b",status="200"} 1\n',
+                      text)
@@ -0,0 +1,47 @@
+import json
+import unittest
+
+from elmmit import models
+
+class TestModels(unittest.TestCase):
+    def test_fields(self):
+        link = models.Link(link_id='a', author_id='david', title='a title')
+        self.assertEqual(link.link_id, 'a')
+        self.assertIsNone(link.url)
+        self.assertEqual(link.to_json()['title'], 'a title')
+        self.assertEqual(sorted(link.to_json()), sorted(models.Link.fields))
+
+        # no per-instance dict
+        self.assertFalse(hasattr(link, '__dict__'))
+
+    def test_from_row(self):
+        row = ('c', 'a', 'david', 1400000000, None, 'a body', 3)
+        comment = models.Comment.from_row(row)
+        self.assertEqual(comment.points, 3)
+        self.assertEqual(comment, models.Comment(**comment.to_json()))
+
+    def test_iter_json(self):
+        comment = models.Comment(comment_id='c', body=u'\u2603 "quoted"')
+        more = models.MoreComments(link_id='l', parent_id='c', pager='p')
+        tree = models.CommentTree(
+            comment=comment,
+            replies=[models.CommentTree(comment=comment, replies=[],
+                                        more=None)] * 2,
+            more=more)
+        listings = [
+            models.CommentListing(comments=[tree, tree], more=None),
+            models.CommentListing(comments=[], more=more),
+            models.LinkListing(links=[models.Link(link_id='a'),
+                                      models.Link(link_id='b')],
+                               pager='p'),
+            models.LinkListing(links=[], pager=None),
+            comment,
+        ]
+
+        # streaming has to produce the same thing as serialising all at once
+        for listing in listings:
+            self.assertEqual(json.loads(''.join(listing.iter_json())),
+                             json.loads(json.dumps(listing.to_json())))
+
+    def test_unknown_field(self):
+        self.assertRaises(TypeError, models.Author, author_id='a', nope=1)
@@ -0,0 +1,93 @@
+import unittest
+
+from elmmit import db
+from elmmit import tracing
+
+class TestQueryPlans(unittest.TestCase):
+    """
+    Every db entry point has to be served by indexes. If one of these fails,
+    a query has regressed to reading a whole table (or sorting one)
+    """
+
+    def setUp(self):
+        self.tracer = tracing.QueryTracer()
+        self.conn = db.connect_db(':memory:', tracer=self.tracer)
+
+        self.author = db.create_author(self.conn, 'david')
+        self.links = [db.submit_link(self.conn, 'david', 'title #%d' % (i,),
+                                     None, None)
+                      for i in range(5)]
+        self.link = self.links[0]
+        self.comment = db.submit_comment(self.conn, self.link.link_id,
+                                         'david', 'a body')
+        self.reply = db.submit_comment(self.conn, self.link.link_id,
+                                       'david', 'a reply',
+                                       parent_id=self.comment.comment_id)
+
+    def assertIndexed(self, db_fn, *a, **kw):
+        "Run `db_fn` and fail if any of its statements scan or sort a table"
+        self.tracer.clear()
+        ret = db_fn(self.conn, *a, **kw)
+
+        self.assertTrue(self.tracer.queries)
+        for query in self.tracer.queries:
+            problems = (tracing.full_scans(query.plan)
+                        + tracing.temp_sorts(query.plan))
+            self.assertFalse(problems,
+                             "%s: %s\n%s" % (db_fn.__name__,
+                                             ', '.join(problems),
+                                             query.sql))
+        return ret
+
+    def test_lookups(self):
+        self.assertIndexed(db.get_author, 'david')
+        self.assertIndexed(db.get_link, self.link.link_id)
+        self.assertIndexed(db.get_comment, self.comment.comment_id)
+
+    def test_writes(self):
+        self.assertIndexed(db.create_author, 'someone')
+        self.assertIndexed(db.submit_link, 'david', 'a title', None, None)
+        self.assertIndexed(db.submit_comment, self.link.link_id, 'david',
+                           'a body', parent_id=self.comment.comment_id)
+        self.assertIndexed(db.upvote_link, self.link.link_id, 1)
+        self.assertIndexed(db.upvote_comment, self.comment.comment_id, 1)
+        self.assertIndexed(db.apply_votes,
+                           {self.link.link_id: 1},
+                           {self.comment.comment_id: 1})
+
+    def test_listings(self):
+        for db_fn in (db.get_newest_links, db.get_best_links,
+                      db.get_hot_links):
+            listing = self.assertIndexed(db_fn, None, limit=2)
+            self.assertIndexed(db_fn, listing.pager, limit=2)
+
+    def test_top_links(self):
+        for period in db.TOP_PERIODS:
+            listing = self.assertIndexed(db.get_top_links, period, limit=2)
+            self.assertIndexed(db.get_top_links, period, listing.pager,
+                               limit=2)
+
+    def test_author_listings(self):
+        for db_fn in (db.get_author_links, db.get_author_comments):
+            for sort in db.AUTHOR_SORTS:
+                listing = self.assertIndexed(db_fn, 'david', sort=sort,
+                                             limit=1)
+                self.assertIndexed(db_fn, 'david', sort=sort, limit=1,
+                                   pager=listing.pager)
+
+    def test_comment_tree(self):
+        for sort in db.COMMENT_SORTS:
+            self.assertIndexed(db.get_comments_for_link, self.link.link_id,
+                               sort=sort)
+            # cut off at the top level, which has to check for replies
+            self.assertIndexed(db.get_comments_for_link, self.link.link_id,
+                               sort=sort, depth=1)
+
+    def test_search(self):
+        # ranking by relevance means sorting the matches, but finding them
+        # mustn't read everything
+        for db_fn in (db.search_links, db.search_comments):
+            self.tracer.clear()
+            db_fn(self.conn, 'body', author_id='david')
+            for query in self.tracer.queries:
+                self.assertFalse(tracing.full_scans(query.plan), query.sql)
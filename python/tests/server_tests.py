@@ -2,22 +2,36 @@ import json
 import os.path
 import shutil
 import tempfile
+import time
 import unittest
 
+from elmmit import api
+from elmmit import maintenance
+from elmmit import metrics
 from elmmit import server
 
+# a query that never finishes
+RUNAWAY = """
+    WITH RECURSIVE forever(n) AS (SELECT 1 UNION ALL SELECT n+1 FROM forever)
+    SELECT count(*) FROM forever
+"""
+
 class TestDb(unittest.TestCase):
+    app_options = {}
+
     def setUp(self):
         self.tempdir = tempfile.mkdtemp()
 
         self.app = server.app
         self.app.testing = True
-        self.app.config['db_path'] = os.path.join(self.tempdir, 'db.db')
+        server.init_app(os.path.join(self.tempdir, 'db.db'),
+                        **self.app_options)
 
         self.client = self.app.test_client()
         print self.app
 
     def tearDown(self):
+        server.close_app()
         shutil.rmtree(self.tempdir)
         del self.tempdir
 
@@ -44,3 +58,289 @@ class TestDb(unittest.TestCase):
         self.assertEqual(rv.status_code, 200)
         self.assertIn('links', json.loads(rv.data))
 
+    def test_listing_cache(self):
+        self.client.post('/api/create-author', data={'author_id': 'hello'})
+
+        def newest_titles():
+            rv = self.client.get('/api/get-newest-links?limit=5')
+            self.assertEqual(rv.status_code, 200)
+            return [l['title'] for l in json.loads(rv.data)['links']]
+
+        self.assertEqual(newest_titles(), [])
+        self.assertEqual(newest_titles(), [])
+        stats = json.loads(self.client.get('/cache-stats').data)
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+
+        # submitting a link has to drop the cached (now stale) listing
+        self.client.post('/api/submit-link',
+                         data={'author_id': 'hello', 'title': 'a title'})
+        self.assertEqual(newest_titles(), ['a title'])
+
+    def test_batch(self):
+        self.client.post('/api/create-author', data={'author_id': 'hello'})
+        rv = self.client.post('/api/submit-link',
+                              data={'author_id': 'hello', 'title': 'a title'})
+        link_id = json.loads(rv.data)['link_id']
+
+        calls = [{'path': '/api/get-link', 'params': {'link_id': link_id}},
+                 {'path': '/api/get-comments-for-link',
+                  'params': {'link_id': link_id}},
+                 {'path': '/api/get-author', 'params': {}},
+                 {'path': '/api/create-author',
+                  'params': {'author_id': 'other'}},
+                 {'path': '/api/get-author',
+                  'params': {'author_id': 'hello'}}]
+        rv = self.client.post('/api/batch', data=json.dumps(calls),
+                              content_type='application/json')
+        self.assertEqual(rv.status_code, 200)
+        results = json.loads(rv.data)['results']
+
+        self.assertEqual(results[0]['result']['title'], 'a title')
+        self.assertEqual(results[1]['result']['comments'], [])
+        self.assertEqual(results[2]['errors'], ['missing author_id'])
+        self.assertIn('errors', results[3])
+        self.assertEqual(results[4]['result']['author_id'], 'hello')
+
+        self.app.config['max_batch_size'] = 2
+        rv = self.client.post('/api/batch', data=json.dumps(calls),
+                              content_type='application/json')
+        self.assertEqual(rv.status_code, 400)
+
+    def test_streamed_comments(self):
+        self.client.post('/api/create-author', data={'author_id': 'hello'})
+        rv = self.client.post('/api/submit-link',
+                              data={'author_id': 'hello', 'title': 'a title'})
+        link_id = json.loads(rv.data)['link_id']
+        for _ in range(3):
+            self.client.post('/api/submit-comment',
+                             data={'author_id': 'hello',
+                                   'link_id': link_id,
+                                   'body': 'a body'})
+
+        rv = self.client.get('/api/get-comments-for-link?link_id=%s&limit=2'
+                             % (link_id,))
+        self.assertEqual(rv.status_code, 200)
+        listing = json.loads(rv.data)
+        self.assertEqual(len(listing['comments']), 2)
+        self.assertIsNotNone(listing['more']['pager'])
+
+    def test_conditional_get(self):
+        self.client.post('/api/create-author', data={'author_id': 'hello'})
+        rv = self.client.post('/api/submit-link',
+                              data={'author_id': 'hello', 'title': 'a title'})
+        link_id = json.loads(rv.data)['link_id']
+
+        for path in ['/api/get-newest-links',
+                     '/api/get-comments-for-link?link_id=%s' % (link_id,),
+                     '/api/get-link?link_id=%s' % (link_id,)]:
+            rv = self.client.get(path)
+            etag = rv.headers['ETag']
+            rv = self.client.get(path, headers={'If-None-Match': etag})
+            self.assertEqual(rv.status_code, 304, path)
+            self.assertEqual(rv.data, '')
+
+            # any change to what's in the response gives it a new ETag
+            self.client.post('/api/upvote-link',
+                             data={'link_id': link_id, 'diff': 1})
+            self.client.post('/api/submit-comment',
+                             data={'author_id': 'hello',
+                                   'link_id': link_id,
+                                   'body': 'a body'})
+            rv = self.client.get(path, headers={'If-None-Match': etag})
+            self.assertEqual(rv.status_code, 200, path)
+            self.assertNotEqual(rv.headers['ETag'], etag)
+
+        # link listings don't change when a link's comments get votes
+        rv = self.client.post('/api/submit-comment',
+                              data={'author_id': 'hello',
+                                    'link_id': link_id,
+                                    'body': 'a body'})
+        comment_id = json.loads(rv.data)['comment_id']
+        rv = self.client.get('/api/get-newest-links')
+        etag = rv.headers['ETag']
+        self.client.post('/api/upvote-comment',
+                         data={'comment_id': comment_id, 'diff': 1})
+        rv = self.client.get('/api/get-newest-links',
+                             headers={'If-None-Match': etag})
+        self.assertEqual(rv.status_code, 304)
+
+    def test_if_modified_since(self):
+        # nothing has been written yet, so this has been unmodified forever
+        rv = self.client.get('/api/get-newest-links')
+        last_modified = rv.headers['Last-Modified']
+        rv = self.client.get('/api/get-newest-links',
+                             headers={'If-Modified-Since': last_modified})
+        self.assertEqual(rv.status_code, 304)
+
+        self.client.post('/api/create-author', data={'author_id': 'hello'})
+        self.client.post('/api/submit-link',
+                         data={'author_id': 'hello', 'title': 'a title'})
+        rv = self.client.get('/api/get-newest-links',
+                             headers={'If-Modified-Since': last_modified})
+        self.assertEqual(rv.status_code, 200)
+
+        # a change this second means it can't give a Last-Modified at all
+        with self.app.config['db_pool'].connection() as conn:
+            with conn:
+                conn.execute("UPDATE versions SET modified = ?",
+                             (int(time.time()) + 60,))
+        rv = self.client.get('/api/get-newest-links')
+        self.assertNotIn('Last-Modified', rv.headers)
+
+    def test_metrics(self):
+        metrics.registry.reset()
+        self.client.post('/api/create-author', data={'author_id': 'hello'})
+        self.client.get('/api/get-author?author_id=hello')
+        self.client.get('/api/get-author')
+        self.client.get('/api/get-comments-for-link?link_id=nope').data
+
+        rv = self.client.get('/metrics')
+        self.assertEqual(rv.status_code, 200)
+        lines = rv.data.splitlines()
+
+        self.assertIn('elmmit_requests_total'
+                      '{route="/api/get-author",status="200"} 1', lines)
+        self.assertIn('elmmit_requests_total'
+                      '{route="/api/get-author",status="400"} 1', lines)
+        self.assertIn('elmmit_request_duration_seconds_count'
+                      '{route="/api/get-author"} 2', lines)
+        self.assertIn('elmmit_request_duration_seconds_bucket'
+                      '{le="+Inf",route="/api/create-author"} 1', lines)
+        self.assertIn('elmmit_sql_statements_total'
+                      '{route="/api/create-author"} 2', lines)
+        # the streamed comment listing counted its bytes once it was sent
+        self.assertIn('elmmit_response_bytes_total'
+                      '{route="/api/get-comments-for-link"} %d'
+                      % (len('{"more": null, "comments": []}'),), lines)
+
+    def test_limits(self):
+        route = api.api_routes['/api/get-newest-links']
+        params, errors = route.parse_params({'limit': '10000000'})
+        self.assertEqual((params['limit'], errors),
+                         (api.MAX_LISTING_LIMIT, []))
+
+        rv = self.client.get('/api/get-newest-links?limit=10000000')
+        self.assertEqual(rv.status_code, 200)
+        # sqlite takes a negative LIMIT to mean no limit at all
+        rv = self.client.get('/api/get-newest-links?limit=-2')
+        self.assertEqual(rv.status_code, 400)
+        self.assertEqual(json.loads(rv.data)['errors'],
+                         ['limit must be at least 1'])
+        rv = self.client.get('/api/get-comments-for-link?link_id=x&sort=nope')
+        self.assertEqual(rv.status_code, 400)
+
+        # the server can be given lower ones
+        self.app.config['limits']['max_listing_limit'] = 2
+        self.client.post('/api/create-author', data={'author_id': 'hello'})
+        for _ in range(3):
+            self.client.post('/api/submit-link',
+                             data={'author_id': 'hello', 'title': 'a title'})
+        rv = self.client.get('/api/get-newest-links?limit=10')
+        self.assertEqual(len(json.loads(rv.data)['links']), 2)
+
+    def test_query_budget(self):
+        self.app.config['query_budget'] = 0.05
+        self.app.config['db_overrides'][server.db.get_author] = (
+            lambda conn, author_id: conn.execute(RUNAWAY).fetchall())
+
+        rv = self.client.get('/api/get-author?author_id=hello')
+        self.assertEqual(rv.status_code, 503)
+
+        calls = [{'path': '/api/get-author', 'params': {'author_id': 'hello'}}]
+        rv = self.client.post('/api/batch', data=json.dumps(calls),
+                              content_type='application/json')
+        self.assertEqual(rv.status_code, 503)
+
+        # and the connection is still good for the next request
+        rv = self.client.get('/api/get-newest-links')
+        self.assertEqual(rv.status_code, 200)
+
+    def test_maintenance_metrics(self):
+        maintainer = maintenance.Maintainer(self.app.config['db_path'],
+                                            interval=3600)
+        self.app.config['maintainer'] = maintainer
+        maintainer.run()
+
+        lines = self.client.get('/metrics').data.splitlines()
+        self.assertIn('elmmit_maintenance_runs_total 1', lines)
+        self.assertIn('elmmit_sqlite_free_pages 0', lines)
+
+    def test_full_vote_buffer(self):
+        server.init_app(os.path.join(self.tempdir, 'db.db'),
+                        vote_flush_interval=3600, request_timeout=2.0)
+        vote_buffer = self.app.config['vote_buffer']
+        vote_buffer.max_pending = 1
+
+        self.client.post('/api/create-author', data={'author_id': 'hello'})
+        rv = self.client.post('/api/submit-link',
+                              data={'author_id': 'hello', 'title': 'a title'})
+        link_id = json.loads(rv.data)['link_id']
+
+        # filling the buffer mustn't have the writer wait on itself
+        rv = self.client.post('/api/upvote-link',
+                              data={'link_id': link_id, 'diff': 1})
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(json.loads(rv.data)['points'], 1)
+        rv = self.client.post('/api/create-author', data={'author_id': 'other'})
+        self.assertEqual(rv.status_code, 200)
+
+        # and the background flush gets it written out
+        def points():
+            with self.app.config['db_pool'].connection() as conn:
+                return server.db.get_link(conn, link_id).points
+        deadline = time.time() + 5
+        while points() != 1 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(points(), 1)
+
+    def test_buffered_upvote_keeps_cache(self):
+        server.init_app(os.path.join(self.tempdir, 'db.db'),
+                        vote_flush_interval=3600)
+        listing_cache = self.app.config['listing_cache']
+
+        self.client.post('/api/create-author', data={'author_id': 'hello'})
+        rv = self.client.post('/api/submit-link',
+                              data={'author_id': 'hello', 'title': 'a title'})
+        link_id = json.loads(rv.data)['link_id']
+
+        # the upvote is only in memory, so the listing is still right
+        generation = listing_cache.generation
+        self.client.post('/api/upvote-link',
+                         data={'link_id': link_id, 'diff': 1})
+        self.assertEqual(listing_cache.generation, generation)
+
+        # until it's written out
+        self.app.config['vote_buffer'].flush()
+        self.assertNotEqual(listing_cache.generation, generation)
+
+    def test_connection_pool(self):
+        pool = self.app.config['db_pool']
+        for _ in range(5):
+            rv = self.client.get('/api/get-newest-links')
+            self.assertEqual(rv.status_code, 200)
+
+        # every request handed its connection back, and they all reused the
+        # same one
+        self.assertEqual(pool.idle.qsize(), 1)
+
+
+class TestWorkers(TestDb):
+    # everything should work the same when the db calls run on worker threads
+    app_options = {'sqlite_readers': 2}
+
+    def test_connection_pool(self):
+        for _ in range(5):
+            rv = self.client.get('/api/get-newest-links')
+            self.assertEqual(rv.status_code, 200)
+
+        # the requests never needed a connection of their own
+        self.assertEqual(self.app.config['db_pool'].idle.qsize(), 0)
+
+    def test_overloaded(self):
+        self.app.config['request_timeout'] = 0.01
+        self.app.config['db_overrides'][server.db.get_author] = (
+            lambda conn, author_id: time.sleep(0.1))
+
+        rv = self.client.get('/api/get-author?author_id=hello')
+        self.assertEqual(rv.status_code, 503)
+        self.assertEqual(rv.headers['Retry-After'], '1')
@@ -0,0 +1,99 @@
+from threading import Thread
+import os.path
+import shutil
+import tempfile
+import time
+import unittest
+
+from elmmit import db
+from elmmit import votes
+
+class TestVotes(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        db_path = os.path.join(self.tempdir, 'db.db')
+        self.conn = db.connect_db(db_path)
+        self.pool = db.ConnectionPool(db_path)
+        # a long interval so that only the test decides when to flush
+        self.buffer = votes.VoteBuffer(self.pool, interval=3600)
+
+    def tearDown(self):
+        self.buffer.close()
+        self.pool.close()
+        self.conn.close()
+        shutil.rmtree(self.tempdir)
+
+    def test_coalesced_votes(self):
+        author = db.create_author(self.conn, 'David')
+        link = db.submit_link(self.conn, author.author_id, 'a title', 'a url', 'the body')
+        comment = db.submit_comment(self.conn, link.link_id,
+                                    author.author_id, "a body")
+
+        for _ in range(3):
+            buffered = self.buffer.upvote_link(self.conn, link.link_id, diff=2)
+        self.buffer.upvote_comment(self.conn, comment.comment_id, diff=1)
+
+        # the caller sees their votes straight away, but nothing is written yet
+        self.assertEqual(buffered.points, 6)
+        self.assertEqual(db.get_link(self.conn, link.link_id).points, 0)
+
+        self.buffer.flush()
+
+        flushed = db.get_link(self.conn, link.link_id)
+        self.assertEqual(flushed.points, 6)
+        self.assertEqual(flushed.hot, buffered.hot)
+        self.assertEqual(db.get_comment(self.conn, comment.comment_id).points, 1)
+        self.assertEqual(db.get_author(self.conn, author.author_id).karma, 7)
+
+    def test_flush_during_upvote(self):
+        author = db.create_author(self.conn, 'David')
+        link = db.submit_link(self.conn, author.author_id, 'a title', None, None)
+        self.buffer.upvote_link(self.conn, link.link_id, diff=1)
+
+        # a flush that starts after the upvote has read the link
+        get_link = db.get_link
+        flushers = []
+        def get_link_then_flush(conn, link_id):
+            ret = get_link(conn, link_id)
+            flushers.append(Thread(target=self.buffer.flush))
+            flushers[0].start()
+            flushers[0].join(0.1)
+            return ret
+
+        db.get_link = get_link_then_flush
+        try:
+            buffered = self.buffer.upvote_link(self.conn, link.link_id, diff=1)
+        finally:
+            db.get_link = get_link
+        flushers[0].join()
+
+        self.assertEqual(buffered.points, 2)
+        self.buffer.flush()
+        self.assertEqual(db.get_link(self.conn, link.link_id).points, 2)
+
+    def test_close_drains(self):
+        author = db.create_author(self.conn, 'David')
+        link = db.submit_link(self.conn, author.author_id, 'a title', 'a url', 'the body')
+
+        self.buffer.upvote_link(self.conn, link.link_id, diff=1)
+        self.buffer.close()
+
+        self.assertEqual(db.get_link(self.conn, link.link_id).points, 1)
+
+    def test_flush_when_full(self):
+        self.buffer.max_pending = 2
+        author = db.create_author(self.conn, 'David')
+        links = [db.submit_link(self.conn, author.author_id, 'a title', None, None)
+                 for _ in range(2)]
+
+        for link in links:
+            self.buffer.upvote_link(self.conn, link.link_id, diff=1)
+
+        # the background thread is woken up to do it
+        deadline = time.time() + 5
+        while (self.buffer.pending.box['links']
+               and time.time() < deadline):
+            time.sleep(0.01)
+        self.assertEqual([db.get_link(self.conn, l.link_id).points
+                          for l in links],
+                         [1, 1])
@@ -0,0 +1,111 @@
+from threading import Event
+from threading import Thread
+import os.path
+import shutil
+import tempfile
+import time
+import unittest
+
+from elmmit import db
+from elmmit import workers
+
+
+class TestWorkers(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        db_path = os.path.join(self.tempdir, 'db.db')
+        db.connect_db(db_path).close()
+        self.workers = workers.Workers(db_path, 1, max_queued=1)
+        self.release = Event()
+
+    def tearDown(self):
+        self.release.set()
+        self.workers.close()
+        shutil.rmtree(self.tempdir)
+
+    def _block(self, conn):
+        self.release.wait()
+
+    def test_call(self):
+        author = self.workers.call(1.0, db.create_author, 'hello')
+        self.assertEqual(author.author_id, 'hello')
+        # exceptions come back to the caller
+        self.assertRaises(TypeError,
+                          self.workers.call, 1.0, db.get_author, 'nobody')
+
+    def test_backpressure(self):
+        # tie up the only thread, then fill the queue behind it
+        self.assertRaises(workers.TimedOut,
+                          self.workers.call, 0.01, self._block)
+        self.assertRaises(workers.TimedOut,
+                          self.workers.call, 0.01, db.create_author, 'hello')
+        self.assertRaises(workers.Overloaded,
+                          self.workers.call, 0.01, db.create_author, 'other')
+
+        # the call that timed out before it got a thread is never made
+        self.release.set()
+        while self.workers.queued():
+            time.sleep(0.001)
+        count = self.workers.call(
+            1.0,
+            lambda conn: conn.execute("SELECT count(*) FROM authors").fetchone())
+        self.assertEqual(count[0], 0)
+
+
+class TestWriter(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        db_path = os.path.join(self.tempdir, 'db.db')
+        self.conn = db.connect_db(db_path)
+        self.writer = workers.Writer(db_path)
+
+    def tearDown(self):
+        self.writer.close()
+        self.conn.close()
+        shutil.rmtree(self.tempdir)
+
+    def test_group_commit(self):
+        started = Event()
+        release = Event()
+        def block(curs):
+            started.set()
+            release.wait()
+
+        def fail(curs):
+            db.create_author(curs, 'failed')
+            raise ValueError("oops")
+
+        results = {}
+        def call(name, fn, *a):
+            try:
+                results[name] = self.writer.call(5.0, fn, *a)
+            except Exception as ex:
+                results[name] = ex
+
+        # everything that queues up behind the blocked call is committed with
+        # a single transaction
+        threads = [Thread(target=call, args=('block', block))]
+        threads[0].start()
+        started.wait()
+        for name, fn, a in [('a', db.create_author, ('a',)),
+                            ('fail', fail, ()),
+                            ('b', db.create_author, ('b',))]:
+            threads.append(Thread(target=call, args=(name, fn) + a))
+            threads[-1].start()
+        while self.writer.queued() < 3:
+            time.sleep(0.001)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results['a'].author_id, 'a')
+        self.assertEqual(results['b'].author_id, 'b')
+        self.assertIsInstance(results['fail'], ValueError)
+        # only the call that failed was undone
+        self.assertEqual(sorted(row[0] for row in self.conn.execute(
+                             "SELECT author_id FROM authors")),
+                         ['a', 'b'])
+
+        batch_sizes = self.writer.batch_stats()
+        self.assertEqual(batch_sizes.count, 2)
+        self.assertEqual(batch_sizes.sum, 4)
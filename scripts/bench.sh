@@ -0,0 +1,5 @@
+#!/bin/sh
+
+set -ev
+
+vagrant ssh -c "cd elmmit/python && python -m elmmit.bench $*"